@@ -33,6 +33,25 @@ class UserResponse(UserBase):
         orm_mode = True
 
 
+class UserPage(BaseModel):
+    items: List[UserResponse]  # by id
+    next_after: Optional[int] = None  # pass as ?after= for the next page
+
+
+class UserHandle(BaseModel):
+    id: int
+    username: str
+
+    class Config:
+        orm_mode = True
+
+
+class PresenceResponse(BaseModel):
+    user_id: int
+    is_online: bool
+    last_seen: Optional[datetime] = None
+
+
 # ---------------------------
 # Chat Schemas
 # ---------------------------
@@ -54,6 +73,26 @@ class ChatResponse(ChatBase):
         orm_mode = True
 
 
+class MessagePreview(BaseModel):
+    id: int
+    sender_id: Optional[int]  # None once the sender deleted their account
+    content: str
+    timestamp: datetime
+
+
+class InboxEntry(ChatBase):
+    id: int
+    created_at: datetime
+    last_activity_at: Optional[datetime] = None
+    message_count: int = 0
+    last_message: Optional[MessagePreview] = None
+
+
+class InboxPage(BaseModel):
+    items: List[InboxEntry]
+    next_cursor: Optional[str] = None  # pass as ?before= for the next page
+
+
 # ---------------------------
 # Chat Participant Schemas
 # ---------------------------
@@ -65,11 +104,22 @@ class ChatParticipantBase(BaseModel):
 
 class ChatParticipantResponse(ChatParticipantBase):
     id: int
+    last_read_message_id: Optional[int] = None
 
     class Config:
         orm_mode = True
 
 
+class ReadWatermark(BaseModel):
+    chat_id: int
+    last_read_message_id: int
+
+
+class UnreadCount(BaseModel):
+    chat_id: int
+    unread: int
+
+
 # ---------------------------
 # Message Schemas
 # ---------------------------
@@ -86,7 +136,7 @@ class MessageCreate(MessageBase):
 class MessageResponse(MessageBase):
     id: int
     chat_id: int
-    sender_id: int
+    sender_id: Optional[int]  # None once the sender deleted their account
     timestamp: datetime
     is_read: bool
     sender: Optional[UserResponse] = None
@@ -95,6 +145,33 @@ class MessageResponse(MessageBase):
         orm_mode = True
 
 
+class MessageCreated(BaseModel):
+    id: int
+    chat_id: int
+    timestamp: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class MessageSearchPage(BaseModel):
+    items: List[MessageResponse]  # best match first
+    next_offset: Optional[int] = None
+
+
+class MessagePage(BaseModel):
+    items: List[MessageResponse]
+    users: Optional[List[UserResponse]] = None  # senders, when requested with senders=ids
+    has_more: bool
+    older_cursor: Optional[str] = None  # pass as ?before= for the previous page
+    newer_cursor: Optional[str] = None  # pass as ?after= to poll for new messages
+
+
+class MessageCatchUp(BaseModel):
+    items: List[MessageResponse]  # oldest first, senders not embedded
+    has_more: bool  # more to come, ask again with the last item's id as since_id
+
+
 
 
 
@@ -108,6 +185,15 @@ class Token(BaseModel):
     token_type: str
 
 
+class CurrentUser(BaseModel):
+    id: int
+    username: str
+    email: EmailStr
+
+    class Config:
+        orm_mode = True
+
+
 
 
 
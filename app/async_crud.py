@@ -0,0 +1,338 @@
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, noload, selectinload
+from typing import List, Optional
+from datetime import datetime
+
+import models, Schemas, crud
+from crud import (
+    _before,
+    _after,
+    chat_activity,
+    chat_message_removed,
+    chat_list_version_bump,
+    chat_version_bump,
+    chats_with_messages_of,
+    direct_pair,
+    direct_pairs_released,
+    is_direct_chat,
+    members_of,
+    messages_since,
+    participants_changed,
+    profile_changed,
+    returns_message_seq,
+    username_prefix,
+    with_message_seq,
+)
+from utils.pagination import MessageCursor
+from utils.archive import archive
+from utils.membership import membership
+from utils.recent import recent
+from utils.security import forget_principal
+
+
+# Async mirrors of crud.py. Relationships the response models read
+# are loaded eagerly, lazy loading isn't possible on an AsyncSession.
+
+
+# ---------------------------
+# USER CRUD
+# ---------------------------
+
+async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[models.User]:
+    return await db.get(models.User, user_id)
+
+
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    result = await db.execute(select(models.User).filter(models.User.email == email))
+    return result.scalars().first()
+
+
+async def create_user(db: AsyncSession, user: Schemas.UserCreate, hashed_password: str) -> models.User:
+    db_user = models.User(
+        username=user.username,
+        email=user.email,
+        hashed_password=hashed_password,
+    )
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+
+async def update_user(db: AsyncSession, user_id: int, user_update: Schemas.UserUpdate) -> Optional[models.User]:
+    db_user = await get_user_by_id(db, user_id)
+    if not db_user:
+        return None
+
+    changes = user_update.dict(exclude_unset=True)
+    for key, value in changes.items():
+        setattr(db_user, key, value)
+
+    if "username" in changes or "email" in changes:
+        for statement in profile_changed(user_id):
+            await db.execute(statement)
+    db_user.updated_at = datetime.utcnow()
+    await db.commit()
+    forget_principal(user_id)
+    await db.refresh(db_user)
+    return db_user
+
+
+async def set_password_hash(db: AsyncSession, user_id: int, hashed_password: str):
+    await db.execute(
+        update(models.User).where(models.User.id == user_id).values(hashed_password=hashed_password)
+    )
+    await db.commit()
+
+
+async def get_users_page(db: AsyncSession, after: Optional[int] = None, limit: int = 50) -> List[models.User]:
+    query = select(models.User)
+    if after is not None:
+        query = query.filter(models.User.id > after)
+    result = await db.execute(query.order_by(models.User.id).limit(limit))
+    return list(result.scalars().all())
+
+
+async def search_usernames(db: AsyncSession, prefix: str, limit: int = 10):
+    result = await db.execute(
+        select(models.User.id, models.User.username)
+        .filter(username_prefix(prefix))
+        .order_by(models.User.username)
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def get_users_by_ids(db: AsyncSession, user_ids) -> List[models.User]:
+    result = await db.execute(select(models.User).filter(models.User.id.in_(set(user_ids))))
+    return list(result.scalars().all())
+
+
+async def delete_user(db: AsyncSession, user_id: int) -> bool:
+    user = await get_user_by_id(db, user_id)
+    if not user:
+        return False
+    for statement in profile_changed(user_id):
+        await db.execute(statement)
+    await db.execute(direct_pairs_released(user_id))
+    affected = (await db.execute(chats_with_messages_of(user_id))).scalars().all()
+    await db.delete(user)
+    await db.commit()
+    membership.invalidate_user(user_id)
+    forget_principal(user_id)
+    # Their messages stay, without a sender: drop the windows still showing one
+    for chat_id in affected:
+        recent.drop(chat_id)
+    return True
+
+
+# ---------------------------
+# CHAT CRUD
+# ---------------------------
+
+async def create_chat(db: AsyncSession, chat: Schemas.ChatCreate) -> models.Chat:
+    new_chat = models.Chat(is_group=chat.is_group)
+    db.add(new_chat)
+    await db.flush()
+
+    for user_id in chat.participant_ids:
+        db.add(models.ChatParticipant(chat_id=new_chat.id, user_id=user_id))
+    await db.flush()
+    await db.execute(chat_list_version_bump(members_of(new_chat.id)))
+    await db.commit()
+
+    return await get_chat_by_id(db, new_chat.id)
+
+
+async def get_or_create_direct_chat(db: AsyncSession, user_id: int, other_user_id: int) -> models.Chat:
+    query = (
+        select(models.Chat)
+        .options(selectinload(models.Chat.participants))
+        .filter(direct_pair(user_id, other_user_id))
+    )
+    chat = (await db.execute(query)).scalars().first()
+    if chat:
+        return chat
+
+    low, high = sorted((user_id, other_user_id))
+    chat = models.Chat(is_group=False, direct_user_low=low, direct_user_high=high)
+    db.add(chat)
+    try:
+        await db.flush()
+        db.add_all([models.ChatParticipant(chat_id=chat.id, user_id=member) for member in (low, high)])
+        await db.flush()
+        await db.execute(chat_list_version_bump([low, high]))
+        await db.commit()
+    except IntegrityError:
+        # Lost the race for this pair, the other chat is committed by now
+        await db.rollback()
+        return (await db.execute(query)).scalars().one()
+    return await get_chat_by_id(db, chat.id)
+
+
+async def get_chat_by_id(db: AsyncSession, chat_id: int) -> Optional[models.Chat]:
+    result = await db.execute(
+        select(models.Chat)
+        .options(selectinload(models.Chat.participants))
+        .filter(models.Chat.id == chat_id)
+    )
+    return result.scalars().first()
+
+
+async def get_user_chats(db: AsyncSession, user_id: int) -> List[models.Chat]:
+    result = await db.execute(
+        select(models.Chat)
+        .join(models.ChatParticipant)
+        .options(selectinload(models.Chat.participants))
+        .filter(models.ChatParticipant.user_id == user_id)
+    )
+    return list(result.scalars().all())
+
+
+async def delete_chat(db: AsyncSession, chat_id: int) -> bool:
+    chat = await db.get(models.Chat, chat_id)
+    if not chat:
+        return False
+    await db.execute(chat_list_version_bump(members_of(chat_id)))
+    await db.delete(chat)
+    await db.commit()
+    membership.invalidate(chat_id)
+    archive.drop(chat_id)
+    recent.drop(chat_id)
+    return True
+
+
+# ---------------------------
+# MESSAGE CRUD
+# ---------------------------
+
+async def create_message(
+    db: AsyncSession, message: Schemas.MessageCreate, sender: Optional[models.User] = None
+) -> models.Message:
+    """
+    Insert a message and update its chat. Pass the sender already loaded to
+    have it on the returned message, it can't be lazy loaded afterwards.
+    """
+    new_message = models.Message(
+        chat_id=message.chat_id,
+        sender_id=message.sender_id,
+        content=message.content,
+        timestamp=datetime.utcnow(),
+        is_read=False,
+        sender=sender,
+    )
+    db.add(new_message)
+    await db.flush()
+    result = await db.execute(
+        with_message_seq(db, chat_activity(new_message.chat_id, new_message.id, new_message.timestamp))
+    )
+    new_message.seq = result.scalar() if returns_message_seq(db) else None
+    await db.commit()
+    recent.add(new_message)
+    return new_message
+
+
+async def get_messages_by_chat(
+    db: AsyncSession,
+    chat_id: int,
+    before: Optional[MessageCursor] = None,
+    after: Optional[MessageCursor] = None,
+    limit: Optional[int] = None,
+    with_sender: bool = True,
+) -> List[models.Message]:
+    if archive.boundary(chat_id) is not None:
+        # Part of the history is archived, let the sync version merge both
+        return await db.run_sync(crud.get_messages_by_chat, chat_id, before, after, limit, with_sender)
+
+    sender_loader = joinedload if with_sender else noload
+    query = (
+        select(models.Message)
+        .options(sender_loader(models.Message.sender))
+        .filter(models.Message.chat_id == chat_id)
+    )
+
+    if after is not None:
+        result = await db.execute(
+            query.filter(_after(after))
+            .order_by(models.Message.timestamp, models.Message.id)
+            .limit(limit)
+        )
+        return list(result.scalars().all())
+
+    if before is not None:
+        query = query.filter(_before(before))
+    if limit is None:
+        result = await db.execute(query.order_by(models.Message.timestamp, models.Message.id))
+        return list(result.scalars().all())
+
+    result = await db.execute(
+        query.order_by(models.Message.timestamp.desc(), models.Message.id.desc()).limit(limit)
+    )
+    return list(reversed(result.scalars().all()))
+
+
+async def get_messages_since(db: AsyncSession, chat_id: int, since_id: int, limit: int) -> List[models.Message]:
+    result = await db.scalars(messages_since(chat_id, since_id, limit))
+    return list(result.all())
+
+
+async def mark_message_as_read(db: AsyncSession, message_id: int) -> Optional[models.Message]:
+    msg = await db.get(models.Message, message_id)
+    if msg:
+        msg.is_read = True
+        await db.execute(chat_version_bump([msg.chat_id]))
+        await db.commit()
+        await db.refresh(msg)
+        recent.mark_read(msg.chat_id, msg.id)
+    return msg
+
+
+async def delete_message(db: AsyncSession, message_id: int) -> bool:
+    msg = await db.get(models.Message, message_id)
+    if not msg:
+        # Unknown, or archived: archived history is read-only
+        return False
+    await db.delete(msg)
+    await db.flush()
+    await db.execute(chat_message_removed(msg.chat_id, message_id))
+    await db.commit()
+    recent.discard(msg.chat_id, message_id)
+    return True
+
+
+# ---------------------------
+# CHAT PARTICIPANTS
+# ---------------------------
+
+async def add_participant_to_chat(db: AsyncSession, chat_id: int, user_id: int) -> models.ChatParticipant:
+    if await db.scalar(is_direct_chat(chat_id)):
+        raise ValueError("Direct chats can't gain participants")
+    participant = models.ChatParticipant(chat_id=chat_id, user_id=user_id)
+    db.add(participant)
+    await db.flush()
+    for statement in participants_changed(chat_id):
+        await db.execute(statement)
+    await db.commit()
+    membership.invalidate(chat_id)
+    await db.refresh(participant)
+    return participant
+
+
+async def remove_participant_from_chat(db: AsyncSession, chat_id: int, user_id: int) -> bool:
+    result = await db.execute(
+        select(models.ChatParticipant).filter(
+            models.ChatParticipant.chat_id == chat_id,
+            models.ChatParticipant.user_id == user_id,
+        )
+    )
+    participant = result.scalars().first()
+    if not participant:
+        return False
+    for statement in participants_changed(chat_id):
+        await db.execute(statement)
+    await db.delete(participant)
+    await db.commit()
+    membership.invalidate(chat_id)
+    return True
@@ -1,12 +1,180 @@
-from dotenv import load_dotenv
 import os
+from typing import Optional
 
-# Load variables from .env file
-load_dotenv()
+from pydantic import BaseSettings
 
-# Access environment variables
-DATABASE_URL = os.getenv("DATABASE_URL")
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 15))
-REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 7))
+
+class Settings(BaseSettings):
+    """
+    Every setting of the app, read once from the environment and .env
+    (variable names are the field names, any case). create_app() takes an
+    instance, so a worker or a test can run with its own.
+    """
+
+    database_url: Optional[str] = None
+    secret_key: Optional[str] = None
+    algorithm: str = "HS256"
+    access_token_expire_minutes: int = 15
+    refresh_token_expire_days: int = 7
+
+    # Connection pool of each worker (QueuePool; ignored for in-memory SQLite)
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = False
+    # At startup: "create" missing tables and the search index, "check" that
+    # tables, columns and indexes exist and fail otherwise, or "skip" any schema work
+    schema_mode: str = "create"
+
+    # Realtime delivery
+    ws_queue_size: int = 100
+    # Event bus between workers: local, unix:///path/to/relay.sock or redis://[:password@]host:port
+    broker_url: str = "local"
+    broker_queue_size: int = 10000
+
+    # Async database mode (AsyncEngine + async route handlers)
+    async_db: bool = False
+    async_database_url: Optional[str] = None
+
+    # Largest accepted POST /messages/batch
+    max_message_batch: int = 1000
+
+    # Group commit for POST /messages/ (batch concurrent inserts into one transaction)
+    group_commit_enabled: bool = False
+    group_commit_max_batch: int = 256
+    group_commit_max_wait_ms: float = 5
+    # A send waiting longer than this for its batch's commit answers 503
+    group_commit_timeout_ms: float = 5000
+
+    # chat_id -> participant ids cache used for membership checks
+    membership_cache_size: int = 10000
+    membership_cache_ttl: float = 60
+
+    # Verified JWT cache (entries expire at the token's exp) and user lookup cache
+    token_cache_size: int = 10000
+    principal_cache_size: int = 10000
+    principal_cache_ttl: float = 30
+
+    # Dedicated password hashing pool, requests beyond workers + queue get a 503
+    hash_workers: int = max(1, (os.cpu_count() or 2) // 2)
+    hash_queue_size: int = 32
+
+    # Presence: offline after presence_timeout s without heartbeat, persisted every presence_flush_interval s
+    presence_timeout: float = 60
+    presence_flush_interval: float = 10
+
+    # Characters of the last message shown per chat in the inbox
+    inbox_preview_length: int = 200
+
+    # Cold history: messages older than archive_after_days (0 disables) move to compressed
+    # per-chat segment files under archive_dir, checked every archive_interval s
+    archive_dir: str = "archive"
+    archive_after_days: float = 0
+    archive_interval: float = 3600
+    archive_block_messages: int = 256
+
+    # Admission control. Token buckets given as "rate/burst" (requests per second, 0 disables),
+    # keyed by user, or by client address before login, plus chat for sent messages.
+    # At most max_concurrency requests run at once (0 disables), others wait up to max_queue_wait_ms.
+    admission_enabled: bool = True
+    admission_table_size: int = 100000
+    rate_limit_user: str = "20/40"      # everything a user does
+    rate_limit_auth: str = "1/10"       # login, refresh, sign-up
+    rate_limit_send: str = "5/20"       # POST /messages/ and /messages/batch
+    rate_limit_search: str = "2/10"
+    rate_limit_read: str = "0/0"
+    rate_limit_write: str = "0/0"
+    rate_limit_chat: str = "20/50"      # messages per chat, all senders together
+    max_concurrency: int = 64
+    max_queue_wait_ms: float = 250
+
+    # Newest messages of active chats kept in memory for catch-up reads (0 disables), idle chats
+    # are evicted past recent_messages_memory_mb, a chat's window is rebuilt after recent_messages_ttl s
+    recent_messages_per_chat: int = 200
+    recent_messages_memory_mb: float = 64
+    recent_messages_ttl: float = 300
+
+    # Log requests running more than nplusone_threshold statements against one table (0 disables)
+    nplusone_threshold: int = 0
+
+    # Sampling profiler: profile this fraction of requests, or those sent with X-Profile: <profile_token>.
+    # Disabled (not even installed) when both are unset.
+    profile_sample_rate: float = 0
+    profile_token: Optional[str] = None
+    profile_interval_ms: float = 5
+
+    # /admin/* (limiter state, profiles) needs the header X-Admin-Token: <admin_token>,
+    # closed to everyone when unset
+    admin_token: Optional[str] = None
+
+    class Config:
+        env_file = ".env"
+
+    def rate_limits(self) -> dict:
+        limits = {}
+        for name in ("user", "auth", "send", "search", "read", "write", "chat"):
+            rate, burst = getattr(self, f"rate_limit_{name}").split("/")
+            limits[name] = (float(rate), float(burst))
+        return limits
+
+
+settings = Settings()
+
+# Module constants, the defaults of the components built at import time
+# (caches, pools, the hub...). create_app() resizes them to its own settings.
+DATABASE_URL = settings.database_url
+SECRET_KEY = settings.secret_key
+ALGORITHM = settings.algorithm
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
+REFRESH_TOKEN_EXPIRE_DAYS = settings.refresh_token_expire_days
+
+WS_QUEUE_SIZE = settings.ws_queue_size
+BROKER_URL = settings.broker_url
+BROKER_QUEUE_SIZE = settings.broker_queue_size
+
+ASYNC_DB = settings.async_db
+ASYNC_DATABASE_URL = settings.async_database_url
+
+MAX_MESSAGE_BATCH = settings.max_message_batch
+
+GROUP_COMMIT_ENABLED = settings.group_commit_enabled
+GROUP_COMMIT_MAX_BATCH = settings.group_commit_max_batch
+GROUP_COMMIT_MAX_WAIT_MS = settings.group_commit_max_wait_ms
+GROUP_COMMIT_TIMEOUT_MS = settings.group_commit_timeout_ms
+
+MEMBERSHIP_CACHE_SIZE = settings.membership_cache_size
+MEMBERSHIP_CACHE_TTL = settings.membership_cache_ttl
+
+TOKEN_CACHE_SIZE = settings.token_cache_size
+PRINCIPAL_CACHE_SIZE = settings.principal_cache_size
+PRINCIPAL_CACHE_TTL = settings.principal_cache_ttl
+
+HASH_WORKERS = settings.hash_workers
+HASH_QUEUE_SIZE = settings.hash_queue_size
+
+PRESENCE_TIMEOUT = settings.presence_timeout
+PRESENCE_FLUSH_INTERVAL = settings.presence_flush_interval
+
+INBOX_PREVIEW_LENGTH = settings.inbox_preview_length
+
+ARCHIVE_DIR = settings.archive_dir
+ARCHIVE_AFTER_DAYS = settings.archive_after_days
+ARCHIVE_INTERVAL = settings.archive_interval
+ARCHIVE_BLOCK_MESSAGES = settings.archive_block_messages
+
+ADMISSION_ENABLED = settings.admission_enabled
+ADMISSION_TABLE_SIZE = settings.admission_table_size
+RATE_LIMITS = settings.rate_limits()
+MAX_CONCURRENCY = settings.max_concurrency
+MAX_QUEUE_WAIT_MS = settings.max_queue_wait_ms
+
+RECENT_MESSAGES_PER_CHAT = settings.recent_messages_per_chat
+RECENT_MESSAGES_MEMORY_MB = settings.recent_messages_memory_mb
+RECENT_MESSAGES_TTL = settings.recent_messages_ttl
+
+NPLUSONE_THRESHOLD = settings.nplusone_threshold
+
+PROFILE_SAMPLE_RATE = settings.profile_sample_rate
+PROFILE_TOKEN = settings.profile_token
+PROFILE_INTERVAL_MS = settings.profile_interval_ms
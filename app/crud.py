@@ -1,8 +1,70 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, case, exists, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, noload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from typing import List, Optional
 from datetime import datetime
 
 import models, Schemas
+from config import INBOX_PREVIEW_LENGTH
+from utils.pagination import MessageCursor
+from utils.archive import ArchivedMessage, archive
+from utils.membership import membership
+from utils.recent import recent
+from utils.security import forget_principal
+
+
+# ---------------------------
+# VERSION COUNTERS (ETags)
+# ---------------------------
+
+def chat_version_bump(chat_ids):
+    """
+    UPDATE bumping chats.version, chat_ids is a list or a select of ids.
+    """
+    return (
+        update(models.Chat)
+        .where(models.Chat.id.in_(chat_ids))
+        .values(version=models.Chat.version + 1)
+    )
+
+
+def chat_list_version_bump(user_ids):
+    """
+    UPDATE bumping users.chat_list_version, user_ids is a list or a select of ids.
+    updated_at is left alone, the user's profile didn't change.
+    """
+    return (
+        update(models.User)
+        .where(models.User.id.in_(user_ids))
+        .values(chat_list_version=models.User.chat_list_version + 1, updated_at=models.User.updated_at)
+    )
+
+
+def members_of(chat_id: int):
+    return select(models.ChatParticipant.user_id).where(models.ChatParticipant.chat_id == chat_id)
+
+
+def chats_of(user_id: int):
+    return select(models.ChatParticipant.chat_id).where(models.ChatParticipant.user_id == user_id)
+
+
+def participants_changed(chat_id: int) -> list:
+    """
+    Statements to run, before commit, when a chat gains or loses members.
+    Run them while every affected member is still (or already) a participant.
+    """
+    return [chat_version_bump([chat_id]), chat_list_version_bump(members_of(chat_id))]
+
+
+def profile_changed(user_id: int) -> list:
+    """
+    The user is embedded in their chats' participant lists and message senders.
+    """
+    co_members = select(models.ChatParticipant.user_id).where(
+        models.ChatParticipant.chat_id.in_(chats_of(user_id))
+    )
+    return [chat_version_bump(chats_of(user_id)), chat_list_version_bump(co_members)]
 
 
 # ---------------------------
@@ -34,17 +96,64 @@ def update_user(db: Session, user_id: int, user_update: Schemas.UserUpdate) -> O
     if not db_user:
         return None
 
-    for key, value in user_update.dict(exclude_unset=True).items():
+    changes = user_update.dict(exclude_unset=True)
+    for key, value in changes.items():
         setattr(db_user, key, value)
 
+    if "username" in changes or "email" in changes:
+        for statement in profile_changed(user_id):
+            db.execute(statement)
     db_user.updated_at = datetime.utcnow()
     db.commit()
+    forget_principal(user_id)
     db.refresh(db_user)
     return db_user
 
 
-def get_all_users(db: Session) -> List[models.User]:
-    return db.query(models.User).all()
+def set_password_hash(db: Session, user_id: int, hashed_password: str):
+    db.execute(
+        update(models.User).where(models.User.id == user_id).values(hashed_password=hashed_password)
+    )
+    db.commit()
+
+
+def get_users_page(db: Session, after: Optional[int] = None, limit: int = 50) -> List[models.User]:
+    """
+    Users by id, starting after the `after` id (keyset, no OFFSET scan).
+    """
+    query = db.query(models.User)
+    if after is not None:
+        query = query.filter(models.User.id > after)
+    return query.order_by(models.User.id).limit(limit).all()
+
+
+def username_prefix(prefix: str):
+    """
+    Filter for usernames starting with prefix, written as a range so it is
+    served by the username index. The startswith() re-check keeps results
+    exact under collations where the range isn't contiguous.
+    """
+    conditions = [models.User.username >= prefix, models.User.username.startswith(prefix, autoescape=True)]
+    if ord(prefix[-1]) < 0x10FFFF:
+        conditions.append(models.User.username < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    return and_(*conditions)
+
+
+def search_usernames(db: Session, prefix: str, limit: int = 10):
+    """
+    (id, username) rows of users whose username starts with prefix, alphabetically.
+    """
+    return (
+        db.query(models.User.id, models.User.username)
+        .filter(username_prefix(prefix))
+        .order_by(models.User.username)
+        .limit(limit)
+        .all()
+    )
+
+
+def get_users_by_ids(db: Session, user_ids) -> List[models.User]:
+    return db.query(models.User).filter(models.User.id.in_(set(user_ids))).all()
 
 def delete_user(db: Session, user_id: int):
     # Fetch the user first
@@ -52,9 +161,19 @@ def delete_user(db: Session, user_id: int):
     if not user:
         return False  # User not found
 
+    for statement in profile_changed(user_id):
+        db.execute(statement)
+    db.execute(direct_pairs_released(user_id))
+    affected = db.execute(chats_with_messages_of(user_id)).scalars().all()
+
     # Delete user from database
     db.delete(user)
     db.commit()
+    membership.invalidate_user(user_id)
+    forget_principal(user_id)
+    # Their messages stay, without a sender: drop the windows still showing one
+    for chat_id in affected:
+        recent.drop(chat_id)
     return True
 
 
@@ -72,20 +191,74 @@ def create_chat(db: Session, chat: Schemas.ChatCreate) -> models.Chat:
     for user_id in chat.participant_ids:
         participant = models.ChatParticipant(chat_id=new_chat.id, user_id=user_id)
         db.add(participant)
+    db.flush()
+    db.execute(chat_list_version_bump(members_of(new_chat.id)))
     db.commit()
 
     db.refresh(new_chat)
     return new_chat
 
 
+def direct_pair(user_id: int, other_user_id: int):
+    """
+    Filter on the canonical (low, high) key of a direct chat.
+    """
+    low, high = sorted((user_id, other_user_id))
+    return and_(models.Chat.direct_user_low == low, models.Chat.direct_user_high == high)
+
+
+def chats_with_messages_of(user_id: int):
+    return select(models.Message.chat_id).where(models.Message.sender_id == user_id).distinct()
+
+
+def direct_pairs_released(user_id: int):
+    """
+    UPDATE clearing the direct chat keys of a user about to be deleted, so a
+    later user given the same id can't land in their chats.
+    """
+    return (
+        update(models.Chat)
+        .where(or_(models.Chat.direct_user_low == user_id, models.Chat.direct_user_high == user_id))
+        .values(direct_user_low=None, direct_user_high=None)
+    )
+
+
+def get_or_create_direct_chat(db: Session, user_id: int, other_user_id: int) -> models.Chat:
+    """
+    The direct chat of two users, created on first use. Concurrent creations
+    for the same pair race on ux_chats_direct_pair: the loser rolls back and
+    returns the winner's chat.
+    """
+    chat = db.query(models.Chat).filter(direct_pair(user_id, other_user_id)).first()
+    if chat:
+        return chat
+
+    low, high = sorted((user_id, other_user_id))
+    chat = models.Chat(is_group=False, direct_user_low=low, direct_user_high=high)
+    db.add(chat)
+    try:
+        db.flush()
+        db.add_all([models.ChatParticipant(chat_id=chat.id, user_id=member) for member in (low, high)])
+        db.flush()
+        db.execute(chat_list_version_bump([low, high]))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return db.query(models.Chat).filter(direct_pair(user_id, other_user_id)).one()
+    db.refresh(chat)
+    return chat
+
+
 def get_chat_by_id(db: Session, chat_id: int) -> Optional[models.Chat]:
     return db.query(models.Chat).filter(models.Chat.id == chat_id).first()
 
 
 def get_user_chats(db: Session, user_id: int) -> List[models.Chat]:
+    # Participants of all chats come back in one extra IN query
     return (
         db.query(models.Chat)
         .join(models.ChatParticipant)
+        .options(selectinload(models.Chat.participants))
         .filter(models.ChatParticipant.user_id == user_id)
         .all()
     )
@@ -95,8 +268,12 @@ def delete_chat(db: Session, chat_id: int) -> bool:
     chat = get_chat_by_id(db, chat_id)
     if not chat:
         return False
+    db.execute(chat_list_version_bump(members_of(chat_id)))
     db.delete(chat)
     db.commit()
+    membership.invalidate(chat_id)
+    archive.drop(chat_id)
+    recent.drop(chat_id)
     return True
 
 
@@ -104,6 +281,50 @@ def delete_chat(db: Session, chat_id: int) -> bool:
 # MESSAGE CRUD
 # ---------------------------
 
+def chat_activity(chat_id: int, message_id: int, timestamp: datetime, count: int = 1):
+    """
+    UPDATE keeping the chat's inbox columns current after inserting `count`
+    messages, the newest being message_id. Execute it before the insert commits.
+    Concurrent inserts can't move last_message_id backwards.
+    """
+    is_newer = or_(models.Chat.last_message_id.is_(None), models.Chat.last_message_id < message_id)
+    return (
+        update(models.Chat)
+        .where(models.Chat.id == chat_id)
+        .values(
+            message_count=models.Chat.message_count + count,
+            message_seq=models.Chat.message_seq + count,
+            version=models.Chat.version + 1,
+            last_message_id=case((is_newer, message_id), else_=models.Chat.last_message_id),
+            last_activity_at=case((is_newer, timestamp), else_=models.Chat.last_activity_at),
+        )
+    )
+
+
+def returns_message_seq(db) -> bool:
+    """
+    Whether the database can return the chat's new message_seq from the
+    chat_activity() UPDATE (SQLite 3.35+, Postgres).
+    """
+    return db.bind.dialect.update_returning
+
+
+def with_message_seq(db, statement):
+    if returns_message_seq(db):
+        return statement.returning(models.Chat.message_seq)
+    return statement
+
+
+def record_message(db: Session, message: models.Message):
+    """
+    Flush a new Message and update its chat, leaves the commit to the caller.
+    """
+    db.add(message)
+    db.flush()
+    result = db.execute(with_message_seq(db, chat_activity(message.chat_id, message.id, message.timestamp)))
+    message.seq = result.scalar() if returns_message_seq(db) else None
+
+
 def create_message(db: Session, message: Schemas.MessageCreate) -> models.Message:
     new_message = models.Message(
         chat_id=message.chat_id,
@@ -111,47 +332,369 @@ def create_message(db: Session, message: Schemas.MessageCreate) -> models.Messag
         content=message.content,
         timestamp=datetime.utcnow(),
     )
-    db.add(new_message)
+    record_message(db, new_message)
     db.commit()
     db.refresh(new_message)
+    recent.add(new_message)
     return new_message
 
 
-def get_messages_by_chat(db: Session, chat_id: int) -> List[models.Message]:
-    return (
+def _before(cursor: MessageCursor):
+    timestamp, message_id = cursor
+    return or_(
+        models.Message.timestamp < timestamp,
+        and_(models.Message.timestamp == timestamp, models.Message.id < message_id),
+    )
+
+
+def _after(cursor: MessageCursor):
+    timestamp, message_id = cursor
+    return or_(
+        models.Message.timestamp > timestamp,
+        and_(models.Message.timestamp == timestamp, models.Message.id > message_id),
+    )
+
+
+def create_messages(db: Session, messages: List[Schemas.MessageCreate]) -> List[models.Message]:
+    """
+    Insert many messages with one multi-row INSERT ... RETURNING and one commit.
+    Returned Message objects are detached, they only carry what was inserted.
+    """
+    now = datetime.utcnow()
+    rows = [
+        {"chat_id": m.chat_id, "sender_id": m.sender_id, "content": m.content, "timestamp": now, "is_read": False}
+        for m in messages
+    ]
+    ids = db.scalars(
+        insert(models.Message).returning(models.Message.id, sort_by_parameter_order=True),
+        rows,
+    ).all()
+
+    created = [models.Message(id=message_id, **row) for message_id, row in zip(ids, rows)]
+
+    # One chat UPDATE per distinct chat in the batch
+    per_chat = {}
+    for message in created:
+        per_chat.setdefault(message.chat_id, []).append(message)
+    for chat_id, chat_messages in per_chat.items():
+        chat_messages.sort(key=lambda message: message.id)
+        result = db.execute(with_message_seq(
+            db, chat_activity(chat_id, chat_messages[-1].id, now, len(chat_messages))
+        ))
+        last_seq = result.scalar() if returns_message_seq(db) else None
+        if last_seq is not None:
+            # The chat's seqs of this batch, in id order
+            for offset, message in enumerate(reversed(chat_messages)):
+                message.seq = last_seq - offset
+
+    db.commit()
+    for message in created:
+        recent.add(message)
+    return created
+
+
+def get_messages_by_chat(
+    db: Session,
+    chat_id: int,
+    before: Optional[MessageCursor] = None,
+    after: Optional[MessageCursor] = None,
+    limit: Optional[int] = None,
+    with_sender: bool = True,
+) -> List[models.Message]:
+    """
+    Messages of a chat in chronological order.
+    With a limit, returns the newest `limit` messages older than `before`
+    (or the newest overall), or the oldest `limit` newer than `after`.
+    Both walk ix_messages_chat_id_timestamp_id so cost doesn't depend on history length.
+    Senders are joined in the same query, or left unloaded with with_sender=False.
+    Pages reaching past the archive boundary continue in the chat's archive,
+    archived messages come back as detached Message objects.
+    """
+    sender_loader = joinedload if with_sender else noload
+    query = (
         db.query(models.Message)
+        .options(sender_loader(models.Message.sender))
         .filter(models.Message.chat_id == chat_id)
-        .order_by(models.Message.timestamp)
+    )
+    rows = read_through_page(query, chat_id, before, after, limit)
+
+    archived = [row for row in rows if isinstance(row, ArchivedMessage)]
+    if not archived:
+        return rows
+    senders = {}
+    if with_sender:
+        senders = {user.id: user for user in get_users_by_ids(db, {row.sender_id for row in archived})}
+    messages = []
+    for row in rows:
+        if isinstance(row, ArchivedMessage):
+            message = models.Message(**row._asdict())
+            # Not through the relationship, the backref would add it to the session
+            set_committed_value(message, "sender", senders.get(row.sender_id))
+            row = message
+        messages.append(row)
+    return messages
+
+
+def read_through_page(
+    query,
+    chat_id: int,
+    before: Optional[MessageCursor],
+    after: Optional[MessageCursor],
+    limit: Optional[int],
+) -> list:
+    """
+    keyset_page over the chat's hot rows and its archive together. Archived
+    messages all sort before hot ones, the archive is only read when the page
+    crosses the boundary. They come back as ArchivedMessage tuples, which
+    read like plain column rows.
+    """
+    boundary = archive.boundary(chat_id)
+    if boundary is None:
+        return keyset_page(query, before, after, limit)
+
+    if after is not None:
+        if after >= boundary:
+            return keyset_page(query, None, after, limit)
+        cold = archive.read(chat_id, after=after, limit=limit)
+        if limit is not None and len(cold) >= limit:
+            return cold
+        return cold + keyset_page(query, None, boundary, None if limit is None else limit - len(cold))
+
+    if before is not None and before <= boundary:
+        return archive.read(chat_id, before=before, limit=limit)
+    # Rows at or below the boundary may linger after a crashed archive run
+    hot = keyset_page(query.filter(_after(boundary)), before, None, limit)
+    if limit is not None and len(hot) >= limit:
+        return hot
+    return archive.read(chat_id, limit=None if limit is None else limit - len(hot)) + hot
+
+
+def keyset_page(query, before: Optional[MessageCursor], after: Optional[MessageCursor], limit: Optional[int]) -> list:
+    """
+    Apply message keyset pagination to any query over messages, ORM objects
+    or plain columns alike. Results come back in chronological order.
+    """
+    if after is not None:
+        return (
+            query.filter(_after(after))
+            .order_by(models.Message.timestamp, models.Message.id)
+            .limit(limit)
+            .all()
+        )
+
+    if before is not None:
+        query = query.filter(_before(before))
+    if limit is None:
+        return query.order_by(models.Message.timestamp, models.Message.id).all()
+
+    newest_first = (
+        query.order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+        .limit(limit)
         .all()
     )
+    return list(reversed(newest_first))
+
+
+def messages_since(chat_id: int, since_id: int, limit: int):
+    """
+    Messages of a chat with an id above since_id, in id order, senders not
+    loaded. Walks ix_messages_chat_id_id.
+    """
+    return (
+        select(models.Message)
+        .options(noload(models.Message.sender))
+        .where(models.Message.chat_id == chat_id, models.Message.id > since_id)
+        .order_by(models.Message.id)
+        .limit(limit)
+    )
+
+
+def get_messages_since(db: Session, chat_id: int, since_id: int, limit: int) -> List[models.Message]:
+    return list(db.scalars(messages_since(chat_id, since_id, limit)).all())
 
 
 def mark_message_as_read(db: Session, message_id: int) -> Optional[models.Message]:
     msg = db.query(models.Message).filter(models.Message.id == message_id).first()
     if msg:
         msg.is_read = True
+        # is_read is part of the history, its ETag changes
+        db.execute(chat_version_bump([msg.chat_id]))
         db.commit()
         db.refresh(msg)
+        recent.mark_read(msg.chat_id, msg.id)
     return msg
 
 
+def mark_chat_read(db: Session, chat_id: int, user_id: int, message_id: int) -> bool:
+    """
+    Move the participant's read watermark forward to message_id in one UPDATE
+    (plus the chat's version when it moved). Never moves it backwards, and
+    only to a message that exists in the chat. Returns False when nothing changed.
+    """
+    participant = models.ChatParticipant
+    result = db.execute(
+        update(participant)
+        .where(
+            participant.chat_id == chat_id,
+            participant.user_id == user_id,
+            or_(participant.last_read_message_id.is_(None), participant.last_read_message_id < message_id),
+            exists().where(models.Message.chat_id == chat_id, models.Message.id == message_id),
+        )
+        .values(last_read_message_id=message_id)
+    )
+    if result.rowcount > 0:
+        db.execute(chat_version_bump([chat_id]))
+    db.commit()
+    return result.rowcount > 0
+
+
+def get_unread_counts(db: Session, user_id: int) -> List[tuple]:
+    """
+    (chat_id, unread) for every chat of the user, one aggregate query.
+    Each chat only counts the index range past its watermark, own messages excluded.
+    """
+    participant, message = models.ChatParticipant, models.Message
+    return (
+        db.query(participant.chat_id, func.count(message.id))
+        .outerjoin(
+            message,
+            and_(
+                message.chat_id == participant.chat_id,
+                message.id > func.coalesce(participant.last_read_message_id, 0),
+                message.sender_id != participant.user_id,
+            ),
+        )
+        .filter(participant.user_id == user_id)
+        .group_by(participant.chat_id)
+        .all()
+    )
+
+
+def chat_message_removed(chat_id: int, message_id: int):
+    """
+    UPDATE for the chat's inbox columns after one of its messages was deleted
+    (and flushed). When it was the last message, the preview and the
+    activity time fall back to the newest remaining one by (timestamp, id),
+    or to the chat's creation when none is left.
+    """
+    def newest(column):
+        return (
+            select(column)
+            .where(models.Message.chat_id == chat_id)
+            .order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+
+    was_last = models.Chat.last_message_id == message_id
+    return (
+        update(models.Chat)
+        .where(models.Chat.id == chat_id)
+        .values(
+            message_count=models.Chat.message_count - 1,
+            version=models.Chat.version + 1,
+            last_message_id=case((was_last, newest(models.Message.id)), else_=models.Chat.last_message_id),
+            last_activity_at=case(
+                (was_last, func.coalesce(newest(models.Message.timestamp), models.Chat.created_at)),
+                else_=models.Chat.last_activity_at,
+            ),
+        )
+    )
+
+
 def delete_message(db: Session, message_id: int) -> bool:
+    """
+    False when there's no such message in the table. Archived messages are
+    read-only history and can't be deleted, they were read by everyone.
+    """
     msg = db.query(models.Message).filter(models.Message.id == message_id).first()
     if not msg:
         return False
     db.delete(msg)
+    db.flush()
+    db.execute(chat_message_removed(msg.chat_id, message_id))
     db.commit()
+    recent.discard(msg.chat_id, message_id)
     return True
 
 
+def get_inbox(
+    db: Session,
+    user_id: int,
+    before: Optional[MessageCursor] = None,
+    limit: int = 20,
+    preview_length: int = INBOX_PREVIEW_LENGTH,
+) -> list:
+    """
+    The user's chats, most recently active first, each with its last message
+    preview. One query, keyset paginated on (last_activity_at, id).
+    """
+    chat, message, participant = models.Chat, models.Message, models.ChatParticipant
+    query = (
+        db.query(
+            chat.id,
+            chat.is_group,
+            chat.created_at,
+            chat.last_activity_at,
+            chat.message_count,
+            message.id.label("message_id"),
+            message.sender_id,
+            func.substr(message.content, 1, preview_length).label("content"),
+            message.timestamp,
+        )
+        .join(participant, and_(participant.chat_id == chat.id, participant.user_id == user_id))
+        .outerjoin(message, message.id == chat.last_message_id)
+    )
+    if before is not None:
+        timestamp, chat_id = before
+        query = query.filter(
+            or_(
+                chat.last_activity_at < timestamp,
+                and_(chat.last_activity_at == timestamp, chat.id < chat_id),
+            )
+        )
+    return query.order_by(chat.last_activity_at.desc(), chat.id.desc()).limit(limit).all()
+
+
 # ---------------------------
 # CHAT PARTICIPANTS
 # ---------------------------
 
+def get_memberships(db: Session, pairs) -> set:
+    """
+    Which of the given (chat_id, user_id) pairs are memberships, in one query.
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return set()
+    rows = (
+        db.query(models.ChatParticipant.chat_id, models.ChatParticipant.user_id)
+        .filter(
+            models.ChatParticipant.chat_id.in_({chat_id for chat_id, _ in pairs}),
+            models.ChatParticipant.user_id.in_({user_id for _, user_id in pairs}),
+        )
+        .all()
+    )
+    return {(chat_id, user_id) for chat_id, user_id in rows} & pairs
+
+
+def is_direct_chat(chat_id: int):
+    return select(models.Chat.direct_user_low.is_not(None)).where(models.Chat.id == chat_id)
+
+
 def add_participant_to_chat(db: Session, chat_id: int, user_id: int) -> models.ChatParticipant:
+    """
+    Raises ValueError for direct chats, they keep their two participants.
+    """
+    if db.scalar(is_direct_chat(chat_id)):
+        raise ValueError("Direct chats can't gain participants")
     participant = models.ChatParticipant(chat_id=chat_id, user_id=user_id)
     db.add(participant)
+    db.flush()
+    for statement in participants_changed(chat_id):
+        db.execute(statement)
     db.commit()
+    membership.invalidate(chat_id)
     db.refresh(participant)
     return participant
 
@@ -167,6 +710,9 @@ def remove_participant_from_chat(db: Session, chat_id: int, user_id: int) -> boo
     )
     if not participant:
         return False
+    for statement in participants_changed(chat_id):
+        db.execute(statement)
     db.delete(participant)
     db.commit()
+    membership.invalidate(chat_id)
     return True
@@ -1,21 +1,117 @@
-from sqlalchemy import create_engine
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-import os
-from dotenv import load_dotenv
-load_dotenv()
 
-SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
-# Create engine
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+from config import Settings
+
+if TYPE_CHECKING:
+    # sqlalchemy.ext.asyncio needs greenlet, only imported in async mode
+    from sqlalchemy.ext.asyncio import AsyncEngine
 
-# Create session
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Engines are created by init_engines() in the app's lifespan, importing
+# this module opens no pool and connects nowhere.
+engine: Optional[Engine] = None
+async_engine: Optional["AsyncEngine"] = None
+
+# Session factories, bound (async: created) by init_engines()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+AsyncSessionLocal = None
 
 # Base class for ORM models
 Base = declarative_base()
 
 
+# Async drivers for the URLs we support, used when ASYNC_DATABASE_URL isn't set
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for {scheme}")
+    return ASYNC_DRIVERS[dialect] + sep + rest
+
+
+def pool_options(url: str, settings: Settings) -> dict:
+    """
+    QueuePool sizing from settings. In-memory SQLite gets a single shared
+    connection from SQLAlchemy and takes none of these.
+    """
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        return {}
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+
+
+def init_engines(settings: Settings) -> Tuple[Engine, Optional["AsyncEngine"]]:
+    """
+    Create the engines and bind the session factories. The async engine is
+    only built in async mode, so the async drivers stay optional.
+    """
+    global engine, async_engine, AsyncSessionLocal
+    if not settings.database_url:
+        raise RuntimeError("DATABASE_URL is not set")
+
+    engine = create_engine(settings.database_url, **pool_options(settings.database_url, settings))
+    SessionLocal.configure(bind=engine)
+    if settings.async_db:
+        from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+        url = settings.async_database_url or to_async_url(settings.database_url)
+        async_engine = create_async_engine(url, **pool_options(url, settings))
+        # Objects stay readable after commit, lazy loads aren't possible in async
+        AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+    return engine, async_engine
+
+
+async def dispose_engines():
+    """
+    Close every pooled connection, the engines can't be used afterwards.
+    """
+    global engine, async_engine
+    if async_engine is not None:
+        await async_engine.dispose()
+        async_engine = None
+    if engine is not None:
+        engine.dispose()
+        engine = None
+
+
+def missing_schema(engine: Engine) -> list:
+    """
+    Tables, columns and indexes of the models that the database doesn't
+    have, as "table", "table.column" or "table.index". Reads the catalog
+    only, changes nothing.
+    """
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            missing.append(table.name)
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(f"{table.name}.{column.name}" for column in table.columns if column.name not in columns)
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing.extend(f"{table.name}.{index.name}" for index in table.indexes if index.name not in indexes)
+    return missing
+
+
 # Dependency function for FastAPI routes
 def get_db():
     """
@@ -28,3 +124,10 @@ def get_db():
     finally:
         db.close()
 
+
+async def get_async_db():
+    """
+    Async counterpart of get_db, only available when ASYNC_DB is enabled.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,87 @@
+import hmac
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException, Request, status
+from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import crud, models
+from database import get_async_db, get_db
+from Schemas import CurrentUser
+from utils.security import decode_token_cached, principal_cache
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
+
+
+def get_principal(db: Session, email: str):
+    principal = principal_cache.get(email)
+    if principal is None:
+        user = crud.get_user_by_email(db, email)
+        if not user:
+            return None
+        principal = CurrentUser.from_orm(user)
+        principal_cache.set(email, principal)
+    return principal
+
+
+async def aget_principal(db, email: str):
+    """
+    get_principal on an AsyncSession, same cache.
+    """
+    principal = principal_cache.get(email)
+    if principal is None:
+        user = await db.scalar(select(models.User).filter(models.User.email == email))
+        if not user:
+            return None
+        principal = CurrentUser.from_orm(user)
+        principal_cache.set(email, principal)
+    return principal
+
+
+def principal_from_token(db: Session, token: str, scope: str = "access_token"):
+    payload = decode_token_cached(token)
+    if not payload or payload.get("scope", "access_token") != scope:
+        return None
+    return get_principal(db, payload.get("sub"))
+
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> CurrentUser:
+    """
+    The user behind the bearer token. Signature checks and user lookups are
+    cached, a warm request doesn't touch the database.
+    """
+    principal = principal_from_token(db, token)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
+
+
+async def aget_current_user(token: str = Depends(oauth2_scheme), db=Depends(get_async_db)) -> CurrentUser:
+    """
+    get_current_user for the async routers, a cache miss awaits the user lookup.
+    """
+    payload = decode_token_cached(token)
+    principal = None
+    if payload and payload.get("scope", "access_token") == "access_token":
+        principal = await aget_principal(db, payload.get("sub"))
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
+
+
+def require_admin(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """
+    Operators only: the X-Admin-Token header must match the app's ADMIN_TOKEN.
+    """
+    expected = request.app.state.settings.admin_token
+    if not expected or not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), expected.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin token required")
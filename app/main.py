@@ -1,17 +1,218 @@
-from fastapi import FastAPI
-from database import Base, engine
-from routers import users , chats, messages , auth
+import logging
+import time
+from contextlib import asynccontextmanager
 
-# Create all tables (only runs once at startup)
-Base.metadata.create_all(bind=engine)
+from fastapi import FastAPI, APIRouter, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+import config
+import database
+from config import Settings
+from database import Base, SessionLocal
+from routers import users , chats, messages , auth, ws, admin
+from utils.group_commit import WriterUnavailable, writer
+from utils.hashing import HasherBusy, hasher
+from utils.admission import AdmissionMiddleware, Throttled, admission, rejection
+from utils.profiler import ProfilerMiddleware, profiler
+from utils.hub import hub
+from utils.membership import membership
+from utils.presence import presence
+from utils.archive import archive
+from utils.recent import recent
+from utils import search, metrics, security
 
-# Initialize app
-app = FastAPI(title="Chat Backend API")
+logger = logging.getLogger(__name__)
 
-# Register routers
-app.include_router(chats.router)
-app.include_router(messages.router)
-app.include_router(auth.router)
-app.include_router(users.router)
+SCHEMA_MODES = ("create", "check", "skip")
 
 
+def hasher_busy(request: Request, exc: HasherBusy):
+    # Shed login/sign-up bursts instead of queueing them behind each other
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Too many password operations, retry shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+
+def writer_unavailable(request: Request, exc: WriterUnavailable):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Message not confirmed in time, check the chat before resending"},
+        headers={"Retry-After": "1"},
+    )
+
+
+def throttled(request: Request, exc: Throttled):
+    return rejection(429, f"Rate limit exceeded ({exc.limit})", exc.retry_after)
+
+
+def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def without_routes_of(router: APIRouter, overrides: list) -> APIRouter:
+    """
+    Copy of `router` minus the endpoints that one of `overrides` already serves.
+    """
+    taken = {
+        (route.path, method)
+        for override in overrides
+        for route in override.routes
+        for method in route.methods
+    }
+    remaining = APIRouter()
+    remaining.routes = [
+        route for route in router.routes
+        if not (isinstance(route, APIRoute) and any((route.path, m) in taken for m in route.methods))
+    ]
+    return remaining
+
+
+# ---------------------------
+# Startup and shutdown
+# ---------------------------
+
+def prepare_schema(engine, mode: str):
+    """
+    "create" adds missing tables and the search index (create_all never
+    alters existing ones), "check" only verifies them, "skip" trusts that
+    migrations ran.
+    """
+    if mode == "create":
+        Base.metadata.create_all(bind=engine)
+        search.install(engine)
+    elif mode == "check":
+        missing = database.missing_schema(engine) + search.missing(engine)
+        if missing:
+            raise RuntimeError("Database schema is missing " + ", ".join(missing))
+
+
+def configure_components(settings: Settings):
+    """
+    Resize the per-process components (built at import from the
+    environment) to this app's settings, before any of them is used.
+    """
+    security.configure(settings)
+    hasher.configure(settings)
+    admission.configure(settings)
+    profiler.configure(settings)
+    membership.configure(settings)
+    recent.configure(settings)
+    hub.configure(settings)
+    writer.configure(settings)
+    presence.configure(settings)
+    archive.configure(settings)
+
+
+def start_background_work():
+    hub.start()
+    presence.start(SessionLocal)
+    archive.start(SessionLocal)
+
+
+def stop_background_work():
+    # Commit whatever the group-commit writer still holds
+    writer.stop()
+    presence.stop()
+    archive.stop()
+    hub.stop()
+
+
+def make_lifespan(settings: Settings):
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        timings = {}
+
+        def timed(phase: str, started: float):
+            timings[phase] = time.perf_counter() - started
+            metrics.startup_seconds.set(timings[phase], phase)
+
+        started = time.perf_counter()
+        configure_components(settings)
+        engine, async_engine = database.init_engines(settings)
+        metrics.instrument_engine(engine)
+        if async_engine is not None:
+            metrics.instrument_engine(async_engine.sync_engine, "async")
+        timed("engines", started)
+
+        started = time.perf_counter()
+        # Catalog queries and DDL block, keep them off the event loop
+        await run_in_threadpool(prepare_schema, engine, settings.schema_mode)
+        timed("schema", started)
+
+        started = time.perf_counter()
+        admission.concurrency.start()
+        start_background_work()
+        timed("background", started)
+
+        app.state.startup_timings = timings
+        logger.info(
+            "Started in %.1f ms (%s, schema %s)",
+            sum(timings.values()) * 1000,
+            ", ".join(f"{phase} {seconds * 1000:.1f} ms" for phase, seconds in timings.items()),
+            settings.schema_mode,
+        )
+        try:
+            yield
+        finally:
+            stop_background_work()
+            await database.dispose_engines()
+
+    return lifespan
+
+
+# ---------------------------
+# App factory
+# ---------------------------
+
+def create_app(settings: Settings = config.settings) -> FastAPI:
+    """
+    Build the app without touching the database: engines, schema and
+    background threads are set up by the lifespan, when the server starts.
+    Also usable as `uvicorn main:create_app --factory`.
+    """
+    if settings.schema_mode not in SCHEMA_MODES:
+        raise ValueError(f"SCHEMA_MODE must be one of {', '.join(SCHEMA_MODES)}")
+
+    app = FastAPI(title="Chat Backend API", lifespan=make_lifespan(settings))
+    app.state.settings = settings
+
+    app.add_exception_handler(HasherBusy, hasher_busy)
+    app.add_exception_handler(Throttled, throttled)
+    app.add_exception_handler(WriterUnavailable, writer_unavailable)
+
+    # Innermost, only admitted requests get profiled
+    profiler.configure(settings)
+    if profiler.enabled:
+        app.add_middleware(ProfilerMiddleware)
+    # Rate limits and load shedding, before anything else runs
+    app.add_middleware(AdmissionMiddleware)
+    # Outermost, so shed requests are measured too
+    app.add_middleware(metrics.MetricsMiddleware, nplusone_threshold=settings.nplusone_threshold)
+
+    app.add_api_route("/metrics", prometheus_metrics, methods=["GET"], include_in_schema=False)
+
+    # Async mode: the async handlers replace their sync twins,
+    # endpoints that only exist in sync form keep working.
+    overrides = []
+    if settings.async_db:
+        from routers import aio
+        overrides = aio.routers
+
+    # Register routers. The sync leftovers go first so fixed paths like
+    # /users/presence are matched before an async /users/{user_id}.
+    app.include_router(without_routes_of(chats.router, overrides))
+    app.include_router(without_routes_of(messages.router, overrides))
+    app.include_router(without_routes_of(auth.router, overrides))
+    app.include_router(without_routes_of(users.router, overrides))
+    for router in overrides:
+        app.include_router(router)
+    app.include_router(ws.router)
+    app.include_router(admin.router)
+
+    return app
+
+
+app = create_app()
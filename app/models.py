@@ -7,6 +7,7 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     Text,
+    Index,
 )
 from sqlalchemy.orm import relationship
 from database import Base
@@ -22,6 +23,8 @@ class User(Base):
     is_online = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Bumped whenever GET /chats/user/{id} would return something different (ETag)
+    chat_list_version = Column(Integer, default=0, nullable=False)
 
     # Relationships
     chats = relationship(
@@ -42,6 +45,20 @@ class Chat(Base):
     is_group = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # Denormalized for the inbox, updated in the same transaction as message inserts
+    last_message_id = Column(Integer, nullable=True)
+    last_activity_at = Column(DateTime, default=datetime.utcnow)
+    message_count = Column(Integer, default=0, nullable=False)
+    # Bumped by message inserts/deletes and participant changes (ETag)
+    version = Column(Integer, default=0, nullable=False)
+    # +1 per message ever inserted, never decremented: consecutive message
+    # events of a chat carry consecutive values, so a missed one shows
+    message_seq = Column(Integer, default=0, server_default="0", nullable=False)
+    # Direct chats only: the two user ids, lowest first, so finding the chat
+    # of a pair is one probe of ux_chats_direct_pair. NULL for groups.
+    direct_user_low = Column(Integer, nullable=True)
+    direct_user_high = Column(Integer, nullable=True)
+
     # Relationships
     participants = relationship(
         "User",
@@ -50,6 +67,13 @@ class Chat(Base):
     )
     messages = relationship("Message", back_populates="chat")
 
+    # Inbox ordering, keyset on (last_activity_at, id)
+    __table_args__ = (
+        Index("ix_chats_last_activity_at_id", "last_activity_at", "id"),
+        # One direct chat per pair, NULLs never collide
+        Index("ux_chats_direct_pair", "direct_user_low", "direct_user_high", unique=True),
+    )
+
     def __repr__(self):
         return f"<Chat(id={self.id}, is_group={self.is_group})>"
 
@@ -60,6 +84,13 @@ class ChatParticipant(Base):
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"))
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    # Everything up to this message id counts as read for this participant
+    last_read_message_id = Column(Integer, nullable=True)
+
+    # "chats of a user" lookups (chat lists, unread counts) start from user_id
+    __table_args__ = (
+        Index("ix_chat_participants_user_id_chat_id", "user_id", "chat_id"),
+    )
 
     def __repr__(self):
         return f"<ChatParticipant(chat_id={self.chat_id}, user_id={self.user_id})>"
@@ -75,10 +106,21 @@ class Message(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     is_read = Column(Boolean, default=False)
 
+    # Not a column: the chat's message_seq right after this message was
+    # inserted, only known on messages this process just wrote
+    seq = None
+
     # Relationships
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="messages_sent")
 
+    # History is always read newest-first within one chat, keyset on (timestamp, id)
+    __table_args__ = (
+        Index("ix_messages_chat_id_timestamp_id", "chat_id", "timestamp", "id"),
+        # Unread counting: messages of a chat past a read watermark
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+    )
+
     def __repr__(self):
         return f"<Message(id={self.id}, sender_id={self.sender_id}, chat_id={self.chat_id})>"
 
@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Depends, Response, status
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+
+from dependencies import require_admin
+from utils.admission import admission
+from utils.profiler import profiler
+from utils.recent import recent
+
+router = APIRouter(prefix="/admin", tags=["Admin"], dependencies=[Depends(require_admin)])
+
+
+@router.get("/admission")
+def admission_stats(key: Optional[str] = None):
+    """
+    Limiter settings and counters of this worker. With ?key=user:<email> or
+    ?key=addr:<ip>, also the tokens currently left in that key's buckets.
+    """
+    return admission.stats(key)
+
+
+@router.get("/recent-messages")
+def recent_message_stats():
+    """
+    Size and hit rate of this worker's recent-message buffer.
+    """
+    return recent.stats()
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+def profile(route: Optional[str] = None):
+    """
+    Collapsed stacks of the profiled requests so far, one line per stack,
+    the route as root frame. Feed to flamegraph.pl or speedscope.
+    - route: only this route, e.g. "GET /messages/chat/{chat_id}"
+    """
+    return PlainTextResponse(profiler.collapsed(route))
+
+
+@router.get("/profile/stats")
+def profile_stats():
+    return profiler.stats()
+
+
+@router.delete("/profile", status_code=status.HTTP_204_NO_CONTENT)
+def reset_profile():
+    profiler.reset()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
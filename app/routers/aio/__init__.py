@@ -0,0 +1,4 @@
+# Async route handlers, mounted instead of their sync twins when ASYNC_DB is enabled
+from routers.aio import users, chats, messages, auth
+
+routers = [chats.router, messages.router, auth.router, users.router]
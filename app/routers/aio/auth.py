@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import Schemas, async_crud
+from database import get_async_db
+from dependencies import aget_principal
+from utils.hashing import hasher
+from utils.security import (
+    create_access_token,
+    create_refresh_token,
+    decode_token_cached,
+)
+
+router = APIRouter(prefix="/auth", tags=["Auth"])
+
+
+@router.post("/login", response_model=Schemas.Token)
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await async_crud.get_user_by_email(db, form_data.username)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    valid, new_hash = await hasher.averify_and_update(form_data.password, user.hashed_password)
+    if not valid:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    if new_hash:
+        await async_crud.set_password_hash(db, user.id, new_hash)
+
+    access_token = create_access_token(data={"sub": user.email})
+    refresh_token = create_refresh_token(data={"sub": user.email})
+
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+
+@router.post("/refresh", response_model=Schemas.Token)
+async def refresh_token(refresh_token: str, db: AsyncSession = Depends(get_async_db)):
+    payload = decode_token_cached(refresh_token)
+    if not payload or payload.get("scope") != "refresh_token":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+
+    username = payload.get("sub")
+    if not await aget_principal(db, username):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+
+    new_access_token = create_access_token(data={"sub": username})
+    new_refresh_token = create_refresh_token(data={"sub": username})
+
+    return {"access_token": new_access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
@@ -0,0 +1,121 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+from database import get_async_db
+from models import Chat, User
+from Schemas import ChatCreate, ChatResponse, CurrentUser
+from utils.membership import membership
+from dependencies import aget_current_user
+import async_crud
+import crud
+from utils import fast_json
+from utils.etag import make_etag, is_fresh, not_modified
+
+router = APIRouter(prefix="/chats", tags=["Chats"], dependencies=[Depends(aget_current_user)])
+
+
+@router.post("/", response_model=ChatResponse)
+async def create_chat(chat_data: ChatCreate, db: AsyncSession = Depends(get_async_db)):
+    """
+    Create a new chat (group or private).
+    - Accepts participant_ids (list of user IDs)
+    - Private chats of two users are get-or-create, see POST /chats/direct/{user_id}
+    """
+    if len(chat_data.participant_ids) < 2:
+        raise HTTPException(status_code=400, detail="At least 2 participants required")
+
+    result = await db.execute(select(User).filter(User.id.in_(chat_data.participant_ids)))
+    participants = list(result.scalars().all())
+    if len(participants) != len(chat_data.participant_ids):
+        raise HTTPException(status_code=404, detail="One or more users not found")
+    if not chat_data.is_group and len(participants) == 2:
+        # A 1:1 chat, the existing one if there is one
+        return await async_crud.get_or_create_direct_chat(db, *chat_data.participant_ids)
+
+    chat = Chat(is_group=chat_data.is_group)
+    chat.participants = participants
+    db.add(chat)
+    await db.flush()
+    await db.execute(crud.chat_list_version_bump(crud.members_of(chat.id)))
+    await db.commit()
+
+    return chat
+
+
+@router.post("/direct/{user_id}", response_model=ChatResponse)
+async def get_direct_chat(
+    user_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentUser = Depends(aget_current_user),
+):
+    """
+    The current user's direct chat with user_id, created on first use.
+    """
+    if user_id == current_user.id:
+        raise HTTPException(status_code=400, detail="Direct chats need two different users")
+    if not await db.scalar(select(User.id).filter(User.id == user_id)):
+        raise HTTPException(status_code=404, detail="User not found")
+    return await async_crud.get_or_create_direct_chat(db, current_user.id, user_id)
+
+
+@router.get("/user/{user_id}", response_model=List[ChatResponse])
+async def get_user_chats(
+    user_id: int,
+    request: Request,
+    response: Response,
+    fast: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentUser = Depends(aget_current_user),
+):
+    """
+    Fetch all chats a user is participating in, only for yourself.
+    """
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only your own chats are visible")
+    version = await db.scalar(select(User.chat_list_version).filter(User.id == user_id))
+    if version is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    etag = make_etag("chats", user_id, version, request)
+    if is_fresh(request, etag):
+        return not_modified(etag)
+
+    if fast:
+        return fast_json.FastJSONResponse(await db.run_sync(fast_json.user_chats, user_id), headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    return await async_crud.get_user_chats(db, user_id)
+
+
+@router.post("/{chat_id}/add_user/{user_id}", response_model=ChatResponse)
+async def add_user_to_chat(
+    chat_id: int,
+    user_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentUser = Depends(aget_current_user),
+):
+    """
+    Add a user to an existing group chat, only its participants can.
+    """
+    chat = await async_crud.get_chat_by_id(db, chat_id)
+    user = await async_crud.get_user_by_id(db, user_id)
+
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if not await membership.ais_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not in chat")
+    if chat.direct_user_low is not None:
+        raise HTTPException(status_code=409, detail="Direct chats can't gain participants")
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    if user in chat.participants:
+        raise HTTPException(status_code=400, detail="User already in chat")
+
+    chat.participants.append(user)
+    await db.flush()
+    for statement in crud.participants_changed(chat_id):
+        await db.execute(statement)
+    await db.commit()
+    membership.invalidate(chat_id)
+    return chat
@@ -0,0 +1,135 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import Optional
+from database import get_async_db
+from models import Chat, User
+from Schemas import MessageCreate, MessageResponse, MessagePage, MessageCatchUp, CurrentUser
+from utils.hub import hub, encode_message_event
+from utils.group_commit import writer
+from utils.membership import membership
+from utils.admission import admission
+from utils.archive import archive
+from utils.recent import recent
+from utils import fast_json
+from utils.etag import make_etag, is_fresh, not_modified
+from dependencies import aget_current_user
+from utils.pagination import decode_cursor, trim_page, build_message_page
+import async_crud
+
+router = APIRouter(prefix="/messages", tags=["Messages"], dependencies=[Depends(aget_current_user)])
+
+
+@router.post("/", response_model=MessageResponse)
+async def send_message(
+    message_data: MessageCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentUser = Depends(aget_current_user),
+):
+    """
+    Send a new message in a chat, as the current user.
+    """
+    if message_data.sender_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Messages can only be sent as yourself")
+    if not await membership.ais_member(db, message_data.chat_id, message_data.sender_id):
+        if not await db.get(Chat, message_data.chat_id):
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if not await db.get(User, message_data.sender_id):
+            raise HTTPException(status_code=404, detail="Sender not found")
+        raise HTTPException(status_code=403, detail="Sender not in chat")
+    admission.check_chat(message_data.chat_id)
+    sender = await db.get(User, message_data.sender_id)
+
+    if writer.enabled:
+        message = await writer.awrite(message_data)
+        set_committed_value(message, "sender", sender)
+        recent.add(message)
+    else:
+        # Also records it in the recent buffer
+        message = await async_crud.create_message(db, message_data, sender=sender)
+
+    hub.publish(message.chat_id, encode_message_event(message))
+    return message
+
+
+@router.get("/chat/{chat_id}", response_model=MessagePage)
+async def get_messages(
+    chat_id: int,
+    request: Request,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    senders: str = Query("embed", regex="^(embed|ids)$"),
+    fast: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentUser = Depends(aget_current_user),
+):
+    """
+    Get one page of messages in a chat, oldest first.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    try:
+        before_key, after_key = decode_cursor(before), decode_cursor(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # Revalidation only costs the version lookup, which doubles as the existence check
+    version = await db.scalar(select(Chat.version).filter(Chat.id == chat_id))
+    if version is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if not await membership.ais_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not in chat")
+    etag = make_etag("chat", chat_id, version, request)
+    if is_fresh(request, etag):
+        return not_modified(etag)
+
+    # senders=ids: no sender per message, each distinct sender once in `users`
+    embed = senders == "embed"
+
+    if fast:
+        page = await db.run_sync(fast_json.message_page, chat_id, before_key, after_key, limit, embed)
+        return fast_json.FastJSONResponse(page, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+    messages = await async_crud.get_messages_by_chat(
+        db, chat_id, before=before_key, after=after_key, limit=limit + 1, with_sender=embed
+    )
+    messages, has_more = trim_page(messages, limit, after_key)
+
+    users = None
+    if not embed:
+        # Deleted accounts leave messages without a sender
+        sender_ids = {m.sender_id for m in messages if m.sender_id is not None}
+        users = await async_crud.get_users_by_ids(db, sender_ids) if sender_ids else []
+    return build_message_page(messages, has_more, after_key, users)
+
+
+@router.get("/chat/{chat_id}/since", response_model=MessageCatchUp)
+async def catch_up(
+    chat_id: int,
+    since_id: int = Query(..., ge=0),
+    limit: int = Query(100, ge=1, le=500),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentUser = Depends(aget_current_user),
+):
+    """
+    Messages with an id above since_id, oldest first, from memory when possible.
+    """
+    if not await membership.ais_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not in chat")
+    messages = recent.since(chat_id, since_id, limit + 1)
+    if messages is None:
+        seq = await db.scalar(select(Chat.message_seq).filter(Chat.id == chat_id))
+        if seq is None:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        boundary = archive.boundary(chat_id)
+        if boundary is not None and since_id < boundary[1]:
+            raise HTTPException(status_code=410, detail="Too far behind, reload the history")
+        epoch = recent.epoch
+        messages = await async_crud.get_messages_since(db, chat_id, since_id, limit + 1)
+        if len(messages) <= limit:
+            recent.fill(chat_id, since_id, messages, seq, epoch)
+    return MessageCatchUp(items=messages[:limit], has_more=len(messages) > limit)
@@ -0,0 +1,90 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+import Schemas, async_crud
+from dependencies import aget_current_user
+from database import get_async_db
+from utils.hashing import hasher
+from utils import fast_json
+
+router = APIRouter(
+    prefix="/users",
+    tags=["Users"],
+)
+
+
+@router.post("/", response_model=Schemas.UserResponse, status_code=status.HTTP_201_CREATED)
+async def create_user(user: Schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user_by_email(db, email=user.email)
+    if db_user:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered",
+        )
+
+    # Hashing is CPU bound, it runs on its own pool off the event loop
+    hashed_pw = await hasher.ahash(user.password)
+    return await async_crud.create_user(db=db, user=user, hashed_password=hashed_pw)
+
+
+@router.get("/", response_model=Schemas.UserPage, dependencies=[Depends(aget_current_user)])
+async def get_users(
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    fast: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+):
+    if fast:
+        return fast_json.FastJSONResponse(await db.run_sync(fast_json.user_page, after, limit))
+    users = await async_crud.get_users_page(db, after=after, limit=limit + 1)
+    next_after = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_after = users[-1].id
+    return Schemas.UserPage(items=users, next_after=next_after)
+
+
+@router.get("/search", response_model=List[Schemas.UserHandle], dependencies=[Depends(aget_current_user)])
+async def search_users(
+    prefix: str = Query(..., min_length=1, max_length=50),
+    limit: int = Query(10, ge=1, le=50),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await async_crud.search_usernames(db, prefix, limit)
+
+
+@router.get("/{user_id}", response_model=Schemas.UserResponse, dependencies=[Depends(aget_current_user)])
+async def get_user(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user_by_id(db, user_id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+
+@router.put("/{user_id}", response_model=Schemas.UserResponse)
+async def update_user(
+    user_id: int,
+    user_update: Schemas.UserUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Schemas.CurrentUser = Depends(aget_current_user),
+):
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only your own account can be changed")
+    updated_user = await async_crud.update_user(db, user_id, user_update)
+    if not updated_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return updated_user
+
+
+@router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_user(
+    user_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Schemas.CurrentUser = Depends(aget_current_user),
+):
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only your own account can be deleted")
+    deleted = await async_crud.delete_user(db, user_id)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"message": "User deleted successfully"}
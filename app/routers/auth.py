@@ -1,29 +1,38 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import timedelta
 
 import models, Schemas, crud
 from database import get_db
 from utils.security import (
-    verify_password,
     create_access_token,
     create_refresh_token,
-    decode_token,
-    ACCESS_TOKEN_EXPIRE_MINUTES,
+    decode_token_cached,
+    token_cache,
+    principal_cache,
 )
+from dependencies import get_current_user, get_principal
+from utils.hashing import hasher
 
 router = APIRouter(prefix="/auth", tags=["Auth"])
 
 
 @router.post("/login", response_model=Schemas.Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    # async so that waiting for the hashing pool holds no threadpool thread,
+    # the database calls go to the threadpool instead
+    user = await run_in_threadpool(crud.get_user_by_email, db, form_data.username)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    valid, new_hash = await hasher.averify_and_update(form_data.password, user.hashed_password)
+    if not valid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    if new_hash:
+        # Stored hash used a deprecated scheme (bcrypt), upgrade it now that we know the password
+        await run_in_threadpool(crud.set_password_hash, db, user.id, new_hash)
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": user.email}, expires_delta=access_token_expires)
+    access_token = create_access_token(data={"sub": user.email})
     refresh_token = create_refresh_token(data={"sub": user.email})
 
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
@@ -31,13 +40,12 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
 
 @router.post("/refresh", response_model=Schemas.Token)
 def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
-    payload = decode_token(refresh_token)
+    payload = decode_token_cached(refresh_token)
     if not payload or payload.get("scope") != "refresh_token":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
 
     username = payload.get("sub")
-    user = crud.get_user_by_email(db, username)
-    if not user:
+    if not get_principal(db, username):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
     new_access_token = create_access_token(data={"sub": username})
@@ -45,3 +53,10 @@ def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
 
     return {"access_token": new_access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
 
+
+@router.get("/cache/stats", dependencies=[Depends(get_current_user)])
+def cache_stats():
+    """
+    Hit/miss counters of the verified-token and principal caches, hashing pool usage.
+    """
+    return {"tokens": token_cache.stats(), "principals": principal_cache.stats(), "hasher": hasher.stats()}
@@ -1,12 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from database import get_db
-from models import Chat, User
-from Schemas import ChatCreate, ChatResponse
+from models import Chat, ChatParticipant, User
+from Schemas import ChatCreate, ChatResponse, CurrentUser, ReadWatermark, UnreadCount, InboxEntry, InboxPage, MessagePreview
+from utils.pagination import encode_cursor, decode_cursor
+from utils import fast_json
+from utils.etag import make_etag, is_fresh, not_modified
+from utils.membership import membership
+from dependencies import get_current_user
 import crud
 
-router = APIRouter(prefix="/chats", tags=["Chats"])
+router = APIRouter(prefix="/chats", tags=["Chats"], dependencies=[Depends(get_current_user)])
 
 
 @router.post("/", response_model=ChatResponse)
@@ -14,6 +19,7 @@ def create_chat(chat_data: ChatCreate, db: Session = Depends(get_db)):
     """
     Create a new chat (group or private).
     - Accepts participant_ids (list of user IDs)
+    - Private chats of two users are get-or-create, see POST /chats/direct/{user_id}
     """
     if len(chat_data.participant_ids) < 2:
         raise HTTPException(status_code=400, detail="At least 2 participants required")
@@ -21,38 +27,173 @@ def create_chat(chat_data: ChatCreate, db: Session = Depends(get_db)):
     participants = db.query(User).filter(User.id.in_(chat_data.participant_ids)).all()
     if len(participants) != len(chat_data.participant_ids):
         raise HTTPException(status_code=404, detail="One or more users not found")
+    if not chat_data.is_group and len(participants) == 2:
+        # A 1:1 chat, the existing one if there is one
+        return crud.get_or_create_direct_chat(db, *chat_data.participant_ids)
 
     chat = Chat(is_group=chat_data.is_group)
     chat.participants = participants
     db.add(chat)
+    db.flush()
+    db.execute(crud.chat_list_version_bump(crud.members_of(chat.id)))
     db.commit()
     db.refresh(chat)
 
     return chat
 
 
+@router.post("/direct/{user_id}", response_model=ChatResponse)
+def get_direct_chat(
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    The current user's direct chat with user_id, created on first use.
+    """
+    if user_id == current_user.id:
+        raise HTTPException(status_code=400, detail="Direct chats need two different users")
+    if not db.query(User.id).filter(User.id == user_id).first():
+        raise HTTPException(status_code=404, detail="User not found")
+    return crud.get_or_create_direct_chat(db, current_user.id, user_id)
+
+
 @router.get("/user/{user_id}", response_model=List[ChatResponse])
-def get_user_chats(user_id: int, db: Session = Depends(get_db)):
+def get_user_chats(
+    user_id: int,
+    request: Request,
+    response: Response,
+    fast: bool = False,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
     """
-    Fetch all chats a user is participating in.
+    Fetch all chats a user is participating in, only for yourself.
+    - fast: plain rows encoded directly, same JSON
+    - If-None-Match: 304 when the chat list hasn't changed
     """
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only your own chats are visible")
+    version = db.query(User.chat_list_version).filter(User.id == user_id).scalar()
+    if version is None:
         raise HTTPException(status_code=404, detail="User not found")
+    etag = make_etag("chats", user_id, version, request)
+    if is_fresh(request, etag):
+        return not_modified(etag)
+
+    if fast:
+        return fast_json.FastJSONResponse(fast_json.user_chats(db, user_id), headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    # user.chats would lazy-load participants once per chat
+    return crud.get_user_chats(db, user_id)
+
+
+@router.get("/inbox", response_model=InboxPage)
+def get_inbox(
+    request: Request,
+    before: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    The current user's chats, most recently active first, with last message previews.
+    """
+    try:
+        before_key = decode_cursor(before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    rows = crud.get_inbox(
+        db, current_user.id, before=before_key, limit=limit + 1,
+        preview_length=request.app.state.settings.inbox_preview_length,
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].last_activity_at, rows[-1].id)
+
+    items = [
+        InboxEntry(
+            id=row.id,
+            is_group=row.is_group,
+            created_at=row.created_at,
+            last_activity_at=row.last_activity_at,
+            message_count=row.message_count,
+            last_message=MessagePreview(
+                id=row.message_id,
+                sender_id=row.sender_id,
+                content=row.content,
+                timestamp=row.timestamp,
+            ) if row.message_id is not None else None,
+        )
+        for row in rows
+    ]
+    return InboxPage(items=items, next_cursor=next_cursor)
+
+
+@router.get("/user/{user_id}/unread", response_model=List[UnreadCount])
+def get_unread_counts(
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Unread message count of every chat the user is in, only for yourself.
+    """
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only your own unread counts are visible")
+    return [UnreadCount(chat_id=chat_id, unread=unread) for chat_id, unread in crud.get_unread_counts(db, user_id)]
+
+
+@router.post("/{chat_id}/read/{message_id}", response_model=ReadWatermark)
+def mark_chat_read(
+    chat_id: int,
+    message_id: int,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Mark everything up to message_id as read for the current user.
+    """
+    if not membership.is_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not in chat")
+
+    if crud.mark_chat_read(db, chat_id, current_user.id, message_id):
+        return ReadWatermark(chat_id=chat_id, last_read_message_id=message_id)
 
-    return user.chats
+    # Already read past it, or not a message of this chat
+    last_read = (
+        db.query(ChatParticipant.last_read_message_id)
+        .filter(ChatParticipant.chat_id == chat_id, ChatParticipant.user_id == current_user.id)
+        .scalar()
+    )
+    if last_read is None:
+        raise HTTPException(status_code=404, detail="Message not found in chat")
+    return ReadWatermark(chat_id=chat_id, last_read_message_id=last_read)
 
 
 @router.post("/{chat_id}/add_user/{user_id}", response_model=ChatResponse)
-def add_user_to_chat(chat_id: int, user_id: int, db: Session = Depends(get_db)):
+def add_user_to_chat(
+    chat_id: int,
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
     """
-    Add a user to an existing chat.
+    Add a user to an existing group chat, only its participants can.
     """
     chat = db.query(Chat).filter(Chat.id == chat_id).first()
     user = db.query(User).filter(User.id == user_id).first()
 
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
+    if not membership.is_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not in chat")
+    if chat.direct_user_low is not None:
+        # Its pair key would still find it as the direct chat of the first two
+        raise HTTPException(status_code=409, detail="Direct chats can't gain participants")
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -60,6 +201,10 @@ def add_user_to_chat(chat_id: int, user_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="User already in chat")
 
     chat.participants.append(user)
+    db.flush()
+    for statement in crud.participants_changed(chat_id):
+        db.execute(statement)
     db.commit()
+    membership.invalidate(chat_id)
     db.refresh(chat)
     return chat
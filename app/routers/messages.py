@@ -1,47 +1,231 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from collections import Counter
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import List, Optional
 from database import get_db
 from models import Message, Chat, User
-from Schemas import MessageCreate, MessageResponse
+from Schemas import MessageCreate, MessageResponse, MessagePage, MessageCatchUp, MessageCreated, MessageSearchPage, CurrentUser
+from utils.hub import hub, encode_message_event
+from utils.group_commit import writer
+from utils.membership import membership
+from utils.admission import admission
+from utils.archive import archive
+from utils.recent import recent
+from utils import fast_json
+from utils.etag import make_etag, is_fresh, not_modified
+from utils.search import search_message_ids
+from dependencies import get_current_user
+from utils.pagination import decode_cursor, trim_page, build_message_page
+import crud
 
-router = APIRouter(prefix="/messages", tags=["Messages"])
+router = APIRouter(prefix="/messages", tags=["Messages"], dependencies=[Depends(get_current_user)])
 
 
 @router.post("/", response_model=MessageResponse)
-def send_message(message_data: MessageCreate, db: Session = Depends(get_db)):
+def send_message(
+    message_data: MessageCreate,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
     """
-    Send a new message in a chat.
+    Send a new message in a chat, as the current user.
     """
-    chat = db.query(Chat).filter(Chat.id == message_data.chat_id).first()
-    sender = db.query(User).filter(User.id == message_data.sender_id).first()
-
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    if not sender:
-        raise HTTPException(status_code=404, detail="Sender not found")
-    if sender not in chat.participants:
+    if message_data.sender_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Messages can only be sent as yourself")
+    if not membership.is_member(db, message_data.chat_id, message_data.sender_id):
+        # Membership implies both rows exist, only a refusal needs to say which is missing
+        if not db.query(Chat.id).filter(Chat.id == message_data.chat_id).first():
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if not db.query(User.id).filter(User.id == message_data.sender_id).first():
+            raise HTTPException(status_code=404, detail="Sender not found")
         raise HTTPException(status_code=403, detail="Sender not in chat")
+    admission.check_chat(message_data.chat_id)
 
-    message = Message(
-        chat_id=message_data.chat_id,
-        sender_id=message_data.sender_id,
-        content=message_data.content,
-    )
+    if writer.enabled:
+        # Returns once the batch holding this message has committed, 503 past the writer's timeout
+        message = writer.write(message_data)
+        set_committed_value(message, "sender", db.get(User, message_data.sender_id))
+    else:
+        message = Message(
+            chat_id=message_data.chat_id,
+            sender_id=message_data.sender_id,
+            content=message_data.content,
+            timestamp=datetime.utcnow(),
+        )
+
+        crud.record_message(db, message)
+        db.commit()
+        db.refresh(message)
 
-    db.add(message)
-    db.commit()
-    db.refresh(message)
+    recent.add(message)
+    # Push to anyone connected on /ws/chats/{chat_id}
+    hub.publish(message.chat_id, encode_message_event(message))
     return message
 
 
-@router.get("/chat/{chat_id}", response_model=List[MessageResponse])
-def get_messages(chat_id: int, db: Session = Depends(get_db)):
+@router.post("/batch", response_model=List[MessageCreated])
+def send_messages(
+    messages_data: List[MessageCreate],
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Send many messages, possibly across chats, in one transaction, all as the current user.
+    All or nothing: any unknown chat/sender or non-member rejects the batch.
+    """
+    if not messages_data:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    max_batch = request.app.state.settings.max_message_batch
+    if len(messages_data) > max_batch:
+        raise HTTPException(status_code=413, detail=f"At most {max_batch} messages per batch")
+    if any(m.sender_id != current_user.id for m in messages_data):
+        raise HTTPException(status_code=403, detail="Messages can only be sent as yourself")
+
+    pairs = {(m.chat_id, m.sender_id) for m in messages_data}
+    missing = pairs - crud.get_memberships(db, pairs)
+    if missing:
+        # Slow path, only to report the right error
+        chat_ids = {chat_id for chat_id, _ in missing}
+        sender_ids = {sender_id for _, sender_id in missing}
+        found_chats = {row.id for row in db.query(Chat.id).filter(Chat.id.in_(chat_ids))}
+        found_senders = {row.id for row in db.query(User.id).filter(User.id.in_(sender_ids))}
+        if chat_ids - found_chats:
+            raise HTTPException(status_code=404, detail=f"Chats not found: {sorted(chat_ids - found_chats)}")
+        if sender_ids - found_senders:
+            raise HTTPException(status_code=404, detail=f"Senders not found: {sorted(sender_ids - found_senders)}")
+        raise HTTPException(status_code=403, detail=f"Senders not in chat: {sorted(missing)}")
+    for chat_id, count in Counter(m.chat_id for m in messages_data).items():
+        admission.check_chat(chat_id, count)
+
+    messages = crud.create_messages(db, messages_data)
+
+    # crud.create_messages already filled the recent buffer
+    for message in messages:
+        hub.publish(message.chat_id, encode_message_event(message))
+    return messages
+
+
+@router.get("/writer/stats")
+def writer_stats():
+    """
+    Batch size and wait time statistics of the group-commit writer.
+    """
+    return {"enabled": writer.enabled, **writer.stats()}
+
+
+@router.get("/search", response_model=MessageSearchPage)
+def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    chat_id: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
     """
-    Get all messages in a chat.
+    Full-text search over the messages of the current user's chats, ranked.
     """
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    if not chat:
+    hits = search_message_ids(db, q, current_user.id, chat_id=chat_id, limit=limit + 1, offset=offset)
+    next_offset = offset + limit if len(hits) > limit else None
+    ids = [message_id for message_id, _ in hits[:limit]]
+
+    by_id = {
+        message.id: message
+        for message in db.query(Message).options(joinedload(Message.sender)).filter(Message.id.in_(ids))
+    }
+    return MessageSearchPage(items=[by_id[i] for i in ids if i in by_id], next_offset=next_offset)
+
+
+@router.get("/chat/{chat_id}", response_model=MessagePage)
+def get_messages(
+    chat_id: int,
+    request: Request,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    senders: str = Query("embed", regex="^(embed|ids)$"),
+    fast: bool = False,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Get one page of messages in a chat, oldest first, participants only.
+    - No cursor: the latest page
+    - before: the page preceding that cursor
+    - after: messages newer than that cursor (polling)
+    - If-None-Match: 304 when nothing in the chat changed
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    try:
+        before_key, after_key = decode_cursor(before), decode_cursor(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # Revalidation only costs the version lookup, which doubles as the existence check
+    version = db.query(Chat.version).filter(Chat.id == chat_id).scalar()
+    if version is None:
         raise HTTPException(status_code=404, detail="Chat not found")
+    if not membership.is_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not in chat")
+    etag = make_etag("chat", chat_id, version, request)
+    if is_fresh(request, etag):
+        return not_modified(etag)
+
+    # senders=ids: no sender per message, each distinct sender once in `users`
+    embed = senders == "embed"
 
-    return chat.messages
+    if fast:
+        page = fast_json.message_page(db, chat_id, before_key, after_key, limit, embed)
+        return fast_json.FastJSONResponse(page, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+    messages = crud.get_messages_by_chat(
+        db, chat_id, before=before_key, after=after_key, limit=limit + 1, with_sender=embed
+    )
+    messages, has_more = trim_page(messages, limit, after_key)
+
+    users = None
+    if not embed:
+        # Deleted accounts leave messages without a sender
+        sender_ids = {m.sender_id for m in messages if m.sender_id is not None}
+        users = crud.get_users_by_ids(db, sender_ids) if sender_ids else []
+    return build_message_page(messages, has_more, after_key, users)
+
+
+@router.get("/chat/{chat_id}/since", response_model=MessageCatchUp)
+def catch_up(
+    chat_id: int,
+    since_id: int = Query(..., ge=0),
+    limit: int = Query(100, ge=1, le=500),
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user),
+):
+    """
+    Messages with an id above since_id, oldest first, for clients resuming
+    after a disconnect. Answered from memory when the gap fits in the chat's
+    recent-message buffer, from the database otherwise.
+    - 410 when the gap reaches into archived history, reload the history instead
+    """
+    # Cached, and an unknown chat has no members either
+    if not membership.is_member(db, chat_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not in chat")
+    messages = recent.since(chat_id, since_id, limit + 1)
+    if messages is None:
+        # Read before the messages: they hold at least every message up to this seq
+        seq = db.query(Chat.message_seq).filter(Chat.id == chat_id).scalar()
+        if seq is None:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        boundary = archive.boundary(chat_id)
+        if boundary is not None and since_id < boundary[1]:
+            raise HTTPException(status_code=410, detail="Too far behind, reload the history")
+        epoch = recent.epoch
+        messages = crud.get_messages_since(db, chat_id, since_id, limit + 1)
+        if len(messages) <= limit:
+            # Everything after since_id, the next reconnect is served from memory
+            recent.fill(chat_id, since_id, messages, seq, epoch)
+    return MessageCatchUp(items=messages[:limit], has_more=len(messages) > limit)
@@ -1,25 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.orm import Session
-from typing import List
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
 import models, Schemas, crud
+from dependencies import get_current_user
 from database import get_db
-from passlib.context import CryptContext
+from utils.hashing import hasher
+from utils.presence import presence
+from utils import fast_json
 router = APIRouter(
     prefix="/users",
     tags=["Users"],
 )
 
 
-# Password hashing context
-pwd_context = CryptContext(
-    schemes=["argon2", "bcrypt"],  # Preference for argon2, fallback to bcrypt
-    deprecated="auto"
-)
-
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
-
-
 # ---------------------------
 # Create new user
 # ---------------------------
@@ -27,9 +21,10 @@ def get_password_hash(password: str) -> str:
 
 
 @router.post("/", response_model=Schemas.UserResponse, status_code=status.HTTP_201_CREATED)
-def create_user(user: Schemas.UserCreate, db: Session = Depends(get_db)):
-    # Check existing user by email
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def create_user(user: Schemas.UserCreate, db: Session = Depends(get_db)):
+    # async so that waiting for the hashing pool holds no threadpool thread,
+    # the database calls go to the threadpool instead
+    db_user = await run_in_threadpool(crud.get_user_by_email, db, email=user.email)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -37,27 +32,75 @@ def create_user(user: Schemas.UserCreate, db: Session = Depends(get_db)):
         )
 
     # Hash the incoming plain password
-    hashed_pw = get_password_hash(user.password)
+    hashed_pw = await hasher.ahash(user.password)
 
     # Pass the hashed password into crud.create_user
-    new_user = crud.create_user(db=db, user=user, hashed_password=hashed_pw)
+    new_user = await run_in_threadpool(crud.create_user, db=db, user=user, hashed_password=hashed_pw)
 
     return new_user
 
 
 # ---------------------------
-# Get all users
+# List users
+# ---------------------------
+@router.get("/", response_model=Schemas.UserPage, dependencies=[Depends(get_current_user)])
+def get_users(
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    fast: bool = False,
+    db: Session = Depends(get_db),
+):
+    """
+    Users by id, one page at a time: pass next_after as ?after= for the next page.
+    """
+    if fast:
+        # Plain rows straight to JSON, no ORM objects or response validation
+        return fast_json.FastJSONResponse(fast_json.user_page(db, after, limit))
+    users = crud.get_users_page(db, after=after, limit=limit + 1)
+    next_after = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_after = users[-1].id
+    return Schemas.UserPage(items=users, next_after=next_after)
+
+
+# ---------------------------
+# Username autocomplete
+# ---------------------------
+@router.get("/search", response_model=List[Schemas.UserHandle], dependencies=[Depends(get_current_user)])
+def search_users(
+    prefix: str = Query(..., min_length=1, max_length=50),
+    limit: int = Query(10, ge=1, le=50),
+    db: Session = Depends(get_db),
+):
+    """
+    Users whose username starts with prefix (case sensitive), alphabetically.
+    """
+    return crud.search_usernames(db, prefix, limit)
+
+
 # ---------------------------
-@router.get("/", response_model=List[Schemas.UserResponse])
-def get_users(db: Session = Depends(get_db)):
-    users = crud.get_all_users(db)
-    return users
+# Presence
+# ---------------------------
+@router.post("/me/heartbeat", status_code=status.HTTP_204_NO_CONTENT)
+def heartbeat(current_user: Schemas.CurrentUser = Depends(get_current_user)):
+    # Memory only, the flusher persists is_online changes in bulk
+    presence.heartbeat(current_user.id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.get("/presence", response_model=List[Schemas.PresenceResponse], dependencies=[Depends(get_current_user)])
+def get_presence(ids: List[int] = Query(..., max_items=500)):
+    return [
+        Schemas.PresenceResponse(user_id=user_id, **state)
+        for user_id, state in presence.lookup(ids).items()
+    ]
 
 
 # ---------------------------
 # Get user by ID
 # ---------------------------
-@router.get("/{user_id}", response_model=Schemas.UserResponse)
+@router.get("/{user_id}", response_model=Schemas.UserResponse, dependencies=[Depends(get_current_user)])
 def get_user(user_id: int, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_id(db, user_id)
     if not db_user:
@@ -69,7 +112,14 @@ def get_user(user_id: int, db: Session = Depends(get_db)):
 # Update user
 # ---------------------------
 @router.put("/{user_id}", response_model=Schemas.UserResponse)
-def update_user(user_id: int, user_update: Schemas.UserUpdate, db: Session = Depends(get_db)):
+def update_user(
+    user_id: int,
+    user_update: Schemas.UserUpdate,
+    db: Session = Depends(get_db),
+    current_user: Schemas.CurrentUser = Depends(get_current_user),
+):
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only your own account can be changed")
     updated_user = crud.update_user(db, user_id, user_update)
     if not updated_user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -80,7 +130,13 @@ def update_user(user_id: int, user_update: Schemas.UserUpdate, db: Session = Dep
 # Delete user
 # ---------------------------
 @router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_user(user_id: int, db: Session = Depends(get_db)):
+def delete_user(
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user: Schemas.CurrentUser = Depends(get_current_user),
+):
+    if user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only your own account can be deleted")
     deleted = crud.delete_user(db, user_id)
     if not deleted:
         raise HTTPException(status_code=404, detail="User not found")
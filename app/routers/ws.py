@@ -0,0 +1,68 @@
+import asyncio
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, status
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from database import get_db
+from utils.hub import hub
+from utils.membership import membership
+from utils.presence import presence
+from dependencies import principal_from_token
+
+router = APIRouter(tags=["Realtime"])
+
+
+def authorize(db: Session, token: str, chat_id: int):
+    """
+    The principal behind the token when they are in the chat, None otherwise.
+    Can query the database, call it from the threadpool.
+    """
+    try:
+        principal = principal_from_token(db, token)
+        if principal is None or not membership.is_member(db, chat_id, principal.id):
+            return None
+        return principal
+    finally:
+        db.close()
+
+
+@router.websocket("/ws/chats/{chat_id}")
+async def chat_events(websocket: WebSocket, chat_id: int, token: str, db: Session = Depends(get_db)):
+    """
+    Push new messages of a chat to a connected participant.
+    Browsers can't set headers on WebSockets, the access token comes as ?token=
+    """
+    # Token and membership lookups are blocking, keep them off the event loop
+    principal = await run_in_threadpool(authorize, db, token, chat_id)
+    if principal is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    sub = hub.subscribe(chat_id, principal.id)
+    presence.connect(principal.id)
+
+    async def pump():
+        while True:
+            payload = await sub.queue.get()
+            if payload is None:
+                # Dropped for being too slow, client should reconnect.
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            await websocket.send_text(payload)
+
+    async def drain():
+        # Clients don't send anything yet, reading just detects the disconnect.
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+    tasks = [asyncio.create_task(pump()), asyncio.create_task(drain())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(sub)
+        presence.disconnect(principal.id)
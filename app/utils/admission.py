@@ -0,0 +1,310 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+from config import (
+    ADMISSION_ENABLED,
+    ADMISSION_TABLE_SIZE,
+    RATE_LIMITS,
+    MAX_CONCURRENCY,
+    MAX_QUEUE_WAIT_MS,
+)
+from utils.security import decode_token_cached
+
+
+class Throttled(Exception):
+    """
+    Raised by handlers when a limit keyed on something only the handler
+    knows (the chat of a message) is exhausted. Answered with a 429.
+    """
+
+    def __init__(self, retry_after: float, limit: str):
+        super().__init__(limit)
+        self.retry_after = retry_after
+        self.limit = limit
+
+
+class TokenBuckets:
+    """
+    One token bucket per key, refilled at `rate` tokens/s up to `burst`.
+
+    A bucket is two numbers, refilled lazily when it is touched, so a check
+    is a dict lookup and a little arithmetic. Buckets are kept in LRU order
+    and the least recently used one is dropped past `maxsize`; a dropped
+    bucket comes back full, which only ever errs on the side of admitting.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = ADMISSION_TABLE_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.throttled = 0
+
+    def take(self, key: Hashable, cost: float = 1) -> float:
+        """
+        Spend `cost` tokens. Returns 0 when admitted, otherwise the seconds
+        until enough tokens will be there (nothing is spent then). A cost
+        above `burst` is never admitted.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0.0
+            self.throttled += 1
+            return (cost - bucket[0]) / self.rate
+
+    def wait(self, key: Hashable, cost: float = 1) -> float:
+        """
+        What take() would return, without spending anything. A non-zero
+        wait is counted as throttled.
+        """
+        tokens = self.peek(key)
+        if tokens is None or tokens >= cost:
+            return 0.0
+        with self._lock:
+            self.throttled += 1
+        return (cost - tokens) / self.rate
+
+    def peek(self, key: Hashable) -> Optional[float]:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                return None
+            return min(self.burst, bucket[0] + (time.monotonic() - bucket[1]) * self.rate)
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "keys": len(self._buckets),
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+        }
+
+
+# Route classes, checked in order: (method, path, class), a path ending
+# in * matches as a prefix. Unauthenticated classes are keyed by client
+# address instead of user.
+ROUTE_CLASSES = [
+    ("POST", "/auth/*", "auth"),
+    ("POST", "/users/", "auth"),  # sign-up, also hashes a password
+    ("POST", "/messages/", "send"),
+    ("POST", "/messages/batch", "send"),
+    ("GET", "/messages/search*", "search"),
+    ("GET", "/users/search*", "search"),
+    ("GET", "/*", "read"),
+]
+DEFAULT_CLASS = "write"
+
+
+def route_class(method: str, path: str) -> str:
+    for route_method, pattern, name in ROUTE_CLASSES:
+        if method != route_method:
+            continue
+        if path == pattern or (pattern.endswith("*") and path.startswith(pattern[:-1])):
+            return name
+    return DEFAULT_CLASS
+
+
+class ConcurrencyLimiter:
+    """
+    At most `limit` requests in flight. Requests beyond that wait, and are
+    shed once they have waited `max_wait` seconds: a queue that grows
+    faster than it drains only adds latency to everything behind it.
+
+    The semaphore belongs to the event loop of the app using it, start()
+    creates it from the lifespan, or the first acquire() when an app runs
+    without one.
+    """
+
+    def __init__(self, limit: int = MAX_CONCURRENCY, max_wait: float = MAX_QUEUE_WAIT_MS / 1000):
+        self.limit = limit
+        self.max_wait = max_wait
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed = 0
+
+    def start(self):
+        if self.limit > 0:
+            self._slots = asyncio.Semaphore(self.limit)
+
+    async def acquire(self) -> bool:
+        if self.limit <= 0:
+            self.in_flight += 1
+            return True
+        if self._slots is None:
+            self.start()
+        if self._slots.locked():
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        if self.limit > 0:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "max_wait_ms": self.max_wait * 1000,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "shed": self.shed,
+        }
+
+
+class AdmissionController:
+    """
+    The limiters of this worker. Every request passes the user's overall
+    bucket and its route class bucket, then the concurrency limiter; sends
+    also pass the chat's bucket, checked by the handler once it knows the chat.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = RATE_LIMITS, enabled: bool = ADMISSION_ENABLED):
+        self.enabled = enabled
+        self.buckets = {name: TokenBuckets(rate, burst) for name, (rate, burst) in limits.items() if rate > 0}
+        self.concurrency = ConcurrencyLimiter()
+
+    def configure(self, settings):
+        """
+        Fresh buckets and limiter sized from `settings`.
+        """
+        self.enabled = settings.admission_enabled
+        self.buckets = {
+            name: TokenBuckets(rate, burst, settings.admission_table_size)
+            for name, (rate, burst) in settings.rate_limits().items() if rate > 0
+        }
+        self.concurrency = ConcurrencyLimiter(settings.max_concurrency, settings.max_queue_wait_ms / 1000)
+
+    def _take(self, limit: str, key: Hashable, cost: float = 1) -> float:
+        buckets = self.buckets.get(limit)
+        return buckets.take(key, cost) if buckets is not None else 0.0
+
+    @staticmethod
+    def client_key(scope) -> str:
+        """
+        The token subject when the request carries a valid bearer token,
+        the client address otherwise. No database access.
+        """
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer":
+                    payload = decode_token_cached(token.strip())
+                    if payload and payload.get("sub"):
+                        return "user:" + payload["sub"]
+                break
+        client = scope.get("client")
+        return "addr:" + (client[0] if client else "unknown")
+
+    def check_request(self, scope) -> Tuple[float, str]:
+        """
+        (retry_after, limit) for the rate limits of one request, retry_after 0 when admitted.
+        """
+        key = self.client_key(scope)
+        klass = route_class(scope["method"], scope["path"])
+        limits = [(limit, self.buckets[limit]) for limit in ("user", klass) if limit in self.buckets]
+        # Check every bucket before taking from any, a refused request
+        # costs nothing. Nothing awaits in between, the loop runs this alone.
+        for limit, buckets in limits:
+            retry_after = buckets.wait(key)
+            if retry_after:
+                return retry_after, limit
+        for limit, buckets in limits:
+            buckets.take(key)
+        return 0.0, ""
+
+    def check_chat(self, chat_id: int, cost: int = 1):
+        """
+        Raise Throttled when the chat's message rate is exhausted, or when
+        `cost` messages at once are more than its burst ever allows.
+        """
+        if not self.enabled:
+            return
+        buckets = self.buckets.get("chat")
+        if buckets is not None and cost > buckets.burst:
+            raise Throttled(cost / buckets.rate, f"chat, at most {buckets.burst:g} messages at once")
+        retry_after = self._take("chat", chat_id, cost)
+        if retry_after:
+            raise Throttled(retry_after, "chat")
+
+    def stats(self, key: Optional[str] = None) -> dict:
+        limiters = {}
+        for name, buckets in self.buckets.items():
+            limiters[name] = buckets.stats()
+            if key is not None:
+                limiters[name]["tokens"] = buckets.peek(key)
+        return {"enabled": self.enabled, "limiters": limiters, "concurrency": self.concurrency.stats()}
+
+
+admission = AdmissionController()
+
+
+def rejection(status_code: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class AdmissionMiddleware:
+    """
+    Plain ASGI middleware, so a rejected request costs no routing or body
+    parsing. WebSocket connections are not limited here.
+    """
+
+    def __init__(self, app, controller: AdmissionController = admission):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.controller.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        retry_after, limit = self.controller.check_request(scope)
+        if retry_after:
+            response = rejection(429, f"Rate limit exceeded ({limit})", retry_after)
+            await response(scope, receive, send)
+            return
+
+        concurrency = self.controller.concurrency
+        if not await concurrency.acquire():
+            response = rejection(503, "Server busy, retry shortly", 1)
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            concurrency.release()
@@ -0,0 +1,402 @@
+import bisect
+import errno
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import and_, delete, exists, func, or_, select
+
+from config import ARCHIVE_DIR, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL, ARCHIVE_BLOCK_MESSAGES
+from models import Chat, ChatParticipant, Message
+from utils.pagination import MessageCursor
+
+logger = logging.getLogger(__name__)
+
+
+# Cold history lives outside the messages table, one pair of files per chat:
+#   chat_<id>.seg  append-only zlib-compressed blocks of messages, in (timestamp, id) order
+#   chat_<id>.idx  one fixed-size record per block: first/last key, offset, length, count
+#
+# Everything archived sorts before everything still in the table, the last
+# archived key is the chat's boundary. Files are appended and fsynced before
+# the rows are deleted, so a crash in between leaves rows at or below the
+# boundary in the table: readers ignore them and the next run deletes them.
+
+INDEX_RECORD = struct.Struct("<qqqqQII")
+EPOCH = datetime(1970, 1, 1)
+
+
+class ArchivedMessage(NamedTuple):
+    # Same fields and order as a plain column select of a message
+    id: int
+    chat_id: int
+    sender_id: int
+    content: str
+    timestamp: datetime
+    is_read: bool
+
+
+class IndexEntry(NamedTuple):
+    first: MessageCursor
+    last: MessageCursor
+    offset: int
+    length: int
+    count: int
+
+
+def _micros(timestamp: datetime) -> int:
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(micros: int) -> datetime:
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def _after(cursor: MessageCursor):
+    timestamp, message_id = cursor
+    return or_(Message.timestamp > timestamp, and_(Message.timestamp == timestamp, Message.id > message_id))
+
+
+def _before(cursor: MessageCursor):
+    timestamp, message_id = cursor
+    return or_(Message.timestamp < timestamp, and_(Message.timestamp == timestamp, Message.id < message_id))
+
+
+def _unread_by_participant():
+    """
+    A participant of the message's chat past whose read watermark it is,
+    the same rule as crud.get_unread_counts.
+    """
+    return and_(
+        ChatParticipant.chat_id == Message.chat_id,
+        Message.id > func.coalesce(ChatParticipant.last_read_message_id, 0),
+        Message.sender_id != ChatParticipant.user_id,
+    )
+
+
+class _Segment:
+    def __init__(self, index_size: int, entries: List[IndexEntry], data):
+        self.index_size = index_size
+        self.entries = entries
+        self.first_keys = [entry.first for entry in entries]
+        self.last_keys = [entry.last for entry in entries]
+        self.data = data  # mmap of the .seg file
+
+
+class MessageArchive:
+    """
+    Reads and writes the per-chat segment files.
+
+    Reading mmaps the segment and only decompresses the blocks a page
+    touches, found by bisecting the sparse index. The index is reloaded when
+    its file size changes, so readers in other processes pick up new blocks.
+    """
+
+    def __init__(
+        self,
+        directory: str = ARCHIVE_DIR,
+        block_messages: int = ARCHIVE_BLOCK_MESSAGES,
+        after_days: float = ARCHIVE_AFTER_DAYS,
+        interval: float = ARCHIVE_INTERVAL,
+    ):
+        self.directory = directory
+        self.block_messages = block_messages
+        # Messages older than this are moved by start()'s thread, 0 never archives
+        self.after_days = after_days
+        self.interval = interval
+        self._segments: Dict[int, _Segment] = {}
+        # With archiving off, whether segments from earlier runs exist; None until looked
+        self._has_segments: Optional[bool] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def configure(self, settings):
+        """
+        Only while stopped.
+        """
+        with self._lock:
+            self.directory = settings.archive_dir
+            self.block_messages = settings.archive_block_messages
+            self.after_days = settings.archive_after_days
+            self.interval = settings.archive_interval
+            self._segments.clear()
+            self._has_segments = None
+
+    def _path(self, chat_id: int, suffix: str) -> str:
+        return os.path.join(self.directory, f"chat_{chat_id}.{suffix}")
+
+    # ---------------------------
+    # Reading
+    # ---------------------------
+
+    def _open(self, chat_id: int) -> Optional[_Segment]:
+        try:
+            index_size = os.stat(self._path(chat_id, "idx")).st_size
+        except FileNotFoundError:
+            with self._lock:
+                self._segments.pop(chat_id, None)
+            return None
+
+        with self._lock:
+            segment = self._segments.get(chat_id)
+            if segment is not None and segment.index_size == index_size:
+                return segment
+
+        with open(self._path(chat_id, "idx"), "rb") as f:
+            raw = f.read(index_size - index_size % INDEX_RECORD.size)
+        entries = [
+            IndexEntry((_from_micros(first_ts), first_id), (_from_micros(last_ts), last_id), offset, length, count)
+            for first_ts, first_id, last_ts, last_id, offset, length, count in INDEX_RECORD.iter_unpack(raw)
+        ]
+        if not entries:
+            return None
+        with open(self._path(chat_id, "seg"), "rb") as f:
+            # Replaced, not closed: a reader may still hold the previous map
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        segment = _Segment(index_size, entries, data)
+        with self._lock:
+            self._segments[chat_id] = segment
+        return segment
+
+    def boundary(self, chat_id: int) -> Optional[MessageCursor]:
+        """
+        Key of the newest archived message of the chat, None if nothing is archived.
+        """
+        if self.after_days <= 0 and not self._any_segments():
+            # Archiving off and never was here, history reads skip the stat
+            return None
+        segment = self._open(chat_id)
+        return segment.last_keys[-1] if segment else None
+
+    def _any_segments(self) -> bool:
+        if self._has_segments is None:
+            try:
+                names = os.listdir(self.directory)
+            except FileNotFoundError:
+                names = []
+            self._has_segments = any(name.endswith(".idx") for name in names)
+        return self._has_segments
+
+    def _block(self, segment: _Segment, entry: IndexEntry, chat_id: int) -> List[ArchivedMessage]:
+        rows = json.loads(zlib.decompress(segment.data[entry.offset:entry.offset + entry.length]))
+        return [
+            ArchivedMessage(message_id, chat_id, sender_id, content, _from_micros(timestamp), bool(is_read))
+            for message_id, sender_id, content, timestamp, is_read in rows
+        ]
+
+    def read(
+        self,
+        chat_id: int,
+        before: Optional[MessageCursor] = None,
+        after: Optional[MessageCursor] = None,
+        limit: Optional[int] = None,
+    ) -> List[ArchivedMessage]:
+        """
+        Archived messages in chronological order, same semantics as
+        crud.keyset_page: the newest `limit` older than `before` (or the
+        newest overall), or the oldest `limit` newer than `after`.
+        """
+        segment = self._open(chat_id)
+        if segment is None:
+            return []
+
+        if after is not None:
+            messages = []
+            for entry in segment.entries[bisect.bisect_right(segment.last_keys, after):]:
+                messages.extend(m for m in self._block(segment, entry, chat_id) if (m.timestamp, m.id) > after)
+                if limit is not None and len(messages) >= limit:
+                    return messages[:limit]
+            return messages
+
+        end = len(segment.entries) if before is None else bisect.bisect_left(segment.first_keys, before)
+        blocks, found = [], 0
+        for entry in reversed(segment.entries[:end]):
+            block = self._block(segment, entry, chat_id)
+            if before is not None:
+                block = [m for m in block if (m.timestamp, m.id) < before]
+            blocks.append(block)
+            found += len(block)
+            if limit is not None and found >= limit:
+                break
+        messages = [m for block in reversed(blocks) for m in block]
+        if limit is not None and len(messages) > limit:
+            messages = messages[len(messages) - limit:]
+        return messages
+
+    def drop(self, chat_id: int):
+        """
+        Remove a deleted chat's archive.
+        """
+        for suffix in ("idx", "seg"):
+            try:
+                os.remove(self._path(chat_id, suffix))
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._segments.pop(chat_id, None)
+
+    # ---------------------------
+    # Archiving
+    # ---------------------------
+
+    def _append(self, chat_id: int, rows: list):
+        """
+        Write rows (chronological) as new blocks, segment first, index last.
+        """
+        records = []
+        with open(self._path(chat_id, "seg"), "ab") as seg:
+            offset = seg.seek(0, os.SEEK_END)
+            for start in range(0, len(rows), self.block_messages):
+                block = rows[start:start + self.block_messages]
+                payload = zlib.compress(
+                    json.dumps(
+                        [[m.id, m.sender_id, m.content, _micros(m.timestamp), bool(m.is_read)] for m in block],
+                        separators=(",", ":"),
+                    ).encode()
+                )
+                seg.write(payload)
+                first, last = block[0], block[-1]
+                records.append(INDEX_RECORD.pack(
+                    _micros(first.timestamp), first.id, _micros(last.timestamp), last.id,
+                    offset, len(payload), len(block),
+                ))
+                offset += len(payload)
+            seg.flush()
+            os.fsync(seg.fileno())
+
+        with open(self._path(chat_id, "idx"), "ab") as idx:
+            # Drop a torn record left by a crash, readers ignore it anyway
+            idx.truncate(idx.seek(0, os.SEEK_END) // INDEX_RECORD.size * INDEX_RECORD.size)
+            idx.write(b"".join(records))
+            idx.flush()
+            os.fsync(idx.fileno())
+        self._has_segments = True
+
+    def archive_chat(self, db, chat_id: int, older_than: datetime) -> int:
+        """
+        Move one batch of the chat's messages older than `older_than` to its
+        segment. The chat's last message always stays in the table (inbox
+        previews join it), and so does everything from the first message a
+        participant hasn't read yet: unread counts and read watermarks only
+        see the table. Returns how many messages were archived.
+        """
+        query = (
+            select(Message.id, Message.sender_id, Message.content, Message.timestamp, Message.is_read)
+            .where(Message.chat_id == chat_id, Message.timestamp < older_than)
+        )
+        last = db.execute(
+            select(Message.timestamp, Message.id)
+            .join(Chat, Chat.last_message_id == Message.id)
+            .where(Chat.id == chat_id)
+        ).first()
+        if last is not None:
+            query = query.where(_before(tuple(last)))
+        first_unread = db.execute(
+            select(Message.timestamp, Message.id)
+            .where(Message.chat_id == chat_id, exists().where(_unread_by_participant()))
+            .order_by(Message.timestamp, Message.id)
+            .limit(1)
+        ).first()
+        if first_unread is not None:
+            query = query.where(_before(tuple(first_unread)))
+        boundary = self.boundary(chat_id)
+        if boundary is not None:
+            query = query.where(_after(boundary))
+
+        rows = db.execute(
+            query.order_by(Message.timestamp, Message.id).limit(self.block_messages * 16)
+        ).all()
+        if rows:
+            self._append(chat_id, rows)
+            boundary = (rows[-1].timestamp, rows[-1].id)
+        if boundary is not None:
+            # Also clears rows a crashed run archived without deleting
+            db.execute(
+                delete(Message)
+                .where(Message.chat_id == chat_id, ~_after(boundary))
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+        return len(rows)
+
+    @contextmanager
+    def _exclusive(self):
+        """
+        One archiver at a time across worker processes, others skip their run.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def run(self, db, older_than: datetime) -> int:
+        """
+        Archive every chat's messages older than `older_than`.
+        """
+        archived = 0
+        with self._exclusive() as acquired:
+            if not acquired:
+                return 0
+            has_old_messages = exists().where(Message.chat_id == Chat.id, Message.timestamp < older_than)
+            chat_ids = db.scalars(
+                select(Chat.id).where(Chat.created_at < older_than, has_old_messages).order_by(Chat.id)
+            ).all()
+            for chat_id in chat_ids:
+                while True:
+                    moved = self.archive_chat(db, chat_id, older_than)
+                    archived += moved
+                    if moved < self.block_messages * 16:
+                        break
+        return archived
+
+    def start(self, session_factory):
+        if self._thread is not None or self.after_days <= 0:
+            return
+        after_days, interval = self.after_days, self.interval
+        self._stop.clear()
+
+        def run():
+            while True:
+                db = session_factory()
+                try:
+                    moved = self.run(db, datetime.utcnow() - timedelta(days=after_days))
+                    if moved:
+                        logger.info("Archived %d messages", moved)
+                except Exception:
+                    logger.exception("Archiving failed, will retry")
+                    db.rollback()
+                finally:
+                    db.close()
+                if self._stop.wait(interval):
+                    return
+
+        self._thread = threading.Thread(target=run, name="message-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+archive = MessageArchive()
@@ -0,0 +1,433 @@
+import abc
+import fcntl
+import fnmatch
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+from typing import Callable, Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+from config import BROKER_URL, BROKER_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+# Chat events travel through a broker so every worker process sees every
+# committed message. The hub publishes once per message; each worker's
+# broker hands incoming events back to its own hub, which only fans out to
+# the sockets connected to that worker.
+#
+#   BROKER_URL=local                      single process, no I/O (default)
+#   BROKER_URL=unix:///tmp/chat.sock      workers on one host, one of them runs the relay
+#   BROKER_URL=redis://:password@host:6379  several hosts, Redis pub/sub
+#
+# Delivery is at-most-once like Redis pub/sub: events published while a
+# worker is reconnecting are lost for that worker, clients re-sync over HTTP.
+
+CHANNEL_PREFIX = "chat:"
+
+Deliver = Callable[[int, str], None]
+Reset = Callable[[], None]
+
+
+class Broker(abc.ABC):
+    @abc.abstractmethod
+    def start(self, deliver: Deliver, reset: Optional[Reset] = None):
+        """
+        Begin receiving events, deliver(chat_id, payload) is called for each
+        and reset() whenever some may have been missed (a reconnect).
+        """
+
+    @abc.abstractmethod
+    def publish(self, chat_id: int, payload: str):
+        """
+        Send an event to every worker, this one included. Never blocks.
+        """
+
+    def stop(self):
+        pass
+
+
+class LocalBroker(Broker):
+    """
+    Single process: publishing is delivering.
+    """
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    def start(self, deliver: Deliver, reset: Optional[Reset] = None):
+        self._deliver = deliver
+
+    def publish(self, chat_id: int, payload: str):
+        if self._deliver is not None:
+            self._deliver(chat_id, payload)
+
+
+# ---------------------------
+# Redis protocol (RESP)
+# ---------------------------
+
+class RespError(Exception):
+    pass
+
+
+def encode_command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def read_reply(stream):
+    """
+    One reply from a buffered binary stream. Errors come back as RespError
+    instances rather than being raised, a pipeline reads past them.
+    """
+    line = stream.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("Connection closed")
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        return None if length < 0 else [read_reply(stream) for _ in range(length)]
+    raise ConnectionError(f"Unexpected reply {line!r}")
+
+
+class RedisBroker(Broker):
+    """
+    Pub/sub over the Redis protocol, one channel per chat.
+
+    Two connections: the subscriber thread holds a PSUBSCRIBE on every chat
+    channel, the publisher thread drains a bounded queue and pipelines the
+    PUBLISH commands, so publish() returns immediately even from async code.
+    """
+
+    def __init__(self, address, password: Optional[str] = None, queue_size: int = BROKER_QUEUE_SIZE):
+        self.address = address  # (host, port) or a Unix socket path
+        self.password = password
+        self._outbox: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._deliver: Optional[Deliver] = None
+        self._reset: Optional[Reset] = None
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._subscriber: Optional[socket.socket] = None
+        self.dropped = 0
+
+    def _connect(self) -> socket.socket:
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.address)
+        else:
+            sock = socket.create_connection(self.address, timeout=5)
+            sock.settimeout(None)
+        if self.password:
+            sock.sendall(encode_command("AUTH", self.password))
+            reply = read_reply(sock.makefile("rb"))
+            if isinstance(reply, RespError):
+                sock.close()
+                raise reply
+        return sock
+
+    def start(self, deliver: Deliver, reset: Optional[Reset] = None):
+        if self._threads:
+            return
+        self._deliver = deliver
+        self._reset = reset
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._subscribe_loop, name="broker-subscriber", daemon=True),
+            threading.Thread(target=self._publish_loop, name="broker-publisher", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def publish(self, chat_id: int, payload: str):
+        try:
+            self._outbox.put_nowait((chat_id, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def _retry(self, backoff: float) -> float:
+        self._stop.wait(backoff)
+        return min(backoff * 2, 5.0)
+
+    def _subscribe_loop(self):
+        backoff = 0.1
+        while not self._stop.is_set():
+            try:
+                self._subscriber = sock = self._connect()
+                sock.sendall(encode_command("PSUBSCRIBE", CHANNEL_PREFIX + "*"))
+                stream = sock.makefile("rb")
+                backoff = 0.1
+                while True:
+                    reply = read_reply(stream)
+                    # Subscribe confirmations are also pushed, only pmessage carries events
+                    if isinstance(reply, list) and len(reply) == 4 and reply[0] == b"pmessage":
+                        chat_id = int(reply[2][len(CHANNEL_PREFIX):])
+                        self._deliver(chat_id, reply[3].decode())
+                    elif isinstance(reply, list) and reply and reply[0] == b"psubscribe":
+                        # (Re)subscribed, whatever was published while we weren't is lost
+                        if self._reset is not None:
+                            self._reset()
+            except (OSError, ConnectionError, RespError, ValueError) as exc:
+                if self._subscriber is not None:
+                    self._subscriber.close()
+                    self._subscriber = None
+                if self._stop.is_set():
+                    return
+                logger.warning("Broker subscriber disconnected (%s), reconnecting", exc)
+                backoff = self._retry(backoff)
+
+    def _publish_loop(self):
+        sock = stream = None
+        backoff = 0.1
+        while not self._stop.is_set():
+            try:
+                batch = [self._outbox.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(batch) < 256:
+                try:
+                    batch.append(self._outbox.get_nowait())
+                except queue.Empty:
+                    break
+            commands = b"".join(
+                encode_command("PUBLISH", f"{CHANNEL_PREFIX}{chat_id}", payload) for chat_id, payload in batch
+            )
+            # An idle connection may have died unnoticed, one fresh retry before dropping
+            for attempt in range(2):
+                try:
+                    if sock is None:
+                        sock = self._connect()
+                        stream = sock.makefile("rb")
+                    sock.sendall(commands)
+                    for _ in batch:
+                        read_reply(stream)
+                    backoff = 0.1
+                    break
+                except (OSError, ConnectionError, RespError) as exc:
+                    if sock is not None:
+                        sock.close()
+                    sock = stream = None
+                    if attempt:
+                        self.dropped += len(batch)
+                        logger.warning("Broker publish failed (%s), dropped %d events", exc, len(batch))
+                        backoff = self._retry(backoff)
+        if sock is not None:
+            sock.close()
+
+    def stop(self):
+        if not self._threads:
+            return
+        self._stop.set()
+        if self._subscriber is not None:
+            # Unblocks the subscriber's pending read
+            try:
+                self._subscriber.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in self._threads:
+            thread.join(5)
+        self._threads = []
+
+
+# ---------------------------
+# Unix socket relay
+# ---------------------------
+
+class RelayServer:
+    """
+    Minimal pub/sub server speaking the subset of RESP the broker uses
+    (PING, PUBLISH, SUBSCRIBE, PSUBSCRIBE), so it can stand in for Redis
+    locally. Whoever holds the lock file runs it, when that process dies
+    the lock is released and the next worker to reconnect takes over.
+    """
+
+    def __init__(self, path: str, send_timeout: float = 5.0):
+        self.path = path
+        self.send_timeout = send_timeout
+        self._lock_file = None
+        self._listener: Optional[socket.socket] = None
+        self._channels: Dict[socket.socket, Set[bytes]] = {}
+        self._patterns: Dict[socket.socket, Set[bytes]] = {}
+        self._send_locks: Dict[socket.socket, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._listener is not None
+
+    def try_start(self) -> bool:
+        """
+        Become the relay if nobody else is. Returns whether this process runs it.
+        """
+        if self.running:
+            return True
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Holding the lock means any socket file left there is stale
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(128)
+        self._lock_file, self._listener = lock_file, listener
+        threading.Thread(target=self._accept_loop, name="broker-relay", daemon=True).start()
+        logger.info("Running the broker relay on %s", self.path)
+        return True
+
+    def _accept_loop(self):
+        listener = self._listener
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            # Reads may idle forever, sends to a stuck subscriber give up
+            seconds = int(self.send_timeout)
+            conn.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                struct.pack("ll", seconds, int((self.send_timeout - seconds) * 1e6)),
+            )
+            with self._lock:
+                self._send_locks[conn] = threading.Lock()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _send(self, conn: socket.socket, data: bytes) -> bool:
+        lock = self._send_locks.get(conn)
+        if lock is None:
+            return False
+        try:
+            with lock:
+                conn.sendall(data)
+            return True
+        except OSError:
+            # Too slow or gone, it will reconnect
+            self._drop(conn)
+            return False
+
+    def _drop(self, conn: socket.socket):
+        with self._lock:
+            self._channels.pop(conn, None)
+            self._patterns.pop(conn, None)
+            self._send_locks.pop(conn, None)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+    def _publish(self, channel: bytes, data: bytes) -> int:
+        with self._lock:
+            targets = [
+                (conn, encode_command("message", channel, data))
+                for conn, channels in self._channels.items() if channel in channels
+            ] + [
+                (conn, encode_command("pmessage", pattern, channel, data))
+                for conn, patterns in self._patterns.items()
+                for pattern in patterns if fnmatch.fnmatchcase(channel.decode(), pattern.decode())
+            ]
+        return sum(self._send(conn, message) for conn, message in targets)
+
+    def _serve(self, conn: socket.socket):
+        stream = conn.makefile("rb")
+        try:
+            while True:
+                command = read_reply(stream)
+                if not isinstance(command, list) or not command:
+                    self._send(conn, b"-ERR protocol error\r\n")
+                    continue
+                name, args = command[0].upper(), command[1:]
+                if name == b"PUBLISH" and len(args) == 2:
+                    self._send(conn, b":%d\r\n" % self._publish(args[0], args[1]))
+                elif name in (b"SUBSCRIBE", b"PSUBSCRIBE") and args:
+                    registry = self._channels if name == b"SUBSCRIBE" else self._patterns
+                    with self._lock:
+                        subscribed = registry.setdefault(conn, set())
+                        subscribed.update(args)
+                        count = len(subscribed)
+                    for arg in args:
+                        self._send(conn, encode_command(name.lower().decode(), arg, count))
+                elif name == b"PING":
+                    self._send(conn, b"+PONG\r\n")
+                else:
+                    self._send(conn, b"-ERR unknown command\r\n")
+        except (OSError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._drop(conn)
+
+    def stop(self):
+        if self._listener is None:
+            return
+        self._listener.close()
+        self._listener = None
+        with self._lock:
+            conns = list(self._send_locks)
+        for conn in conns:
+            self._drop(conn)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._lock_file.close()
+        self._lock_file = None
+
+
+class RelayBroker(RedisBroker):
+    """
+    RedisBroker over a Unix socket served by one of the workers.
+    """
+
+    def __init__(self, path: str, queue_size: int = BROKER_QUEUE_SIZE):
+        super().__init__(path, queue_size=queue_size)
+        self.relay = RelayServer(path)
+
+    def _connect(self) -> socket.socket:
+        self.relay.try_start()
+        return super()._connect()
+
+    def stop(self):
+        super().stop()
+        self.relay.stop()
+
+
+def make_broker(url: str = BROKER_URL, queue_size: int = BROKER_QUEUE_SIZE) -> Broker:
+    parsed = urlparse(url or "local")
+    if parsed.scheme == "unix":
+        return RelayBroker(parsed.path, queue_size=queue_size)
+    if parsed.scheme == "redis":
+        return RedisBroker(
+            (parsed.hostname or "localhost", parsed.port or 6379), password=parsed.password, queue_size=queue_size
+        )
+    if url in ("", "local"):
+        return LocalBroker()
+    raise ValueError(f"Unsupported BROKER_URL {url!r}")
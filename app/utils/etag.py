@@ -0,0 +1,35 @@
+import hashlib
+
+from fastapi import Request, Response
+
+
+# ETags are built from a version counter kept in the database (chats.version,
+# users.chat_list_version), so answering a revalidation costs one primary key
+# lookup, no matter which worker served the original response.
+#
+# They are weak: presence (is_online) and updated_at of embedded users are not
+# versioned, a 304 may hold slightly older values for those fields.
+
+
+def make_etag(kind: str, key: int, version: int, request: Request) -> str:
+    """
+    The query string (cursor, limit, senders, fast...) picks a different
+    representation of the same resource, so it is part of the tag.
+    """
+    params = hashlib.sha1(str(sorted(request.query_params.multi_items())).encode()).hexdigest()[:12]
+    return f'W/"{kind}-{key}-v{version}-{params}"'
+
+
+def is_fresh(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison, W/ prefixes don't matter
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
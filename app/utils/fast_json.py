@@ -0,0 +1,133 @@
+import json
+from collections import defaultdict
+from operator import itemgetter
+from typing import List, Optional
+
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+
+import crud
+from models import Chat, ChatParticipant, Message, User
+from utils.pagination import MessageCursor, trim_page, page_cursors
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to the stdlib encoder
+    orjson = None
+
+
+# Opt-in fast path (?fast=true) for big list responses: rows are selected as
+# plain columns instead of ORM objects, shaped into the same JSON the
+# response models produce, and encoded directly. What the database returns
+# is trusted, so nothing is validated again on the way out.
+
+USER_COLUMNS = (User.id, User.username, User.email, User.is_online, User.created_at, User.updated_at)
+MESSAGE_COLUMNS = (Message.id, Message.chat_id, Message.sender_id, Message.content, Message.timestamp, Message.is_read)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content)
+        return json.dumps(content, default=lambda value: value.isoformat(), separators=(",", ":")).encode()
+
+
+def _user(row) -> dict:
+    return {
+        "id": row.id,
+        "username": row.username,
+        "email": row.email,
+        "is_online": bool(row.is_online),
+        "created_at": row.created_at,
+        "updated_at": row.updated_at,
+    }
+
+
+def users_by_id(db: Session, user_ids) -> dict:
+    if not user_ids:
+        return {}
+    rows = db.query(*USER_COLUMNS).filter(User.id.in_(set(user_ids)))
+    return {row.id: _user(row) for row in rows}
+
+
+def user_page(db: Session, after: Optional[int], limit: int) -> dict:
+    """
+    Same shape as UserPage.
+    """
+    query = db.query(*USER_COLUMNS)
+    if after is not None:
+        query = query.filter(User.id > after)
+    items = [_user(row) for row in query.order_by(User.id).limit(limit + 1)]
+    next_after = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_after = items[-1]["id"]
+    return {"items": items, "next_after": next_after}
+
+
+def user_chats(db: Session, user_id: int) -> List[dict]:
+    """
+    Same shape as List[ChatResponse]: two queries, chats then all their participants.
+    """
+    chats = (
+        db.query(Chat.id, Chat.is_group, Chat.created_at)
+        .join(ChatParticipant, ChatParticipant.chat_id == Chat.id)
+        .filter(ChatParticipant.user_id == user_id)
+        .all()
+    )
+    if not chats:
+        return []
+
+    participants = defaultdict(list)
+    rows = (
+        db.query(ChatParticipant.chat_id, *USER_COLUMNS)
+        .join(User, User.id == ChatParticipant.user_id)
+        .filter(ChatParticipant.chat_id.in_([chat.id for chat in chats]))
+    )
+    for row in rows:
+        participants[row.chat_id].append(_user(row))
+
+    return [
+        {"is_group": bool(chat.is_group), "id": chat.id, "created_at": chat.created_at, "participants": participants[chat.id]}
+        for chat in chats
+    ]
+
+
+def message_page(
+    db: Session,
+    chat_id: int,
+    before: Optional[MessageCursor],
+    after: Optional[MessageCursor],
+    limit: int,
+    embed: bool,
+) -> dict:
+    """
+    Same shape as MessagePage. Senders are fetched once per distinct user,
+    embedded mode reuses the same dict for every message of a sender.
+    """
+    rows = crud.read_through_page(
+        db.query(*MESSAGE_COLUMNS).filter(Message.chat_id == chat_id), chat_id, before, after, limit + 1
+    )
+    rows, has_more = trim_page(rows, limit, after)
+    older_cursor, newer_cursor = page_cursors(rows, has_more, after, key=itemgetter(4, 0))
+
+    senders = users_by_id(db, {row.sender_id for row in rows if row.sender_id is not None})
+    items = [
+        {
+            "content": row.content,
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "sender_id": row.sender_id,
+            "timestamp": row.timestamp,
+            "is_read": bool(row.is_read),
+            "sender": senders.get(row.sender_id) if embed else None,
+        }
+        for row in rows
+    ]
+    return {
+        "items": items,
+        "users": None if embed else list(senders.values()),
+        "has_more": has_more,
+        "older_cursor": older_cursor,
+        "newer_cursor": newer_cursor,
+    }
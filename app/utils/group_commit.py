@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import List
+
+import crud
+from database import SessionLocal
+from config import GROUP_COMMIT_ENABLED, GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_WAIT_MS, GROUP_COMMIT_TIMEOUT_MS
+from Schemas import MessageCreate
+
+logger = logging.getLogger(__name__)
+
+
+class WriterUnavailable(Exception):
+    """
+    Raised when a message's batch didn't commit within the writer's timeout.
+    """
+
+
+class GroupCommitWriter:
+    """
+    Funnels concurrent message inserts through one writer thread that commits
+    them in micro-batches: one transaction per batch instead of per message.
+
+    A batch is flushed when it reaches max_batch messages or when its first
+    message has waited max_wait_ms, whichever comes first. Callers get a Future
+    that resolves to the inserted Message once its batch has committed.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        max_batch: int = GROUP_COMMIT_MAX_BATCH,
+        max_wait_ms: float = GROUP_COMMIT_MAX_WAIT_MS,
+        enabled: bool = GROUP_COMMIT_ENABLED,
+        timeout_ms: float = GROUP_COMMIT_TIMEOUT_MS,
+    ):
+        self.session_factory = session_factory
+        # Whether POST /messages/ goes through the writer
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout_ms / 1000
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def configure(self, settings):
+        """
+        Only while stopped, the writer thread reads these.
+        """
+        self.enabled = settings.group_commit_enabled
+        self.max_batch = settings.group_commit_max_batch
+        self.max_wait = settings.group_commit_max_wait_ms / 1000
+        self.timeout = settings.group_commit_timeout_ms / 1000
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._messages = 0
+        self._failed_batches = 0
+        self._max_batch_seen = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._commit_total = 0.0
+
+    def submit(self, message: MessageCreate) -> Future:
+        self._ensure_started()
+        future: Future = Future()
+        self._queue.put((message, future, time.perf_counter()))
+        return future
+
+    def write(self, message: MessageCreate):
+        """
+        Submit and wait for the commit, at most `timeout` seconds.
+        """
+        future = self.submit(message)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            self._give_up(future)
+
+    async def awrite(self, message: MessageCreate):
+        """
+        write() for async code, waits without holding a thread.
+        """
+        future = self.submit(message)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._give_up(future)
+
+    def _give_up(self, future: Future):
+        # Still queued: dropped, never written. Already in a committing
+        # batch: it may still land, clients see it on their next catch-up.
+        future.cancel()
+        raise WriterUnavailable()
+
+    def _ensure_started(self):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    logger.error("Group-commit writer thread died, restarting it")
+                self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Flush what is queued and stop the writer thread.
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+            stopping = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch: List[tuple]):
+        # Callers that gave up cancelled theirs, the rest can't be cancelled from here on
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.perf_counter()
+        db = None
+        try:
+            db = self.session_factory()
+            messages = crud.create_messages(db, [message for message, _, _ in batch])
+        except Exception as exc:
+            db.rollback()
+            with self._stats_lock:
+                self._failed_batches += 1
+            for _, future, _ in batch:
+                future.set_exception(exc)
+            return
+        finally:
+            if db is not None:
+                db.close()
+
+        done = time.perf_counter()
+        with self._stats_lock:
+            self._batches += 1
+            self._messages += len(batch)
+            self._max_batch_seen = max(self._max_batch_seen, len(batch))
+            self._commit_total += done - started
+            for _, _, submitted in batch:
+                self._wait_total += done - submitted
+                self._wait_max = max(self._wait_max, done - submitted)
+
+        for (_, future, _), message in zip(batch, messages):
+            future.set_result(message)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            batches = self._batches or 1
+            messages = self._messages or 1
+            return {
+                "running": self._thread is not None and self._thread.is_alive(),
+                "queued": self._queue.qsize(),
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000,
+                "batches": self._batches,
+                "failed_batches": self._failed_batches,
+                "messages": self._messages,
+                "avg_batch_size": self._messages / batches,
+                "max_batch_size": self._max_batch_seen,
+                "avg_wait_ms": self._wait_total / messages * 1000,
+                "max_wait_ms_seen": self._wait_max * 1000,
+                "avg_commit_ms": self._commit_total / batches * 1000,
+            }
+
+
+writer = GroupCommitWriter(SessionLocal)
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+from config import HASH_WORKERS, HASH_QUEUE_SIZE
+
+
+# The one password context of the app. argon2 for new hashes, bcrypt is
+# still verified but deprecated, so those hashes get upgraded on login.
+pwd_context = CryptContext(schemes=["argon2", "bcrypt"], deprecated="auto")
+
+
+class HasherBusy(Exception):
+    """
+    Raised instead of queueing when the hashing pool is saturated.
+    """
+
+
+class PasswordHasher:
+    """
+    Runs hashing and verification on a dedicated, bounded pool so a login
+    burst can't take the threads every other route runs on.
+
+    Threads are enough here: argon2 and bcrypt release the GIL while hashing.
+    At most `workers` hashes run at once and `queue_size` more may wait,
+    anything beyond that fails fast with HasherBusy.
+    """
+
+    def __init__(self, workers: int = HASH_WORKERS, queue_size: int = HASH_QUEUE_SIZE):
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.rejected = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._resize(workers, queue_size)
+
+    def _resize(self, workers: int, queue_size: int):
+        old = self._executor
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        if old is not None:
+            # Hashes already queued there still finish
+            old.shutdown(wait=False)
+
+    def configure(self, settings):
+        if (settings.hash_workers, settings.hash_queue_size) != (self.workers, self.queue_size):
+            self._resize(settings.hash_workers, settings.hash_queue_size)
+
+    def _submit(self, fn, *args) -> Future:
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy()
+        with self._lock:
+            self._pending += 1
+        future = self._executor.submit(fn, *args)
+        # Released into the semaphore it was taken from, even after a resize
+        future.add_done_callback(lambda _future: self._release(slots))
+        return future
+
+    def _release(self, slots: threading.BoundedSemaphore):
+        with self._lock:
+            self._pending -= 1
+        slots.release()
+
+    def hash(self, password: str) -> str:
+        return self._submit(pwd_context.hash, password).result()
+
+    async def ahash(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(pwd_context.hash, password))
+
+    def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """
+        Returns (valid, new_hash). new_hash is set when the stored hash uses a
+        deprecated scheme or parameters and should be replaced.
+        """
+        return self._submit(pwd_context.verify_and_update, password, hashed).result()
+
+    async def averify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        return await asyncio.wrap_future(self._submit(pwd_context.verify_and_update, password, hashed))
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self._pending,
+            "rejected": self.rejected,
+        }
+
+
+hasher = PasswordHasher()
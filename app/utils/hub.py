@@ -0,0 +1,131 @@
+import json
+import asyncio
+from typing import Dict, Optional, Set
+
+from config import WS_QUEUE_SIZE
+from utils.broker import Broker, make_broker
+from utils.recent import recent
+
+
+class Subscription:
+    """
+    A single WebSocket connection listening to one chat.
+    Holds a bounded queue so a slow client can never block the sender.
+    """
+
+    def __init__(self, chat_id: int, user_id: int, maxsize: int):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def offer(self, payload: str):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # Client can't keep up: drop what is buffered and tell the
+            # connection to close so the client reconnects and re-syncs.
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class ChatHub:
+    """
+    Fan-out of chat events to the WebSocket clients connected to this worker.
+
+    Subscriptions live on the event loop thread. publish() can be called
+    from any thread (sync routes run in the threadpool), it hands the event
+    to the broker, which delivers it back to the hub of every worker.
+    The fan-out is always scheduled onto the loop.
+    """
+
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, broker: Optional[Broker] = None):
+        self.queue_size = queue_size
+        self.broker = broker or make_broker()
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def configure(self, settings):
+        """
+        Only while stopped: replaces the broker.
+        """
+        self.queue_size = settings.ws_queue_size
+        self.broker = make_broker(settings.broker_url, settings.broker_queue_size)
+
+    def start(self):
+        self.broker.start(self.deliver, self.reset)
+
+    def stop(self):
+        self.broker.stop()
+
+    def subscribe(self, chat_id: int, user_id: int) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        sub = Subscription(chat_id, user_id, self.queue_size)
+        self._subscribers.setdefault(chat_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        subs = self._subscribers.get(sub.chat_id)
+        if not subs:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._subscribers[sub.chat_id]
+
+    def subscriber_count(self, chat_id: int) -> int:
+        return len(self._subscribers.get(chat_id, ()))
+
+    def publish(self, chat_id: int, payload: str):
+        """
+        Send an already-encoded event to every subscriber of the chat, on any worker.
+        """
+        self.broker.publish(chat_id, payload)
+
+    def deliver(self, chat_id: int, payload: str):
+        """
+        Called by the broker for every event, keeps the recent-message
+        buffer current and fans out to local subscribers.
+        """
+        recent.apply_event(chat_id, payload)
+        loop = self._loop
+        if loop is None or loop.is_closed() or chat_id not in self._subscribers:
+            return
+        loop.call_soon_threadsafe(self._fanout, chat_id, payload)
+
+    def reset(self):
+        """
+        Called by the broker when events may have been lost (reconnect).
+        """
+        recent.clear()
+
+    def _fanout(self, chat_id: int, payload: str):
+        for sub in list(self._subscribers.get(chat_id, ())):
+            sub.offer(payload)
+            if sub.overflowed:
+                self.unsubscribe(sub)
+
+
+hub = ChatHub()
+
+
+def encode_message_event(message) -> str:
+    """
+    Encode a committed Message once, the same text is sent to every subscriber.
+    """
+    return json.dumps({
+        "type": "message.created",
+        # The chat's message_seq after this message, lets receivers notice a missed event
+        "seq": getattr(message, "seq", None),
+        "data": {
+            "id": message.id,
+            "chat_id": message.chat_id,
+            "sender_id": message.sender_id,
+            "content": message.content,
+            "timestamp": message.timestamp.isoformat(),
+            "is_read": bool(message.is_read),
+        },
+    })
@@ -0,0 +1,79 @@
+import threading
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from config import MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL
+from models import ChatParticipant
+from utils.cache import TTLCache
+
+
+class MembershipCache:
+    """
+    chat_id -> frozenset of participant ids, so "is this user in the chat"
+    is a set lookup instead of loading chat.participants.
+
+    Every write that changes participants must call invalidate(). Caches are
+    per process, the TTL bounds staleness for changes made by other workers.
+    """
+
+    def __init__(self, maxsize: int = MEMBERSHIP_CACHE_SIZE, ttl: float = MEMBERSHIP_CACHE_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+        # Bumped on every invalidation, a load that raced with one is not stored
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _query(chat_id: int):
+        return select(ChatParticipant.user_id).filter(ChatParticipant.chat_id == chat_id)
+
+    def _store(self, chat_id: int, user_ids, epoch: int) -> frozenset:
+        members = frozenset(user_ids)
+        with self._lock:
+            if epoch == self._epoch:
+                self._cache.set(chat_id, members)
+        return members
+
+    def members(self, db: Session, chat_id: int) -> frozenset:
+        members = self._cache.get(chat_id)
+        if members is None:
+            epoch = self._epoch
+            members = self._store(chat_id, db.execute(self._query(chat_id)).scalars().all(), epoch)
+        return members
+
+    async def amembers(self, db, chat_id: int) -> frozenset:
+        members = self._cache.get(chat_id)
+        if members is None:
+            epoch = self._epoch
+            result = await db.execute(self._query(chat_id))
+            members = self._store(chat_id, result.scalars().all(), epoch)
+        return members
+
+    def is_member(self, db: Session, chat_id: int, user_id: int) -> bool:
+        return user_id in self.members(db, chat_id)
+
+    async def ais_member(self, db, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.amembers(db, chat_id)
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._epoch += 1
+            self._cache.pop(chat_id)
+
+    def invalidate_user(self, user_id: int):
+        """
+        A user was deleted: forget every cached chat they were part of.
+        """
+        with self._lock:
+            self._epoch += 1
+            self._cache.discard_where(lambda members: user_id in members)
+
+    def configure(self, settings):
+        with self._lock:
+            self._epoch += 1
+            self._cache.resize(settings.membership_cache_size, settings.membership_cache_ttl)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+membership = MembershipCache()
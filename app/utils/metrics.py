@@ -0,0 +1,324 @@
+import bisect
+import contextvars
+import logging
+import re
+import threading
+import time
+from collections import Counter as TableCounter
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+from config import NPLUSONE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+
+# Prometheus text exposition without the client library. Metrics are per
+# process: with several workers each one reports its own, scrape them
+# individually or aggregate downstream.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class FunctionGauge(Metric):
+    """
+    Gauge read when scraped, fn returns {label values tuple: value}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Dict[Tuple, float]], labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self):
+        return [f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in self.fn().items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (non cumulative, +Inf last), sum, count]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        lines = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    "http_requests_total", "Requests handled", ("method", "route", "status")
+))
+request_seconds = registry.register(Histogram(
+    "http_request_duration_seconds", "Request latency", ("method", "route")
+))
+in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "Requests being handled", ("method", "route")
+))
+request_statements = registry.register(Histogram(
+    "http_request_db_statements", "SQL statements per request", ("method", "route"), STATEMENT_BUCKETS
+))
+request_db_seconds = registry.register(Histogram(
+    "http_request_db_seconds", "Time spent in SQL per request", ("method", "route")
+))
+statements_total = registry.register(Counter(
+    "db_statements_total", "SQL statements executed, requests and background work", ("engine",)
+))
+statement_seconds_total = registry.register(Counter(
+    "db_statement_seconds_total", "Time spent executing SQL", ("engine",)
+))
+checkout_seconds = registry.register(Histogram(
+    "db_pool_checkout_seconds", "Wait for a pooled connection", ("engine",), CHECKOUT_BUCKETS
+))
+_pools = {}
+
+
+def _pool_state() -> Dict[Tuple, float]:
+    # Only QueuePool keeps these numbers, SQLite in-memory pools don't
+    state = {}
+    for name, pool in _pools.items():
+        for key in ("size", "checkedout", "overflow"):
+            method = getattr(pool, key, None)
+            if method is not None:
+                state[(name, key)] = method()
+    return state
+
+
+pool_connections = registry.register(FunctionGauge(
+    "db_pool_connections", "Pool size, checked out connections and overflow in use", _pool_state, ("engine", "state")
+))
+startup_seconds = registry.register(Gauge(
+    "app_startup_seconds", "Time spent in each startup phase of this worker", ("phase",)
+))
+nplusone_total = registry.register(Counter(
+    "db_nplusone_suspects_total", "Requests that queried one table more than NPLUSONE_THRESHOLD times", ("route", "table")
+))
+
+
+# ---------------------------
+# SQL instrumentation
+# ---------------------------
+
+class RequestStats:
+    __slots__ = ("statements", "db_seconds", "tables")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.tables = TableCounter()
+
+
+# Set by the middleware. Sync routes run in the threadpool with a copy of
+# the context, which still points at the same RequestStats object.
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request", default=None)
+
+_TABLE = re.compile(r"^\s*(?:SELECT\b.*?\bFROM|INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+[\"`]?(\w+)", re.I | re.S)
+
+
+@lru_cache(maxsize=1024)
+def table_of(statement: str) -> str:
+    """
+    Main table of a statement, statements are parameterized so this is cached.
+    """
+    match = _TABLE.match(statement)
+    return match.group(1) if match else "other"
+
+
+def instrument_engine(engine, name: str = "default"):
+    """
+    Count and time every statement of `engine`, and time pool checkouts.
+    Pass async engines' .sync_engine.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        statements_total.inc(name)
+        statement_seconds_total.inc(name, amount=elapsed)
+        stats = current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_seconds += elapsed
+            stats.tables[table_of(statement)] += 1
+
+    # The pool has no "before checkout" event, time the call itself
+    pool = engine.pool
+    connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            checkout_seconds.observe(time.perf_counter() - start, name)
+
+    pool.connect = timed_connect
+
+    _pools[name] = pool
+
+
+# ---------------------------
+# Middleware
+# ---------------------------
+
+def route_of(scope) -> str:
+    """
+    Path template of the route that will handle the request, so ids don't end
+    up as label values. Same matching Starlette does right after us.
+    """
+    partial = None
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app, nplusone_threshold: int = NPLUSONE_THRESHOLD):
+        self.app = app
+        self.nplusone_threshold = nplusone_threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method, route = scope["method"], route_of(scope)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        in_flight.inc(method, route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_flight.dec(method, route)
+            current_request.reset(token)
+            requests_total.inc(method, route, status)
+            request_seconds.observe(elapsed, method, route)
+            request_statements.observe(stats.statements, method, route)
+            request_db_seconds.observe(stats.db_seconds, method, route)
+            if self.nplusone_threshold:
+                self._check_nplusone(method, route, stats)
+
+    def _check_nplusone(self, method: str, route: str, stats: RequestStats):
+        for table, count in stats.tables.items():
+            if count > self.nplusone_threshold:
+                nplusone_total.inc(route, table)
+                logger.warning(
+                    "Possible N+1: %s %s ran %d statements on %s (%d in total, %.1f ms)",
+                    method, route, count, table, stats.statements, stats.db_seconds * 1000,
+                )
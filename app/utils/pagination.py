@@ -0,0 +1,67 @@
+import base64
+from datetime import datetime
+from operator import attrgetter
+from typing import Optional, Tuple
+
+from Schemas import MessagePage
+
+
+# A cursor points at one row by its sort key (timestamp, id): messages by
+# timestamp, chats in the inbox by last_activity_at.
+# Clients must treat it as opaque.
+MessageCursor = Tuple[datetime, int]
+
+
+def encode_cursor(timestamp: datetime, message_id: int) -> str:
+    raw = f"{timestamp.isoformat()}|{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[MessageCursor]:
+    """
+    Returns the (timestamp, id) key, None when no cursor was given.
+    Raises ValueError for anything we didn't produce ourselves.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.split("|")
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def trim_page(messages: list, limit: int, after: Optional[MessageCursor]):
+    """
+    Pages are fetched with limit + 1 rows, the extra row only tells us
+    whether another page exists. Returns (page, has_more).
+    """
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[:limit] if after else messages[1:]
+    return messages, has_more
+
+
+def page_cursors(messages: list, has_more: bool, after: Optional[MessageCursor], key=attrgetter("timestamp", "id")):
+    """
+    (older_cursor, newer_cursor) of a trimmed page. `key` reads the
+    (timestamp, id) of one item, items are ORM objects by default.
+    """
+    older_cursor = newer_cursor = None
+    if messages:
+        if after or has_more:
+            older_cursor = encode_cursor(*key(messages[0]))
+        newer_cursor = encode_cursor(*key(messages[-1]))
+    return older_cursor, newer_cursor
+
+
+def build_message_page(messages: list, has_more: bool, after: Optional[MessageCursor], users: Optional[list] = None):
+    older_cursor, newer_cursor = page_cursors(messages, has_more, after)
+    return MessagePage(
+        items=messages,
+        users=users,
+        has_more=has_more,
+        older_cursor=older_cursor,
+        newer_cursor=newer_cursor,
+    )
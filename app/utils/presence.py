@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import update
+
+from config import PRESENCE_TIMEOUT, PRESENCE_FLUSH_INTERVAL
+from models import User
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    """
+    Who is online, kept in memory and fed by heartbeats and open WebSockets.
+
+    A user is online while they have a connection open or heartbeated within
+    `timeout` seconds. Every `flush_interval` seconds the users whose state
+    changed since the last flush are written to users.is_online with at most
+    two bulk UPDATEs, instead of one row update per heartbeat. Once per
+    `timeout` the online users are written again, in case another worker's
+    start() reset them.
+    """
+
+    def __init__(self, timeout: float = PRESENCE_TIMEOUT, flush_interval: float = PRESENCE_FLUSH_INTERVAL):
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self._last_seen: Dict[int, float] = {}
+        self._connections: Dict[int, int] = {}
+        self._flushed: Dict[int, bool] = {}  # what the users table holds, as far as we know
+        self._reasserted = 0.0  # last time every online user was written, not just changes
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def configure(self, settings):
+        """
+        Only while stopped, the flusher thread reads these.
+        """
+        self.timeout = settings.presence_timeout
+        self.flush_interval = settings.presence_flush_interval
+
+    def heartbeat(self, user_id: int):
+        with self._lock:
+            self._last_seen[user_id] = time.time()
+
+    def connect(self, user_id: int):
+        with self._lock:
+            self._connections[user_id] = self._connections.get(user_id, 0) + 1
+            self._last_seen[user_id] = time.time()
+
+    def disconnect(self, user_id: int):
+        with self._lock:
+            remaining = self._connections.get(user_id, 0) - 1
+            if remaining > 0:
+                self._connections[user_id] = remaining
+            else:
+                self._connections.pop(user_id, None)
+            self._last_seen[user_id] = time.time()
+
+    def _is_online(self, user_id: int, now: float) -> bool:
+        if user_id in self._connections:
+            return True
+        last_seen = self._last_seen.get(user_id)
+        return last_seen is not None and now - last_seen < self.timeout
+
+    def lookup(self, user_ids: Iterable[int]) -> Dict[int, dict]:
+        now = time.time()
+        with self._lock:
+            result = {}
+            for user_id in user_ids:
+                last_seen = self._last_seen.get(user_id)
+                result[user_id] = {
+                    "is_online": self._is_online(user_id, now),
+                    "last_seen": datetime.utcfromtimestamp(last_seen) if last_seen else None,
+                }
+            return result
+
+    def flush(self, db):
+        """
+        Write changed is_online values in bulk, forget users that went offline.
+        """
+        now = time.time()
+        with self._lock:
+            reassert = now - self._reasserted >= self.timeout
+            if reassert:
+                self._reasserted = now
+            went_online, went_offline = set(), set()
+            for user_id in set(self._last_seen) | set(self._connections) | set(self._flushed):
+                online = self._is_online(user_id, now)
+                if self._flushed.get(user_id) != online or (online and reassert):
+                    (went_online if online else went_offline).add(user_id)
+        if not went_online and not went_offline:
+            return
+
+        if went_online:
+            db.execute(update(User).where(User.id.in_(went_online)).values(is_online=True))
+        if went_offline:
+            db.execute(update(User).where(User.id.in_(went_offline)).values(is_online=False))
+        db.commit()
+
+        with self._lock:
+            for user_id in went_online:
+                self._flushed[user_id] = True
+            for user_id in went_offline:
+                # Offline and persisted, nothing left to track until the next heartbeat
+                if not self._is_online(user_id, time.time()):
+                    self._flushed.pop(user_id, None)
+                    self._last_seen.pop(user_id, None)
+                else:
+                    self._flushed[user_id] = False
+
+    def start(self, session_factory):
+        if self._thread is not None:
+            return
+        self._reset_stale(session_factory)
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                self._flush_with(session_factory)
+            self._flush_with(session_factory)
+
+        self._thread = threading.Thread(target=run, name="presence-flusher", daemon=True)
+        self._thread.start()
+
+    def _reset_stale(self, session_factory):
+        """
+        Users left online by a process that stopped without flushing (crash,
+        kill -9) go offline. Those of other live workers are written back by
+        their own flusher within `timeout`.
+        """
+        with self._lock:
+            online = [user_id for user_id, flushed in self._flushed.items() if flushed]
+        db = session_factory()
+        try:
+            stale = update(User).where(User.is_online.is_(True))
+            if online:
+                stale = stale.where(User.id.not_in(online))
+            db.execute(stale.values(is_online=False))
+            db.commit()
+        except Exception:
+            logger.exception("Resetting stale presence failed")
+            db.rollback()
+        finally:
+            db.close()
+
+    def _flush_with(self, session_factory):
+        db = session_factory()
+        try:
+            self.flush(db)
+        except Exception:
+            logger.exception("Presence flush failed, will retry")
+            db.rollback()
+        finally:
+            db.close()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(self.flush_interval + 5)
+        self._thread = None
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,175 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Optional
+
+from config import PROFILE_SAMPLE_RATE, PROFILE_TOKEN, PROFILE_INTERVAL_MS
+from utils.metrics import route_of
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+THIS_FILE = os.path.abspath(__file__)
+MAX_STACKS_PER_ROUTE = 5000
+
+
+@lru_cache(maxsize=4096)
+def _frame_label(filename: str, name: str) -> str:
+    if filename.startswith(APP_DIR):
+        filename = filename[len(APP_DIR):]
+    else:
+        _, _, filename = filename.rpartition("site-packages" + os.sep)
+    return f"{name} ({filename})"
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling of live requests, aggregated per route as collapsed
+    stacks ("route;frame;frame count", the input of flamegraph.pl and speedscope).
+
+    One request is profiled at a time. While it runs, a sampler thread reads
+    every thread's stack each `interval` and keeps those with app code on
+    them, from the outermost app frame down, library frames included. An
+    idle threadpool or event loop has no app frames, so what remains is the
+    profiled request, plus any other request executing app code in that
+    same instant. Awaiting coroutines are not on any stack: async handlers
+    show their CPU time, not their waits.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        token: Optional[str] = PROFILE_TOKEN,
+        interval: float = PROFILE_INTERVAL_MS / 1000,
+    ):
+        self.sample_rate = sample_rate
+        self.token = token
+        self.interval = interval
+        self._stacks: Dict[str, Counter] = {}
+        self._requests: Counter = Counter()
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._route: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or bool(self.token)
+
+    def configure(self, settings):
+        self.sample_rate = settings.profile_sample_rate
+        self.token = settings.profile_token
+        self.interval = settings.profile_interval_ms / 1000
+
+    def wants(self, scope) -> bool:
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == b"x-profile":
+                    return hmac.compare_digest(value, self.token.encode())
+        return random.random() < self.sample_rate
+
+    def begin(self, route: str) -> bool:
+        """
+        Start sampling for one request, False if another one is being profiled.
+        """
+        if not self._busy.acquire(blocking=False):
+            return False
+        self._route = route
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        self._active.set()
+        return True
+
+    def end(self):
+        self._active.clear()
+        with self._lock:
+            self._requests[self._route] += 1
+        self._busy.release()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            self._active.wait()
+            while self._active.is_set():
+                route = self._route
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = self._collapse(frame)
+                    if stack:
+                        self._record(route, stack)
+                time.sleep(self.interval)
+
+    @staticmethod
+    def _collapse(frame) -> Optional[str]:
+        frames = []
+        while frame is not None:
+            frames.append(frame.f_code)
+            frame = frame.f_back
+        frames.reverse()
+        for start, code in enumerate(frames):
+            if code.co_filename.startswith(APP_DIR) and code.co_filename != THIS_FILE:
+                return ";".join(_frame_label(code.co_filename, code.co_name) for code in frames[start:])
+        return None
+
+    def _record(self, route: str, stack: str):
+        with self._lock:
+            stacks = self._stacks.setdefault(route, Counter())
+            if stack in stacks or len(stacks) < MAX_STACKS_PER_ROUTE:
+                stacks[stack] += 1
+
+    def collapsed(self, route: Optional[str] = None) -> str:
+        with self._lock:
+            lines = [
+                f"{name};{stack} {count}"
+                for name, stacks in self._stacks.items() if route is None or name == route
+                for stack, count in stacks.items()
+            ]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "interval_ms": self.interval * 1000,
+                "profiled_requests": dict(self._requests),
+                "samples": {route: sum(stacks.values()) for route, stacks in self._stacks.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self._requests.clear()
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilerMiddleware:
+    """
+    Only installed when profiling is enabled, there is nothing on the
+    request path otherwise.
+    """
+
+    def __init__(self, app, profiler: SamplingProfiler = profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.wants(scope):
+            await self.app(scope, receive, send)
+            return
+        if not self.profiler.begin(f"{scope['method']} {route_of(scope)}"):
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.end()
@@ -0,0 +1,273 @@
+import bisect
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, Optional
+
+from config import RECENT_MESSAGES_PER_CHAT, RECENT_MESSAGES_MEMORY_MB, RECENT_MESSAGES_TTL
+
+
+# Rough size of a buffered message besides its text: the tuple, its ints and datetime
+MESSAGE_OVERHEAD = 250
+
+
+class RecentMessage(NamedTuple):
+    id: int
+    chat_id: int
+    sender_id: int
+    content: str
+    timestamp: datetime
+    is_read: bool
+
+    @classmethod
+    def of(cls, message) -> "RecentMessage":
+        return cls(
+            message.id, message.chat_id, message.sender_id, message.content, message.timestamp, bool(message.is_read)
+        )
+
+
+def _cost(message: RecentMessage) -> int:
+    return MESSAGE_OVERHEAD + len(message.content)
+
+
+class _Window:
+    __slots__ = ("floor", "seq", "ids", "messages", "bytes", "expires")
+
+    def __init__(self, floor: int, seq: int, expires: float):
+        self.floor = floor
+        # The chat's message_seq this window is complete up to
+        self.seq = seq
+        self.ids: List[int] = []
+        self.messages: List[RecentMessage] = []
+        self.bytes = 0
+        self.expires = expires
+
+
+class RecentMessageBuffer:
+    """
+    The newest messages of each active chat, so clients catching up after a
+    reconnect are answered without a query.
+
+    A chat's window holds every message with an id above its `floor`, in id
+    order, at most `per_chat` of them: the oldest is dropped and the floor
+    moves up past it. A read since an id at or above the floor is complete
+    from memory, anything older goes to the database.
+
+    Windows only start from a database read, which also gives the chat's
+    message_seq at the time. After that a window is extended by messages
+    committed here or received through the hub, but only by the next seq:
+    the broker delivers at most once, so a seq that skips one (or a message
+    without a seq) drops the window, and so does a broker reconnect
+    (clear()). Whole windows are evicted least recently used first once the
+    buffered text passes `max_bytes`. Deletes are only seen by the worker
+    making them, as with the membership cache the TTL bounds what other
+    workers keep serving.
+    """
+
+    def __init__(
+        self,
+        per_chat: int = RECENT_MESSAGES_PER_CHAT,
+        max_bytes: int = int(RECENT_MESSAGES_MEMORY_MB * 1024 * 1024),
+        ttl: float = RECENT_MESSAGES_TTL,
+    ):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._windows: "OrderedDict[int, _Window]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Bumped on every invalidation, a database read that raced with one is not stored
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_chat > 0
+
+    def configure(self, settings):
+        with self._lock:
+            self.per_chat = settings.recent_messages_per_chat
+            self.max_bytes = int(settings.recent_messages_memory_mb * 1024 * 1024)
+            self.ttl = settings.recent_messages_ttl
+            self.epoch += 1
+            self._windows.clear()
+            self._bytes = 0
+
+    # Callers hold the lock for everything below up to add()
+
+    def _window(self, chat_id: int, now: float) -> Optional[_Window]:
+        window = self._windows.get(chat_id)
+        if window is None:
+            return None
+        if window.expires <= now:
+            self._remove(chat_id)
+            return None
+        self._windows.move_to_end(chat_id)
+        return window
+
+    def _new_window(self, chat_id: int, floor: int, seq: int, now: float) -> _Window:
+        self._remove(chat_id)
+        window = self._windows[chat_id] = _Window(floor, seq, now + self.ttl)
+        return window
+
+    def _remove(self, chat_id: int):
+        window = self._windows.pop(chat_id, None)
+        if window is not None:
+            self._bytes -= window.bytes
+
+    def _insert(self, window: _Window, message: RecentMessage):
+        if message.id <= window.floor:
+            return
+        index = bisect.bisect_left(window.ids, message.id)
+        if index < len(window.ids) and window.ids[index] == message.id:
+            return
+        window.ids.insert(index, message.id)
+        window.messages.insert(index, message)
+        window.bytes += _cost(message)
+        self._bytes += _cost(message)
+        while len(window.ids) > self.per_chat:
+            window.floor = window.ids.pop(0)
+            dropped = window.messages.pop(0)
+            window.bytes -= _cost(dropped)
+            self._bytes -= _cost(dropped)
+
+    def _shrink(self):
+        while self._bytes > self.max_bytes and self._windows:
+            _, window = self._windows.popitem(last=False)
+            self._bytes -= window.bytes
+            self.evictions += 1
+
+    def add(self, message, seq: Optional[int] = None):
+        """
+        Record a committed message (ORM object or RecentMessage) that took
+        the chat's message_seq to `seq` (default: message.seq). Chats
+        without a window are left alone.
+        """
+        if not self.enabled:
+            return
+        if seq is None:
+            seq = getattr(message, "seq", None)
+        message = RecentMessage.of(message)
+        with self._lock:
+            window = self._window(message.chat_id, time.monotonic())
+            if window is None:
+                return
+            if seq is not None and seq <= window.seq:
+                # Already in the window (our own event coming back) or older than it
+                return
+            if seq is None or seq != window.seq + 1:
+                # A message in between was missed, the window can't be trusted
+                self._remove(message.chat_id)
+                return
+            window.seq = seq
+            self._insert(window, message)
+            self._shrink()
+
+    def apply_event(self, chat_id: int, payload: str):
+        """
+        Hub events, as delivered to every worker.
+        """
+        if not self.enabled:
+            return
+        event = json.loads(payload)
+        if event.get("type") == "message.created":
+            data = event["data"]
+            self.add(RecentMessage(
+                data["id"], data["chat_id"], data["sender_id"], data["content"],
+                datetime.fromisoformat(data["timestamp"]), data["is_read"],
+            ), event.get("seq"))
+
+    def since(self, chat_id: int, since_id: int, limit: int) -> Optional[List[RecentMessage]]:
+        """
+        Up to `limit` messages with an id above since_id, oldest first.
+        None when the chat's window doesn't reach back to since_id.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            window = self._window(chat_id, time.monotonic())
+            if window is None or since_id < window.floor:
+                self.misses += 1
+                return None
+            self.hits += 1
+            start = bisect.bisect_right(window.ids, since_id)
+            return window.messages[start:start + limit]
+
+    def fill(self, chat_id: int, since_id: int, messages: Iterable, seq: int, epoch: int):
+        """
+        Store a database read holding every message of the chat above
+        since_id, made after reading the chat's message_seq `seq`. Skipped
+        when something was invalidated since `epoch`.
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            window = self._window(chat_id, now)
+            if window is not None and window.seq > seq:
+                # The window already saw messages this read may predate
+                return
+            if window is None or window.seq < seq:
+                window = self._new_window(chat_id, since_id, seq, now)
+            elif since_id < window.floor:
+                # Both complete up to the same seq, the read only reaches further back
+                window.floor = since_id
+            for message in messages:
+                self._insert(window, RecentMessage.of(message))
+            self._shrink()
+
+    def discard(self, chat_id: int, message_id: int):
+        with self._lock:
+            self.epoch += 1
+            window = self._windows.get(chat_id)
+            if window is None:
+                return
+            index = bisect.bisect_left(window.ids, message_id)
+            if index < len(window.ids) and window.ids[index] == message_id:
+                del window.ids[index]
+                dropped = window.messages.pop(index)
+                window.bytes -= _cost(dropped)
+                self._bytes -= _cost(dropped)
+
+    def mark_read(self, chat_id: int, message_id: int):
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is None:
+                return
+            index = bisect.bisect_left(window.ids, message_id)
+            if index < len(window.ids) and window.ids[index] == message_id:
+                window.messages[index] = window.messages[index]._replace(is_read=True)
+
+    def drop(self, chat_id: int):
+        with self._lock:
+            self.epoch += 1
+            self._remove(chat_id)
+
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self._windows.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "per_chat": self.per_chat,
+                "chats": len(self._windows),
+                "messages": sum(len(window.ids) for window in self._windows.values()),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+recent = RecentMessageBuffer()
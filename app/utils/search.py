@@ -0,0 +1,142 @@
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+# The text index lives next to `messages` and is maintained by the database
+# itself, so every insert/delete path (crud, routers, bulk inserts, the
+# group-commit writer) stays in sync without calling anything here:
+#   - SQLite: an external-content FTS5 table kept current by triggers
+#   - Postgres: a GIN expression index on to_tsvector(content)
+
+SQLITE_FTS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+       USING fts5(content, content='messages', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+         INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+         INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+         INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+         INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+       END""",
+]
+
+POSTGRES_FTS = [
+    """CREATE INDEX IF NOT EXISTS ix_messages_content_fts
+       ON messages USING GIN (to_tsvector('simple', content))""",
+]
+
+
+def install(engine):
+    """
+    Create the text index if it's missing. Safe to run on every startup.
+    """
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            existed = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+            ).first()
+            for statement in SQLITE_FTS:
+                conn.execute(text(statement))
+            if not existed:
+                # Index messages written before search existed
+                conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+        elif engine.dialect.name == "postgresql":
+            for statement in POSTGRES_FTS:
+                conn.execute(text(statement))
+
+
+def missing(engine) -> list:
+    """
+    Parts of the text index the database doesn't have, named like
+    database.missing_schema does. Reads the catalog only.
+    """
+    with engine.connect() as conn:
+        if engine.dialect.name == "sqlite":
+            found = {
+                (row.type, row.name)
+                for row in conn.execute(text("SELECT type, name FROM sqlite_master WHERE name LIKE 'messages_fts%'"))
+            }
+            wanted = [("table", "messages_fts", "messages_fts")] + [
+                ("trigger", name, f"messages.{name}")
+                for name in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update")
+            ]
+            return [label for kind, name, label in wanted if (kind, name) not in found]
+        if engine.dialect.name == "postgresql":
+            found = conn.execute(
+                text("SELECT 1 FROM pg_indexes WHERE tablename = 'messages' AND indexname = 'ix_messages_content_fts'")
+            ).first()
+            return [] if found else ["messages.ix_messages_content_fts"]
+    return []
+
+
+def _fts5_query(q: str) -> str:
+    """
+    Quote every word so user input can't use FTS5 syntax, the last word
+    matches as a prefix (search as you type).
+    """
+    words = re.findall(r"\w+", q)
+    if not words:
+        return ""
+    quoted = ['"' + word.replace('"', '""') + '"' for word in words]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search_message_ids(
+    db: Session,
+    q: str,
+    user_id: int,
+    chat_id: Optional[int] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> List[Tuple[int, float]]:
+    """
+    Ids of messages matching q, best match first, restricted to chats the
+    user is in. Returns (message_id, rank) pairs.
+    """
+    dialect = db.get_bind().dialect.name
+    params = {"user_id": user_id, "chat_id": chat_id, "limit": limit, "offset": offset}
+    chat_filter = "AND m.chat_id = :chat_id" if chat_id is not None else ""
+
+    if dialect == "sqlite":
+        params["q"] = _fts5_query(q)
+        if not params["q"]:
+            return []
+        sql = f"""
+            SELECT m.id, bm25(messages_fts) AS score
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN chat_participants cp ON cp.chat_id = m.chat_id AND cp.user_id = :user_id
+            WHERE messages_fts MATCH :q {chat_filter}
+            ORDER BY score, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    elif dialect == "postgresql":
+        params["q"] = q
+        sql = f"""
+            SELECT m.id, ts_rank(to_tsvector('simple', m.content), plainto_tsquery('simple', :q)) AS score
+            FROM messages m
+            JOIN chat_participants cp ON cp.chat_id = m.chat_id AND cp.user_id = :user_id
+            WHERE to_tsvector('simple', m.content) @@ plainto_tsquery('simple', :q) {chat_filter}
+            ORDER BY score DESC, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    else:
+        # No text index for this database, plain scan
+        params["q"] = f"%{q}%"
+        sql = f"""
+            SELECT m.id, 0 AS score
+            FROM messages m
+            JOIN chat_participants cp ON cp.chat_id = m.chat_id AND cp.user_id = :user_id
+            WHERE m.content LIKE :q {chat_filter}
+            ORDER BY m.id DESC
+            LIMIT :limit OFFSET :offset
+        """
+
+    return [(row.id, row.score) for row in db.execute(text(sql), params)]
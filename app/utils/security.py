@@ -1,25 +1,27 @@
+import hashlib
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
-from passlib.context import CryptContext
-import os
-from dotenv import load_dotenv
-load_dotenv()
+from config import (
+    SECRET_KEY,
+    ALGORITHM,
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    REFRESH_TOKEN_EXPIRE_DAYS,
+    TOKEN_CACHE_SIZE,
+    PRINCIPAL_CACHE_SIZE,
+    PRINCIPAL_CACHE_TTL,
+)
+from utils.cache import TTLCache
+from utils.hashing import hasher
 
-# Secret key and algorithm
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 15))
-REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 7))
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 
-
-# Password hashing
+# Password hashing, runs on the dedicated pool in utils.hashing
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return hasher.hash(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    valid, _ = hasher.verify_and_update(plain_password, hashed_password)
+    return valid
 
 
 # Token creation
@@ -42,3 +44,48 @@ def decode_token(token: str):
         return payload
     except JWTError:
         return None
+
+
+# Verified payloads keyed by token hash, each entry lives until the token's exp
+token_cache = TTLCache(TOKEN_CACHE_SIZE, ttl=float("inf"))
+
+
+def decode_token_cached(token: str):
+    """
+    decode_token without re-verifying the signature of a token we've already seen.
+    Only valid tokens are cached.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is None:
+        payload = decode_token(token)
+        if payload and payload.get("exp"):
+            token_cache.set(key, payload, expires_at=float(payload["exp"]))
+    return payload
+
+
+# email -> CurrentUser, short lived so profile changes made by other workers show up quickly
+principal_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+
+def configure(settings):
+    """
+    Sign and verify with this app's key, expiries and cache sizes.
+    """
+    global SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS
+    if not settings.secret_key:
+        raise RuntimeError("SECRET_KEY is not set")
+    SECRET_KEY = settings.secret_key
+    ALGORITHM = settings.algorithm
+    ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
+    REFRESH_TOKEN_EXPIRE_DAYS = settings.refresh_token_expire_days
+    # Tokens verified with the previous key mean nothing now
+    token_cache.resize(settings.token_cache_size, float("inf"))
+    principal_cache.resize(settings.principal_cache_size, settings.principal_cache_ttl)
+
+
+def forget_principal(user_id: int):
+    """
+    Call after a user is updated or deleted.
+    """
+    principal_cache.discard_where(lambda principal: principal.id == user_id)
@@ -0,0 +1,337 @@
+"""
+Load test of the chat API: boots the app in-process (httpx ASGITransport,
+no server or sockets) on a freshly seeded SQLite database and drives it with
+concurrent async clients, one scenario at a time.
+
+    python benchmarks/loadtest.py --users 2000 --chats 500 --messages 50000
+    python benchmarks/loadtest.py --save benchmarks/baseline.json
+    python benchmarks/loadtest.py --baseline benchmarks/baseline.json   # exit 1 on regression
+
+Reports throughput and p50/p95/p99 latency per scenario. Baselines are
+plain JSON; a scenario regresses when its p95 grows, or its throughput
+drops, by more than --threshold. Any failed request fails the run. Compare runs from the same machine and
+the same arguments only. Needs httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+PASSWORD = "bench-password"
+SCENARIOS = ["login_storm", "send_burst", "history_paging", "chat_list", "inbox", "user_listing"]
+
+
+def configure(args):
+    """
+    Environment for the app, must run before anything from app/ is imported.
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(args.workdir, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "bench-secret")
+    os.environ["ADMISSION_ENABLED"] = "true" if args.admission else "false"
+    os.environ["ARCHIVE_AFTER_DAYS"] = "0"
+    os.environ["BROKER_URL"] = "local"
+
+
+# ---------------------------
+# Seeding
+# ---------------------------
+
+def seed(args, rng: random.Random) -> dict:
+    from sqlalchemy import func, insert, select, update
+
+    import models
+    from database import SessionLocal
+    from utils.hashing import hasher
+
+    now = datetime.utcnow()
+    hashed = hasher.hash(PASSWORD)  # one hash for everyone, seeding shouldn't take minutes
+    with SessionLocal() as db:
+        db.execute(insert(models.User), [
+            {
+                "username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": hashed,
+                "created_at": now, "updated_at": now, "chat_list_version": 0,
+            }
+            for i in range(args.users)
+        ])
+        emails = dict(db.execute(select(models.User.id, models.User.email)).all())
+        user_ids = sorted(emails)
+
+        # Chat 1 is the long one, the rest are mostly direct chats with a few groups
+        members = {}
+        members[1] = user_ids[:min(20, len(user_ids))]
+        for chat_id in range(2, args.chats + 1):
+            size = rng.randint(3, 12) if chat_id % 10 == 0 else 2
+            members[chat_id] = rng.sample(user_ids, min(size, len(user_ids)))
+        db.execute(insert(models.Chat), [
+            {"id": chat_id, "is_group": len(ids) > 2, "created_at": now, "message_count": 0, "version": 0}
+            for chat_id, ids in members.items()
+        ])
+        db.execute(insert(models.ChatParticipant), [
+            {"chat_id": chat_id, "user_id": user_id} for chat_id, ids in members.items() for user_id in ids
+        ])
+
+        start = now - timedelta(days=30)
+        for chat_id, ids in members.items():
+            count = args.messages if chat_id == 1 else args.messages_per_chat
+            for offset in range(0, count, 5000):
+                db.execute(insert(models.Message), [
+                    {
+                        "chat_id": chat_id, "sender_id": rng.choice(ids), "content": f"message {n} " * 3,
+                        "timestamp": start + timedelta(seconds=n), "is_read": False,
+                    }
+                    for n in range(offset, min(count, offset + 5000))
+                ])
+
+        # Inbox columns, as the write paths would have maintained them
+        message = models.Message
+        db.execute(update(models.Chat).values(
+            last_message_id=select(func.max(message.id)).where(message.chat_id == models.Chat.id).scalar_subquery(),
+            last_activity_at=select(func.max(message.timestamp)).where(message.chat_id == models.Chat.id).scalar_subquery(),
+            message_count=select(func.count()).where(message.chat_id == models.Chat.id).scalar_subquery(),
+        ))
+        db.commit()
+
+    return {"emails": emails, "user_ids": user_ids, "members": members}
+
+
+# ---------------------------
+# Scenarios
+# ---------------------------
+
+class Context:
+    def __init__(self, data: dict, rng: random.Random):
+        from utils.security import create_access_token
+
+        self.rng = rng
+        self.emails = data["emails"]
+        self.user_ids = data["user_ids"]
+        self.members = data["members"]
+        self.tokens = {}
+        self._create_token = create_access_token
+
+    def auth(self, user_id: int) -> dict:
+        token = self.tokens.get(user_id)
+        if token is None:
+            token = self.tokens[user_id] = self._create_token({"sub": self.emails[user_id]})
+        return {"Authorization": f"Bearer {token}"}
+
+    def random_user(self) -> int:
+        return self.rng.choice(self.user_ids)
+
+
+async def login_storm(client, ctx: Context, state: dict):
+    user_id = ctx.random_user()
+    return await client.post(
+        "/auth/login", data={"username": ctx.emails[user_id], "password": PASSWORD}
+    )
+
+
+async def send_burst(client, ctx: Context, state: dict):
+    chat_id = ctx.rng.choice(list(ctx.members))
+    sender_id = ctx.rng.choice(ctx.members[chat_id])
+    return await client.post(
+        "/messages/",
+        json={"chat_id": chat_id, "sender_id": sender_id, "content": "load test message"},
+        headers=ctx.auth(sender_id),
+    )
+
+
+async def history_paging(client, ctx: Context, state: dict):
+    # Each client scrolls the long chat back from the newest page, then starts over
+    params = {"limit": 50}
+    if state.get("cursor"):
+        params["before"] = state["cursor"]
+    response = await client.get("/messages/chat/1", params=params, headers=ctx.auth(ctx.members[1][0]))
+    if response.status_code == 200:
+        state["cursor"] = response.json()["older_cursor"]
+    return response
+
+
+async def chat_list(client, ctx: Context, state: dict):
+    user_id = ctx.random_user()
+    return await client.get(f"/chats/user/{user_id}", headers=ctx.auth(user_id))
+
+
+async def inbox(client, ctx: Context, state: dict):
+    user_id = ctx.random_user()
+    return await client.get("/chats/inbox", params={"limit": 20}, headers=ctx.auth(user_id))
+
+
+async def user_listing(client, ctx: Context, state: dict):
+    params = {"limit": 100}
+    if state.get("after"):
+        params["after"] = state["after"]
+    response = await client.get("/users/", params=params, headers=ctx.auth(ctx.user_ids[0]))
+    if response.status_code == 200:
+        state["after"] = response.json()["next_after"]
+    return response
+
+
+# ---------------------------
+# Running and reporting
+# ---------------------------
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Nearest rank
+    rank = math.ceil(pct / 100 * len(sorted_values)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+async def run_scenario(client, ctx: Context, step, requests: int, concurrency: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        await step(client, ctx, {})
+
+    latencies, errors, statuses = [], 0, {}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        state = {}
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                response = await step(client, ctx, state)
+                status = response.status_code
+            except Exception:
+                status = "exception"
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == "exception" or status >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> dict:
+    """
+    scenario -> list of regression descriptions, empty when within threshold.
+    """
+    regressions = {}
+    for name, current in results.items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        found = []
+        if before["p95_ms"] and current["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            found.append(f"p95 {before['p95_ms']} -> {current['p95_ms']} ms")
+        if before["rps"] and current["rps"] < before["rps"] * (1 - threshold):
+            found.append(f"throughput {before['rps']} -> {current['rps']} req/s")
+        if current["errors"] > before["errors"]:
+            found.append(f"errors {before['errors']} -> {current['errors']}")
+        regressions[name] = found
+    return regressions
+
+
+def report(results: dict, regressions: dict):
+    print(f"{'scenario':<16}{'requests':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, r in results.items():
+        flag = "  REGRESSION: " + ", ".join(regressions[name]) if regressions.get(name) else ""
+        print(
+            f"{name:<16}{r['requests']:>9}{r['errors']:>8}{r['rps']:>10.1f}"
+            f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{flag}"
+        )
+
+
+async def main_async(args) -> int:
+    import httpx
+
+    from main import app
+
+    rng = random.Random(args.seed)
+    requests = {"login_storm": args.logins}
+    results = {}
+    # Engines and tables only exist once the lifespan has started
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+        data = seed(args, rng)
+        print(
+            f"seeded {args.users} users, {args.chats} chats, {args.messages} messages in the long chat "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+        ctx = Context(data, rng)
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name in args.scenarios:
+                results[name] = await run_scenario(
+                    client, ctx, globals()[name], requests.get(name, args.requests), args.concurrency, args.warmup
+                )
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold) if baseline else {}
+    report(results, regressions)
+
+    if args.save:
+        meta = {
+            "created_at": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("save", "baseline", "workdir")},
+        }
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"saved {args.save}")
+
+    failed = [name for name, result in results.items() if result["errors"]]
+    if failed:
+        # Timings of failed requests say nothing about the app
+        print(f"errors in {', '.join(failed)}, results are not comparable")
+    return 1 if failed or any(regressions.values()) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=20000, help="messages in the long chat")
+    parser.add_argument("--messages-per-chat", type=int, default=20)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--logins", type=int, default=100, help="requests of login_storm, hashing is slow")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--admission", action="store_true", help="keep rate limits on")
+    parser.add_argument("--save", help="write results as a JSON baseline")
+    parser.add_argument("--baseline", help="compare with this baseline, exit 1 on regression")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative change")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        configure(args)
+        sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
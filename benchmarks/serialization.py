@@ -0,0 +1,109 @@
+"""
+Compare the default response path (ORM objects -> pydantic orm_mode ->
+jsonable_encoder -> json) with the ?fast=true path (column rows -> orjson)
+for a page of messages and a page of users.
+
+    python benchmarks/serialization.py --messages 200 --users 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from datetime import datetime, timedelta  # noqa: E402
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import crud  # noqa: E402
+import models  # noqa: E402
+from database import Base  # noqa: E402
+from Schemas import UserPage  # noqa: E402
+from utils import fast_json  # noqa: E402
+from utils.pagination import trim_page, build_message_page  # noqa: E402
+
+
+def seed(db, users: int, messages: int, senders: int):
+    now = datetime.utcnow()
+    db.add_all(
+        models.User(username=f"user{i}", email=f"user{i}@example.com", hashed_password="x", created_at=now, updated_at=now)
+        for i in range(users)
+    )
+    chat = models.Chat(is_group=True)
+    db.add(chat)
+    db.flush()
+    db.add_all(models.ChatParticipant(chat_id=chat.id, user_id=i + 1) for i in range(senders))
+    db.add_all(
+        models.Message(
+            chat_id=chat.id,
+            sender_id=i % senders + 1,
+            content=f"message number {i} " * 4,
+            timestamp=now - timedelta(seconds=messages - i),
+        )
+        for i in range(messages)
+    )
+    db.commit()
+    return chat.id
+
+
+def timed(fn, repeat: int) -> float:
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200, help="page size")
+    parser.add_argument("--messages", type=int, default=200, help="page size")
+    parser.add_argument("--senders", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        chat_id = seed(db, args.users, args.messages, args.senders)
+
+    limit = args.messages
+
+    def messages_default():
+        with Session() as db:
+            rows = crud.get_messages_by_chat(db, chat_id, limit=limit + 1)
+            rows, has_more = trim_page(rows, limit, None)
+            return json.dumps(jsonable_encoder(build_message_page(rows, has_more, None))).encode()
+
+    def messages_fast():
+        with Session() as db:
+            return fast_json.FastJSONResponse(fast_json.message_page(db, chat_id, None, None, limit, True)).body
+
+    def users_default():
+        with Session() as db:
+            users = crud.get_users_page(db, limit=args.users)
+            return json.dumps(jsonable_encoder(UserPage(items=users))).encode()
+
+    def users_fast():
+        with Session() as db:
+            return fast_json.FastJSONResponse(fast_json.user_page(db, None, args.users)).body
+
+    print(f"encoder: {'orjson' if fast_json.orjson else 'stdlib json (orjson not installed)'}")
+    for name, default, fast in [
+        (f"message page ({limit} messages)", messages_default, messages_fast),
+        (f"user page ({args.users} users)", users_default, users_fast),
+    ]:
+        assert json.loads(default()) == json.loads(fast()), f"{name}: fast path output differs"
+        default_ms, fast_ms = timed(default, args.repeat), timed(fast, args.repeat)
+        print(f"{name:<32} default {default_ms:8.2f} ms   fast {fast_ms:8.2f} ms   x{default_ms / fast_ms:.1f}")
+
+
+if __name__ == "__main__":
+    main()
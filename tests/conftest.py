@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# The app imports its modules flat from app/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("SECRET_KEY", "test-secret")
+
+
+@pytest.fixture
+def make_settings(tmp_path):
+    """
+    Settings for an app on its own SQLite file.
+    """
+    from config import Settings
+
+    def make(**overrides):
+        return Settings(database_url=f"sqlite:///{tmp_path / 'test.db'}", **overrides)
+
+    return make
+
+
+@pytest.fixture
+def client(make_settings):
+    """
+    A started sync-mode app on its own database.
+    """
+    from fastapi.testclient import TestClient
+    from main import create_app
+
+    with TestClient(create_app(make_settings())) as client:
+        yield client
@@ -0,0 +1,9 @@
+def sign_up_and_login(client, name: str) -> dict:
+    response = client.post(
+        "/users/", json={"username": name, "email": f"{name}@example.com", "password": "password123"}
+    )
+    assert response.status_code == 201, response.text
+    user = response.json()
+    response = client.post("/auth/login", data={"username": user["email"], "password": "password123"})
+    assert response.status_code == 200, response.text
+    return {"id": user["id"], "headers": {"Authorization": f"Bearer {response.json()['access_token']}"}}
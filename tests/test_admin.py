@@ -0,0 +1,17 @@
+from fastapi.testclient import TestClient
+
+from helpers import sign_up_and_login
+from main import create_app
+
+
+def test_admin_routes_need_the_admin_token(make_settings):
+    with TestClient(create_app(make_settings(admin_token="let-me-in"))) as client:
+        user = sign_up_and_login(client, "alice")
+        for method, path in (("GET", "/admin/admission"), ("GET", "/admin/profile"), ("DELETE", "/admin/profile")):
+            assert client.request(method, path, headers=user["headers"]).status_code == 403
+            assert client.request(method, path, headers={"X-Admin-Token": "wrong"}).status_code == 403
+            assert client.request(method, path, headers={"X-Admin-Token": "let-me-in"}).status_code < 300
+
+
+def test_admin_routes_are_closed_without_a_token(client):
+    assert client.get("/admin/recent-messages", headers={"X-Admin-Token": ""}).status_code == 403
@@ -0,0 +1,51 @@
+from fastapi.testclient import TestClient
+
+from helpers import sign_up_and_login
+from main import create_app
+from utils.admission import AdmissionController, ConcurrencyLimiter, admission, route_class
+
+
+def scope(method: str, path: str) -> dict:
+    return {"type": "http", "method": method, "path": path, "headers": [], "client": ("10.0.0.1", 1234)}
+
+
+def test_route_classes():
+    assert route_class("POST", "/users/") == "auth"
+    assert route_class("POST", "/users/me/heartbeat") == "write"
+    assert route_class("POST", "/auth/login") == "auth"
+    assert route_class("POST", "/messages/") == "send"
+    assert route_class("POST", "/messages/batch") == "send"
+    assert route_class("GET", "/users/search") == "search"
+    assert route_class("GET", "/chats/1") == "read"
+    assert route_class("DELETE", "/users/1") == "write"
+
+
+def test_refused_request_takes_from_no_bucket():
+    controller = AdmissionController({"user": (0.001, 5), "auth": (0.001, 1)})
+    assert controller.check_request(scope("POST", "/auth/login")) == (0.0, "")
+
+    retry_after, limit = controller.check_request(scope("POST", "/auth/login"))
+    assert retry_after and limit == "auth"
+    # Only the admitted request was charged to the user's bucket
+    assert controller.buckets["user"].peek("addr:10.0.0.1") > 3.9
+
+
+def test_batches_pay_for_every_message(make_settings):
+    with TestClient(create_app(make_settings(rate_limit_chat="1/5"))) as client:
+        alice = sign_up_and_login(client, "alice")
+        bob = sign_up_and_login(client, "bob")
+        chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+        message = {"chat_id": chat_id, "sender_id": alice["id"], "content": "hi"}
+
+        response = client.post("/messages/batch", json=[message] * 6, headers=alice["headers"])
+        assert response.status_code == 429
+        assert client.post("/messages/batch", json=[message] * 5, headers=alice["headers"]).status_code == 200
+        assert client.post("/messages/", json=message, headers=alice["headers"]).status_code == 429
+
+
+def test_limiter_works_without_a_lifespan(make_settings):
+    app = create_app(make_settings())
+    admission.concurrency = ConcurrencyLimiter(4)
+    client = TestClient(app)
+    assert client.get("/metrics").status_code == 200
+    assert admission.concurrency.in_flight == 0
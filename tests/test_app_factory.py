@@ -0,0 +1,92 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from jose import jwt
+from sqlalchemy import create_engine, text
+
+import database
+from config import Settings
+from helpers import sign_up_and_login
+from main import create_app, prepare_schema
+from utils.admission import admission
+from utils.archive import archive
+from utils.group_commit import writer
+from utils.hashing import hasher
+from utils.hub import hub
+from utils.presence import presence
+from utils.recent import recent
+from utils.security import principal_cache
+
+
+def test_components_follow_the_app_settings(make_settings):
+    settings = make_settings(
+        rate_limit_auth="2/3",
+        max_concurrency=7,
+        recent_messages_per_chat=5,
+        principal_cache_ttl=9,
+        ws_queue_size=11,
+        group_commit_max_batch=13,
+        hash_workers=1,
+        presence_timeout=17,
+        archive_dir="elsewhere",
+    )
+    with TestClient(create_app(settings)):
+        assert hasher.workers == 1
+        assert presence.timeout == 17
+        assert archive.directory == "elsewhere"
+        assert admission.buckets["auth"].burst == 3
+        assert admission.concurrency.limit == 7
+        assert recent.per_chat == 5
+        assert principal_cache.ttl == 9
+        assert hub.queue_size == 11
+        assert writer.max_batch == 13
+
+
+def test_app_runs_from_a_settings_object_alone(tmp_path):
+    settings = Settings(
+        database_url=f"sqlite:///{tmp_path / 'own.db'}",
+        secret_key="own-key",
+        access_token_expire_minutes=1,
+        max_message_batch=2,
+    )
+    with TestClient(create_app(settings)) as client:
+        user = sign_up_and_login(client, "alice")
+        token = user["headers"]["Authorization"].split()[1]
+        payload = jwt.decode(token, "own-key", algorithms=["HS256"])
+        # Signed with the app's key, not the environment's, and its expiry
+        assert payload["exp"] <= time.time() + 61
+
+        batch = [{"chat_id": 1, "sender_id": user["id"], "content": "x"}] * 3
+        assert client.post("/messages/batch", json=batch, headers=user["headers"]).status_code == 413
+
+
+def test_check_mode_reports_missing_indexes(make_settings):
+    settings = make_settings()
+    engine = create_engine(settings.database_url)
+    prepare_schema(engine, "create")
+    assert database.missing_schema(engine) == []
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ux_chats_direct_pair"))
+    assert database.missing_schema(engine) == ["chats.ux_chats_direct_pair"]
+    engine.dispose()
+
+
+def test_check_mode_needs_the_search_index(make_settings):
+    settings = make_settings(schema_mode="check")
+    engine = create_engine(settings.database_url)
+    prepare_schema(engine, "create")
+    prepare_schema(engine, "check")
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TRIGGER messages_fts_delete"))
+    with pytest.raises(RuntimeError, match="messages.messages_fts_delete"):
+        with TestClient(create_app(settings)):
+            pass
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE messages_fts"))
+    with pytest.raises(RuntimeError, match="missing messages_fts, messages.messages_fts_delete$"):
+        prepare_schema(engine, "check")
+    engine.dispose()
@@ -0,0 +1,136 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+import crud, models, Schemas
+from database import Base
+from utils.archive import INDEX_RECORD, archive
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "directory", str(tmp_path / "archive"))
+    monkeypatch.setattr(archive, "block_messages", 4)
+    monkeypatch.setattr(archive, "_segments", {})
+    monkeypatch.setattr(archive, "_has_segments", None)
+    engine = create_engine(f"sqlite:///{tmp_path / 'archive.db'}")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def chat_with_history(db, count: int):
+    alice, bob = (
+        crud.create_user(db, Schemas.UserCreate(username=name, email=f"{name}@example.com", password="x"), "hash")
+        for name in ("alice", "bob")
+    )
+    chat = crud.create_chat(db, Schemas.ChatCreate(is_group=True, participant_ids=[alice.id, bob.id]))
+    start = datetime(2024, 1, 1)
+    ids = []
+    for n in range(count):
+        # Pairs of equal timestamps, pages must order them by id
+        timestamp = start + timedelta(minutes=n // 2)
+        message = models.Message(chat_id=chat.id, sender_id=alice.id, content=f"m{n}", timestamp=timestamp)
+        crud.record_message(db, message)
+        db.commit()
+        ids.append(message.id)
+    return chat.id, bob.id, ids
+
+
+def archive_all(db) -> int:
+    return archive.run(db, datetime.utcnow() + timedelta(days=1))
+
+
+def hot_count(db, chat_id: int) -> int:
+    return db.scalar(select(func.count()).select_from(models.Message).where(models.Message.chat_id == chat_id))
+
+
+def unread(db, user_id: int, chat_id: int) -> int:
+    return dict(crud.get_unread_counts(db, user_id))[chat_id]
+
+
+def walk_back(db, chat_id: int, limit: int) -> list:
+    ids, before = [], None
+    while True:
+        page = crud.get_messages_by_chat(db, chat_id, before=before, limit=limit)
+        ids[:0] = [m.id for m in page]
+        if len(page) < limit:
+            return ids
+        before = (page[0].timestamp, page[0].id)
+
+
+def walk_forward(db, chat_id: int, limit: int) -> list:
+    ids, after = [], (datetime(2000, 1, 1), 0)
+    while True:
+        page = crud.get_messages_by_chat(db, chat_id, after=after, limit=limit)
+        ids += [m.id for m in page]
+        if len(page) < limit:
+            return ids
+        after = (page[-1].timestamp, page[-1].id)
+
+
+def test_unread_messages_stay_in_the_table(db):
+    chat_id, bob_id, ids = chat_with_history(db, 20)
+    crud.mark_chat_read(db, chat_id, bob_id, ids[11])
+
+    assert archive_all(db) == 12
+    assert archive.boundary(chat_id)[1] == ids[11]
+    assert hot_count(db, chat_id) == 8
+    assert unread(db, bob_id, chat_id) == 8
+
+    crud.mark_chat_read(db, chat_id, bob_id, ids[-1])
+    # The last message stays for the inbox preview
+    assert archive_all(db) == 7
+    assert hot_count(db, chat_id) == 1
+    assert unread(db, bob_id, chat_id) == 0
+
+
+def test_pages_read_through_the_boundary(db):
+    chat_id, bob_id, ids = chat_with_history(db, 23)
+    crud.mark_chat_read(db, chat_id, bob_id, ids[16])
+    archive_all(db)
+
+    for limit in (1, 3, 5, 50):
+        assert walk_back(db, chat_id, limit) == ids
+        assert walk_forward(db, chat_id, limit) == ids
+    archived = crud.get_messages_by_chat(db, chat_id, before=archive.boundary(chat_id), limit=2)
+    assert [m.id for m in archived] == ids[14:16]
+    assert archived[0].sender.username == "alice"
+
+
+def test_torn_segment_writes_are_ignored(db):
+    chat_id, bob_id, ids = chat_with_history(db, 10)
+    crud.mark_chat_read(db, chat_id, bob_id, ids[5])
+    archive_all(db)
+
+    # A crash after writing a block but before its index record completed
+    with open(archive._path(chat_id, "seg"), "ab") as seg:
+        seg.write(os.urandom(64))
+    with open(archive._path(chat_id, "idx"), "ab") as idx:
+        idx.write(b"\x01" * (INDEX_RECORD.size // 2))
+    assert walk_back(db, chat_id, 4) == ids
+
+    crud.mark_chat_read(db, chat_id, bob_id, ids[-1])
+    assert archive_all(db) == 3
+    assert os.path.getsize(archive._path(chat_id, "idx")) % INDEX_RECORD.size == 0
+    assert walk_back(db, chat_id, 4) == ids
+    assert walk_forward(db, chat_id, 4) == ids
+
+
+def test_history_reads_skip_the_archive_when_it_is_off(db, monkeypatch):
+    chat_id, _, ids = chat_with_history(db, 3)
+    monkeypatch.setattr(archive, "after_days", 0)
+
+    def no_open(chat_id):
+        raise AssertionError("segment looked up with archiving off")
+
+    monkeypatch.setattr(archive, "_open", no_open)
+    assert archive.boundary(chat_id) is None
+    assert [m.id for m in crud.get_messages_by_chat(db, chat_id, limit=10)] == ids
@@ -0,0 +1,86 @@
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+from fastapi.testclient import TestClient
+
+import database
+from helpers import sign_up_and_login
+from main import create_app
+
+
+def test_async_mode_uses_the_async_engine(make_settings):
+    with TestClient(create_app(make_settings(async_db=True))):
+        assert database.async_engine is not None
+        assert database.async_engine.url.drivername == "sqlite+aiosqlite"
+    assert database.async_engine is None
+
+
+def test_async_message_round_trip(make_settings):
+    with TestClient(create_app(make_settings(async_db=True))) as client:
+        alice = sign_up_and_login(client, "alice")
+        bob = sign_up_and_login(client, "bob")
+
+        response = client.post(
+            "/chats/", json={"is_group": False, "participant_ids": [alice["id"], bob["id"]]}, headers=alice["headers"]
+        )
+        assert response.status_code == 200, response.text
+        chat_id = response.json()["id"]
+
+        sent = []
+        for n in range(3):
+            response = client.post(
+                "/messages/",
+                json={"chat_id": chat_id, "sender_id": alice["id"], "content": f"hello {n}"},
+                headers=alice["headers"],
+            )
+            assert response.status_code == 200, response.text
+            assert response.json()["sender"]["username"] == "alice"
+            sent.append(response.json()["id"])
+
+        response = client.get(f"/messages/chat/{chat_id}", params={"limit": 2}, headers=bob["headers"])
+        assert response.status_code == 200, response.text
+        page = response.json()
+        assert [m["id"] for m in page["items"]] == sent[1:]
+        assert page["has_more"] is True
+
+        response = client.get(
+            f"/messages/chat/{chat_id}/since", params={"since_id": sent[0]}, headers=bob["headers"]
+        )
+        assert response.status_code == 200, response.text
+        assert [m["id"] for m in response.json()["items"]] == sent[1:]
+
+
+def test_async_send_rejects_other_sender(make_settings):
+    with TestClient(create_app(make_settings(async_db=True))) as client:
+        alice = sign_up_and_login(client, "alice")
+        bob = sign_up_and_login(client, "bob")
+        response = client.post(
+            "/chats/", json={"is_group": True, "participant_ids": [alice["id"], bob["id"]]}, headers=alice["headers"]
+        )
+        chat_id = response.json()["id"]
+
+        response = client.post(
+            "/messages/",
+            json={"chat_id": chat_id, "sender_id": bob["id"], "content": "not mine"},
+            headers=alice["headers"],
+        )
+        assert response.status_code == 403
+
+
+def test_async_routes_authenticate_without_the_sync_pool(make_settings):
+    from dependencies import get_current_user
+    from routers import aio
+
+    def calls(dependant):
+        for dependency in dependant.dependencies:
+            yield dependency.call
+            yield from calls(dependency)
+
+    for router in aio.routers:
+        for route in router.routes:
+            assert get_current_user not in set(calls(route.dependant)), route.path
+
+    with TestClient(create_app(make_settings(async_db=True))) as client:
+        response = client.get("/messages/chat/1", headers={"Authorization": "Bearer nonsense"})
+        assert response.status_code == 401
@@ -0,0 +1,111 @@
+import queue
+import socket
+import threading
+import time
+
+import pytest
+
+from utils.broker import Broker, RelayBroker, RespError, encode_command, read_reply
+
+
+def split_writes(data: bytes, size: int):
+    """
+    The read end of a socket pair, `data` trickling in `size` bytes at a time.
+    """
+    reader, writer = socket.socketpair()
+
+    def trickle():
+        for start in range(0, len(data), size):
+            writer.sendall(data[start:start + size])
+            time.sleep(0.001)
+        writer.close()
+
+    threading.Thread(target=trickle, daemon=True).start()
+    return reader.makefile("rb")
+
+
+class Listener:
+    """
+    Collects what a broker delivers, and counts its resets.
+    """
+
+    def __init__(self):
+        self.events: queue.Queue = queue.Queue()
+        self.resets = threading.Semaphore(0)
+
+    def deliver(self, chat_id: int, payload: str):
+        self.events.put((chat_id, payload))
+
+    def reset(self):
+        self.resets.release()
+
+    def subscribed(self):
+        assert self.resets.acquire(timeout=5), "never (re)subscribed"
+
+    def next(self):
+        return self.events.get(timeout=5)
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """
+    Two workers' brokers sharing one relay socket, both subscribed.
+    """
+    path = str(tmp_path / "chat.sock")
+    brokers, listeners = [RelayBroker(path), RelayBroker(path)], [Listener(), Listener()]
+    try:
+        for broker, listener in zip(brokers, listeners):
+            broker.start(listener.deliver, listener.reset)
+            listener.subscribed()
+        yield brokers, listeners
+    finally:
+        for broker in brokers:
+            broker.stop()
+
+
+def test_broker_is_abstract():
+    with pytest.raises(TypeError):
+        Broker()
+
+
+def test_replies_split_across_reads():
+    payload = "x" * 300 + "\r\n" + "é"
+    data = encode_command("pmessage", "chat:*", "chat:7", payload) + b":42\r\n-ERR nope\r\n$-1\r\n"
+    for size in (1, 7, 4096):
+        stream = split_writes(data, size)
+        assert read_reply(stream) == [b"pmessage", b"chat:*", b"chat:7", payload.encode()]
+        assert read_reply(stream) == 42
+        error = read_reply(stream)
+        assert isinstance(error, RespError) and str(error) == "ERR nope"
+        assert read_reply(stream) is None
+
+
+def test_truncated_replies_are_disconnects():
+    for data in (b"$10\r\nshort", b"*2\r\n$1\r\na\r\n", b"+OK"):
+        with pytest.raises(ConnectionError):
+            read_reply(split_writes(data, 2))
+
+
+def test_events_reach_every_worker(workers):
+    brokers, listeners = workers
+    assert sum(broker.relay.running for broker in brokers) == 1
+
+    brokers[0].publish(3, "from the first")
+    brokers[1].publish(4, "from the second")
+    for listener in listeners:
+        assert {listener.next(), listener.next()} == {(3, "from the first"), (4, "from the second")}
+
+
+def test_workers_reconnect_when_the_relay_goes_away(workers):
+    brokers, listeners = workers
+    relay = next(broker.relay for broker in brokers if broker.relay.running)
+    relay.stop()
+
+    # Every subscriber resubscribes (resetting what it may have missed) to the relay's successor
+    for listener in listeners:
+        listener.subscribed()
+    assert sum(broker.relay.running for broker in brokers) == 1
+
+    brokers[0].publish(5, "after the restart")
+    for listener in listeners:
+        assert listener.next() == (5, "after the restart")
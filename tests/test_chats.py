@@ -0,0 +1,110 @@
+import threading
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import crud, models, Schemas
+from database import Base
+from helpers import sign_up_and_login
+
+
+def test_direct_chats_keep_their_two_participants(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    mallory = sign_up_and_login(client, "mallory")
+    chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+
+    # Not a participant
+    response = client.post(f"/chats/{chat_id}/add_user/{mallory['id']}", headers=mallory["headers"])
+    assert response.status_code == 403
+    # A participant, but the chat is direct
+    response = client.post(f"/chats/{chat_id}/add_user/{mallory['id']}", headers=alice["headers"])
+    assert response.status_code == 409
+
+    chat = client.post(f"/chats/direct/{alice['id']}", headers=bob["headers"]).json()
+    assert chat["id"] == chat_id
+    assert sorted(user["id"] for user in chat["participants"]) == sorted([alice["id"], bob["id"]])
+
+
+def test_group_chats_gain_participants_from_members(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    carol = sign_up_and_login(client, "carol")
+    response = client.post(
+        "/chats/", json={"is_group": True, "participant_ids": [alice["id"], bob["id"]]}, headers=alice["headers"]
+    )
+    chat_id = response.json()["id"]
+
+    assert client.post(f"/chats/{chat_id}/add_user/{carol['id']}", headers=carol["headers"]).status_code == 403
+    assert client.post(f"/chats/{chat_id}/add_user/{carol['id']}", headers=alice["headers"]).status_code == 200
+
+
+def test_concurrent_direct_chat_creation_yields_one_chat(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'race.db'}", connect_args={"timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    with Session() as db:
+        ids = [
+            crud.create_user(db, Schemas.UserCreate(username=name, email=f"{name}@example.com", password="x"), "h").id
+            for name in ("alice", "bob")
+        ]
+
+    workers = 8
+    barrier = threading.Barrier(workers)
+    results, errors = [], []
+
+    def create(index: int):
+        pair = ids if index % 2 else ids[::-1]
+        db = Session()
+        try:
+            barrier.wait()
+            results.append(crud.get_or_create_direct_chat(db, *pair).id)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=create, args=(index,)) for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(set(results)) == 1
+    with Session() as db:
+        assert db.query(func.count(models.Chat.id)).scalar() == 1
+        assert db.query(func.count(models.ChatParticipant.chat_id)).scalar() == 2
+    engine.dispose()
+
+
+def test_history_and_chat_lists_are_private(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    mallory = sign_up_and_login(client, "mallory")
+    chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+    message = {"chat_id": chat_id, "sender_id": alice["id"], "content": "hi"}
+    assert client.post("/messages/", json=message, headers=alice["headers"]).status_code == 200
+
+    for path in (f"/messages/chat/{chat_id}", f"/messages/chat/{chat_id}/since?since_id=0"):
+        assert client.get(path, headers=mallory["headers"]).status_code == 403
+        assert client.get(path, headers=bob["headers"]).status_code == 200
+    assert client.get(f"/chats/user/{alice['id']}", headers=mallory["headers"]).status_code == 403
+    assert client.get(f"/chats/user/{alice['id']}", headers=alice["headers"]).status_code == 200
+
+
+def test_messages_of_deleted_accounts_are_still_listed(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+    message = {"chat_id": chat_id, "sender_id": bob["id"], "content": "bye"}
+    assert client.post("/messages/", json=message, headers=bob["headers"]).status_code == 200
+    assert client.delete(f"/users/{bob['id']}", headers=bob["headers"]).status_code == 204
+
+    response = client.get("/chats/inbox", headers=alice["headers"])
+    assert response.status_code == 200, response.text
+    assert response.json()["items"][0]["last_message"]["sender_id"] is None
+    for params in ({}, {"senders": "ids"}, {"fast": "true"}):
+        response = client.get(f"/messages/chat/{chat_id}", params=params, headers=alice["headers"])
+        assert response.status_code == 200, response.text
+        assert response.json()["items"][0]["sender_id"] is None
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import crud, models, Schemas
+from database import Base
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'crud.db'}")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def send(db, chat_id: int, sender_id: int, timestamp: datetime) -> models.Message:
+    message = models.Message(chat_id=chat_id, sender_id=sender_id, content="hi", timestamp=timestamp)
+    crud.record_message(db, message)
+    db.commit()
+    return message
+
+
+def test_deleting_the_last_message_moves_the_chat_back(db):
+    user = crud.create_user(db, Schemas.UserCreate(username="ann", email="ann@example.com", password="x"), "hash")
+    chat = crud.create_chat(db, Schemas.ChatCreate(is_group=True, participant_ids=[user.id]))
+    start = datetime(2024, 1, 1)
+    first = send(db, chat.id, user.id, start)
+    last = send(db, chat.id, user.id, start + timedelta(minutes=5))
+
+    crud.delete_message(db, last.id)
+    db.refresh(chat)
+    assert (chat.last_message_id, chat.last_activity_at) == (first.id, start)
+
+    crud.delete_message(db, first.id)
+    db.refresh(chat)
+    assert chat.last_message_id is None
+    assert chat.last_activity_at == chat.created_at
+
+
+def test_read_state_changes_the_chat_version(db):
+    user = crud.create_user(db, Schemas.UserCreate(username="ann", email="ann@example.com", password="x"), "hash")
+    chat = crud.create_chat(db, Schemas.ChatCreate(is_group=True, participant_ids=[user.id]))
+    message = send(db, chat.id, user.id, datetime(2024, 1, 1))
+    versions = [db.query(models.Chat.version).filter(models.Chat.id == chat.id).scalar()]
+
+    crud.mark_message_as_read(db, message.id)
+    versions.append(db.query(models.Chat.version).filter(models.Chat.id == chat.id).scalar())
+    assert crud.mark_chat_read(db, chat.id, user.id, message.id)
+    versions.append(db.query(models.Chat.version).filter(models.Chat.id == chat.id).scalar())
+    assert not crud.mark_chat_read(db, chat.id, user.id, message.id)
+    versions.append(db.query(models.Chat.version).filter(models.Chat.id == chat.id).scalar())
+
+    assert versions[0] < versions[1] < versions[2] == versions[3]
+
+
+def test_unread_counts_follow_reads_and_deletes(db):
+    ann, bea = (
+        crud.create_user(db, Schemas.UserCreate(username=name, email=f"{name}@example.com", password="x"), "hash")
+        for name in ("ann", "bea")
+    )
+    chat = crud.create_chat(db, Schemas.ChatCreate(is_group=True, participant_ids=[ann.id, bea.id]))
+    start = datetime(2024, 1, 1)
+    sent = [send(db, chat.id, ann.id, start + timedelta(minutes=n)) for n in range(5)]
+    reply = send(db, chat.id, bea.id, start + timedelta(minutes=5))
+
+    # Own messages never count
+    assert crud.get_unread_counts(db, bea.id) == [(chat.id, 5)]
+    assert crud.get_unread_counts(db, ann.id) == [(chat.id, 1)]
+
+    assert crud.mark_chat_read(db, chat.id, bea.id, sent[2].id)
+    assert crud.get_unread_counts(db, bea.id) == [(chat.id, 2)]
+    # Deleting a read message changes nothing, an unread one drops out
+    crud.delete_message(db, sent[0].id)
+    assert crud.get_unread_counts(db, bea.id) == [(chat.id, 2)]
+    crud.delete_message(db, sent[4].id)
+    assert crud.get_unread_counts(db, bea.id) == [(chat.id, 1)]
+
+    # Reading up to a deleted message is refused, the watermark stays
+    assert not crud.mark_chat_read(db, chat.id, bea.id, sent[4].id)
+    assert crud.mark_chat_read(db, chat.id, bea.id, reply.id)
+    assert crud.get_unread_counts(db, bea.id) == [(chat.id, 0)]
+    assert crud.get_unread_counts(db, ann.id) == [(chat.id, 1)]
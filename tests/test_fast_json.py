@@ -0,0 +1,42 @@
+from helpers import sign_up_and_login
+
+
+def both(client, url: str, headers: dict, **params):
+    """
+    The regular and the fast response of one request, as parsed JSON.
+    """
+    slow = client.get(url, params=params, headers=headers)
+    fast = client.get(url, params={**params, "fast": True}, headers=headers)
+    assert slow.status_code == fast.status_code == 200, (slow.text, fast.text)
+    return slow.json(), fast.json()
+
+
+def test_fast_responses_match_the_regular_ones(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    carol = sign_up_and_login(client, "carol")
+    chat_id = client.post(
+        "/chats/", json={"is_group": True, "participant_ids": [alice["id"], bob["id"], carol["id"]]},
+        headers=alice["headers"],
+    ).json()["id"]
+    client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"])
+    for n, user in enumerate((alice, bob, alice, carol, bob)):
+        message = {"chat_id": chat_id, "sender_id": user["id"], "content": f"message {n} é \"quoted\"\n"}
+        assert client.post("/messages/", json=message, headers=user["headers"]).status_code == 200
+    # Senders can go away, their messages stay
+    assert client.delete(f"/users/{carol['id']}", headers=carol["headers"]).status_code == 204
+
+    url = f"/messages/chat/{chat_id}"
+    for params in ({}, {"senders": "ids"}, {"limit": 2}, {"limit": 2, "senders": "ids"}):
+        slow, fast = both(client, url, bob["headers"], **params)
+        assert slow == fast
+    older = both(client, url, bob["headers"], limit=2)[0]["older_cursor"]
+    slow, fast = both(client, url, bob["headers"], limit=2, before=older)
+    assert slow == fast and len(slow["items"]) == 2
+
+    slow, fast = both(client, f"/chats/user/{alice['id']}", alice["headers"])
+    assert slow == fast and len(slow) == 2
+
+    for params in ({}, {"limit": 1}, {"after": alice["id"]}):
+        slow, fast = both(client, "/users/", alice["headers"], **params)
+        assert slow == fast
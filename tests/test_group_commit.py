@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+import crud, models, Schemas
+from database import Base
+from helpers import sign_up_and_login
+from main import create_app
+from utils.group_commit import GroupCommitWriter, WriterUnavailable, writer
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'writer.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine, autoflush=False)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def message(session_factory):
+    db = session_factory()
+    user = crud.create_user(db, Schemas.UserCreate(username="ann", email="ann@example.com", password="x"), "hash")
+    chat = crud.create_chat(db, Schemas.ChatCreate(is_group=True, participant_ids=[user.id]))
+    message = Schemas.MessageCreate(chat_id=chat.id, sender_id=user.id, content="hi")
+    db.close()
+    return message
+
+
+def stored(session_factory) -> int:
+    db = session_factory()
+    try:
+        return db.scalar(select(func.count()).select_from(models.Message))
+    finally:
+        db.close()
+
+
+def test_slow_commits_time_out(session_factory, message):
+    gate = threading.Event()
+
+    def stuck_factory():
+        gate.wait(5)
+        return session_factory()
+
+    slow = GroupCommitWriter(stuck_factory, max_batch=1, max_wait_ms=0, timeout_ms=100)
+    # Its batch is already committing, it lands late
+    with pytest.raises(WriterUnavailable):
+        slow.write(message)
+    # Still queued when it gave up, never written
+    with pytest.raises(WriterUnavailable):
+        slow.write(message)
+    gate.set()
+    slow.stop()
+    assert stored(session_factory) == 1
+
+
+def test_a_dead_writer_thread_is_restarted(session_factory, message):
+    revived = GroupCommitWriter(session_factory, max_wait_ms=0)
+    revived.write(message)
+    # Ends the thread behind the writer's back
+    revived._queue.put(None)
+    revived._thread.join(5)
+
+    assert revived.write(message).chat_id == message.chat_id
+    assert revived.stats()["running"]
+    revived.stop()
+    assert stored(session_factory) == 2
+
+
+def test_unconfirmed_sends_answer_503(make_settings, monkeypatch):
+    with TestClient(create_app(make_settings(group_commit_enabled=True))) as client:
+        alice = sign_up_and_login(client, "alice")
+        bob = sign_up_and_login(client, "bob")
+        chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+
+        def give_up(message_data):
+            raise WriterUnavailable()
+
+        monkeypatch.setattr(writer, "write", give_up)
+        response = client.post(
+            "/messages/", json={"chat_id": chat_id, "sender_id": alice["id"], "content": "hi"}, headers=alice["headers"]
+        )
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
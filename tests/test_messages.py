@@ -0,0 +1,98 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from helpers import sign_up_and_login
+from main import create_app
+
+
+@pytest.fixture
+def chat(client):
+    """
+    alice and bob's direct chat: (alice, bob, chat_id).
+    """
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+    return alice, bob, chat_id
+
+
+def send_batch(client, user: dict, chat_id: int, count: int) -> list:
+    batch = [{"chat_id": chat_id, "sender_id": user["id"], "content": f"m{n}"} for n in range(count)]
+    response = client.post("/messages/batch", json=batch, headers=user["headers"])
+    assert response.status_code == 200, response.text
+    return [message["id"] for message in response.json()]
+
+
+def test_pages_split_messages_with_equal_timestamps(client, chat):
+    alice, bob, chat_id = chat
+    # One batch, one timestamp for all of them: only the id orders them
+    ids = send_batch(client, alice, chat_id, 7)
+
+    for fast in (False, True):
+        seen, params = [], {"limit": 3, "fast": fast}
+        while True:
+            page = client.get(f"/messages/chat/{chat_id}", params=params, headers=bob["headers"]).json()
+            seen[:0] = [message["id"] for message in page["items"]]
+            if not page["has_more"]:
+                break
+            params = {"limit": 3, "fast": fast, "before": page["older_cursor"]}
+        assert seen == ids
+
+        newer = client.get(
+            f"/messages/chat/{chat_id}",
+            params={"limit": 3, "fast": fast, "after": page["newer_cursor"]},
+            headers=bob["headers"],
+        ).json()
+        assert [message["id"] for message in newer["items"]] == ids[1:4]
+
+
+def test_batches_are_validated_as_a_whole(make_settings):
+    with TestClient(create_app(make_settings(max_message_batch=4))) as client:
+        alice = sign_up_and_login(client, "alice")
+        bob = sign_up_and_login(client, "bob")
+        carol = sign_up_and_login(client, "carol")
+        chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+        other_id = client.post(f"/chats/direct/{carol['id']}", headers=bob["headers"]).json()["id"]
+
+        def message(chat: int = chat_id, sender: int = alice["id"]) -> dict:
+            return {"chat_id": chat, "sender_id": sender, "content": "hi"}
+
+        def post(batch: list) -> int:
+            return client.post("/messages/batch", json=batch, headers=alice["headers"]).status_code
+
+        assert post([]) == 400
+        assert post([message()] * 5) == 413
+        assert post([message(), message(sender=bob["id"])]) == 403
+        assert post([message(), message(chat=other_id + 100)]) == 404
+        assert post([message(), message(chat=other_id)]) == 403
+        # Nothing of the refused batches was written
+        history = client.get(f"/messages/chat/{chat_id}", headers=alice["headers"]).json()
+        assert history["items"] == []
+
+        assert post([message()] * 4) == 200
+
+
+def test_unchanged_history_answers_304(client, chat):
+    alice, bob, chat_id = chat
+    url = f"/messages/chat/{chat_id}"
+    send_batch(client, alice, chat_id, 2)
+
+    first = client.get(url, headers=bob["headers"])
+    etag = first.headers["ETag"]
+    again = client.get(url, headers={**bob["headers"], "If-None-Match": etag})
+    assert again.status_code == 304 and again.headers["ETag"] == etag and not again.content
+    # Another representation, another tag
+    fast_etag = client.get(url, params={"fast": True}, headers=bob["headers"]).headers["ETag"]
+    assert fast_etag != etag
+    fast = client.get(url, params={"fast": True}, headers={**bob["headers"], "If-None-Match": fast_etag})
+    assert fast.status_code == 304
+
+    # Any participant may revalidate the same version, an outsider still gets 403
+    assert client.get(url, headers={**alice["headers"], "If-None-Match": etag}).status_code == 304
+    carol = sign_up_and_login(client, "carol")
+    assert client.get(url, headers={**carol["headers"], "If-None-Match": etag}).status_code == 403
+
+    send_batch(client, alice, chat_id, 1)
+    changed = client.get(url, headers={**bob["headers"], "If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert len(changed.json()["items"]) == 3
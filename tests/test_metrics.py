@@ -0,0 +1,44 @@
+from helpers import sign_up_and_login
+
+
+HISTORY = 'method="GET",route="/messages/chat/{chat_id}"'
+
+
+def scrape(client) -> dict:
+    """
+    Sample name with labels -> value, from /metrics.
+    """
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_requests_are_counted_per_route_template(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    chat_id = client.post(f"/chats/direct/{bob['id']}", headers=alice["headers"]).json()["id"]
+    before = scrape(client)
+
+    for _ in range(3):
+        assert client.get(f"/messages/chat/{chat_id}", headers=alice["headers"]).status_code == 200
+    assert client.get("/messages/chat/999999", headers=alice["headers"]).status_code == 404
+    after = scrape(client)
+
+    def delta(name: str) -> float:
+        return after.get(name, 0) - before.get(name, 0)
+
+    # One series for every chat id, split by status
+    assert delta(f'http_requests_total{{{HISTORY},status="200"}}') == 3
+    assert delta(f'http_requests_total{{{HISTORY},status="404"}}') == 1
+    assert delta(f"http_request_duration_seconds_count{{{HISTORY}}}") == 4
+    assert delta(f'http_request_duration_seconds_bucket{{{HISTORY},le="+Inf"}}') == 4
+    assert delta(f"http_request_db_statements_count{{{HISTORY}}}") == 4
+    # Every request needed the database at least once
+    assert delta(f"http_request_db_statements_sum{{{HISTORY}}}") >= 4
+    assert delta('db_statements_total{engine="default"}') >= 4
+    assert not any(name.startswith("http_requests_total") and "/999999" in name for name in after)
@@ -0,0 +1,52 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+import crud, models, Schemas
+from database import Base
+from main import create_app
+from utils.presence import PresenceRegistry
+
+
+def online_ids(db) -> set:
+    db.expire_all()
+    return {user.id for user in db.query(models.User).filter(models.User.is_online.is_(True))}
+
+
+def test_startup_clears_presence_left_by_a_dead_process(make_settings):
+    settings = make_settings()
+    engine = create_engine(settings.database_url)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    for name in ("ann", "bea"):
+        crud.create_user(db, Schemas.UserCreate(username=name, email=f"{name}@example.com", password="x"), "hash")
+    db.execute(update(models.User).values(is_online=True))
+    db.commit()
+
+    with TestClient(create_app(settings)):
+        assert online_ids(db) == set()
+    db.close()
+    engine.dispose()
+
+
+def test_online_users_are_written_again_once_per_timeout(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'presence.db'}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    user = crud.create_user(db, Schemas.UserCreate(username="ann", email="ann@example.com", password="x"), "hash")
+    registry = PresenceRegistry(timeout=60)
+
+    registry.heartbeat(user.id)
+    registry.flush(db)
+    assert online_ids(db) == {user.id}
+
+    # Another worker's startup reset it
+    db.execute(update(models.User).values(is_online=False))
+    db.commit()
+    registry.flush(db)
+    assert online_ids(db) == set()
+    registry._reasserted -= 60
+    registry.flush(db)
+    assert online_ids(db) == {user.id}
+    db.close()
+    engine.dispose()
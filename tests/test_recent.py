@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from utils.recent import RecentMessage, RecentMessageBuffer
+
+
+def message(message_id: int, chat_id: int = 1) -> RecentMessage:
+    return RecentMessage(message_id, chat_id, 1, f"message {message_id}", datetime(2024, 1, 1), False)
+
+
+def test_window_starts_from_a_database_read():
+    buffer = RecentMessageBuffer(per_chat=10, max_bytes=1 << 20, ttl=60)
+    buffer.add(message(1), seq=1)
+    assert buffer.since(1, 0, 10) is None
+
+    buffer.fill(1, 0, [message(1)], 1, buffer.epoch)
+    buffer.add(message(2), seq=2)
+    buffer.add(message(2), seq=2)
+    assert [m.id for m in buffer.since(1, 0, 10)] == [1, 2]
+
+
+def test_sequence_gap_drops_the_window():
+    buffer = RecentMessageBuffer(per_chat=10, max_bytes=1 << 20, ttl=60)
+    buffer.fill(1, 0, [message(1)], 1, buffer.epoch)
+    # seq 2 was never delivered
+    buffer.add(message(3), seq=3)
+    assert buffer.since(1, 0, 10) is None
+    buffer.add(message(4), seq=4)
+    assert buffer.since(1, 0, 10) is None
+
+
+def test_older_read_does_not_replace_a_newer_window():
+    buffer = RecentMessageBuffer(per_chat=10, max_bytes=1 << 20, ttl=60)
+    buffer.fill(1, 1, [message(2)], 2, buffer.epoch)
+    buffer.fill(1, 0, [message(1)], 1, buffer.epoch)
+    assert [m.id for m in buffer.since(1, 1, 10)] == [2]
+    assert buffer.since(1, 0, 10) is None
+
+
+def test_clear_on_reconnect():
+    buffer = RecentMessageBuffer(per_chat=10, max_bytes=1 << 20, ttl=60)
+    buffer.fill(1, 0, [message(1)], 1, buffer.epoch)
+    epoch = buffer.epoch
+    buffer.clear()
+    assert buffer.since(1, 0, 10) is None
+    buffer.fill(1, 0, [message(1)], 1, epoch)
+    assert buffer.since(1, 0, 10) is None
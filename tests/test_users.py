@@ -0,0 +1,65 @@
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from helpers import sign_up_and_login
+
+
+def test_accounts_are_only_changed_by_their_owner(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+
+    assert client.put(f"/users/{bob['id']}", json={"username": "bobby"}, headers=alice["headers"]).status_code == 403
+    assert client.delete(f"/users/{bob['id']}", headers=alice["headers"]).status_code == 403
+    assert client.get(f"/chats/user/{bob['id']}/unread", headers=alice["headers"]).status_code == 403
+
+    assert client.get(f"/chats/user/{bob['id']}/unread", headers=bob["headers"]).status_code == 200
+    assert client.put(f"/users/{bob['id']}", json={"username": "bobby"}, headers=bob["headers"]).status_code == 200
+    assert client.delete(f"/users/{bob['id']}", headers=bob["headers"]).status_code == 204
+
+
+def test_websocket_requires_a_participant(client):
+    alice = sign_up_and_login(client, "alice")
+    bob = sign_up_and_login(client, "bob")
+    carol = sign_up_and_login(client, "carol")
+    response = client.post(
+        "/chats/", json={"is_group": False, "participant_ids": [alice["id"], bob["id"]]}, headers=alice["headers"]
+    )
+    chat_id = response.json()["id"]
+
+    token = alice["headers"]["Authorization"].split()[1]
+    with client.websocket_connect(f"/ws/chats/{chat_id}?token={token}"):
+        pass
+
+    token = carol["headers"]["Authorization"].split()[1]
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/ws/chats/{chat_id}?token={token}") as websocket:
+            websocket.receive_text()
+
+
+def test_user_pages_and_username_prefixes(client):
+    names = ["ann", "anna", "an_x", "anx", "bob", "Ann"]
+    users = [sign_up_and_login(client, name) for name in names]
+    headers = users[0]["headers"]
+
+    seen, after = [], None
+    while True:
+        params = {"limit": 4} if after is None else {"limit": 4, "after": after}
+        page = client.get("/users/", params=params, headers=headers).json()
+        seen += [user["id"] for user in page["items"]]
+        after = page["next_after"]
+        if after is None:
+            break
+    assert seen == [user["id"] for user in users]
+
+    def search(prefix: str) -> list:
+        response = client.get("/users/search", params={"prefix": prefix}, headers=headers)
+        assert response.status_code == 200, response.text
+        return [user["username"] for user in response.json()]
+
+    assert search("an") == ["an_x", "ann", "anna", "anx"]
+    # LIKE wildcards in the prefix are plain characters
+    assert search("an_") == ["an_x"]
+    assert search("ann") == ["ann", "anna"]
+    assert search("Ann") == ["Ann"]
+    assert search("z") == []
+    assert client.get("/users/search", params={"prefix": ""}, headers=headers).status_code == 422